@@ -14,7 +14,6 @@
 
 import numpy as np
 import json
-import torch
 from swig_decoders import PathTrie, TrieVector
 
 # triton_python_backend_utils is available in every Triton Python model. You
@@ -82,8 +81,7 @@ class TritonPythonModel:
           be the same as `requests`
         """
         responses = []
-        batch_log_probs, batch_log_probs_idx, batch_len, batch_states = [], [], [], []
-        cur_encoder_out = []
+        batch_log_probs, batch_log_probs_idx, batch_len = [], [], []
 
         batch_encoder_hist = []
         batch_start = []
@@ -97,19 +95,15 @@ class TritonPythonModel:
         # and create a pb_utils.InferenceResponse for each of them.
         batch_idx = 0
         for request in requests:
-            # Get INPUT0
+            # Get INPUT0, the input tensors are only read during this
+            # inference, so they are used by dlpack without copies
             in_0 = pb_utils.get_input_tensor_by_name(request, "log_probs")
-            batch_log_probs.append(in_0.as_numpy()[0])
+            batch_log_probs.append(from_dlpack(in_0.to_dlpack())[0])
             in_1 = pb_utils.get_input_tensor_by_name(request, "log_probs_idx")
-            batch_log_probs_idx.append(in_1.as_numpy()[0])
-            if self.model.rescoring:
-                in_2 = pb_utils.get_input_tensor_by_name(request, "chunk_out")
-                # important to use clone or this tensor
-                # the tensor will be released after one inference
-                in_2 = from_dlpack(in_2.to_dlpack()).clone()
-                cur_encoder_out.append(in_2[0])
+            batch_log_probs_idx.append(from_dlpack(in_1.to_dlpack())[0])
             in_3 = pb_utils.get_input_tensor_by_name(request, "chunk_out_lens")
-            batch_len.append(in_3.as_numpy())
+            chunk_len = int(in_3.as_numpy().item())
+            batch_len.append(chunk_len)
 
             in_start = pb_utils.get_input_tensor_by_name(request, "START")
             start = in_start.as_numpy()[0][0]
@@ -130,43 +124,40 @@ class TritonPythonModel:
 
             if start and ready:
                 # intialize states
-                encoder_out = self.model.generate_init_cache()
+                encoder_hist = self.model.generate_init_cache()
                 root = PathTrie()
                 # register this sequence
-                self.seq_states[corrid] = [root, encoder_out]
+                self.seq_states[corrid] = [root, encoder_hist]
 
             if end and ready:
                 rescore_index[batch_idx] = 1
 
             if ready:
-                root, encoder_out = self.seq_states[corrid]
+                root, encoder_hist = self.seq_states[corrid]
                 trieVector.append(root)
                 batch_idx2_corrid[batch_idx] = corrid
-                batch_encoder_hist.append(encoder_out)
+                if self.model.rescoring:
+                    in_2 = pb_utils.get_input_tensor_by_name(request,
+                                                             "chunk_out")
+                    # the chunk is copied into the history buffer, which
+                    # outlives this inference
+                    in_2 = from_dlpack(in_2.to_dlpack())
+                    encoder_hist.append(in_2[0][0:chunk_len])
+                batch_encoder_hist.append(encoder_hist)
 
             batch_idx += 1
 
-        batch_states = [trieVector, batch_start, batch_encoder_hist, cur_encoder_out]
-        res_sents, new_states = self.model.infer(batch_log_probs, batch_log_probs_idx,
-                                                 batch_len, rescore_index, batch_states)
-        cur_encoder_out = new_states
+        batch_states = [trieVector, batch_start, batch_encoder_hist]
+        res_sents = self.model.infer(batch_log_probs, batch_log_probs_idx,
+                                     batch_len, rescore_index, batch_states)
         for i in range(len(res_sents)):
             sent = np.array(res_sents[i])
             out_tensor_0 = pb_utils.Tensor("OUTPUT0", sent.astype(self.output0_dtype))
             response = pb_utils.InferenceResponse(output_tensors=[out_tensor_0])
             responses.append(response)
-            corr = batch_idx2_corrid[i]
             if i in rescore_index:
                 # this response ends, remove it
-                del self.seq_states[corr]
-            else:
-                if self.model.rescoring:
-                    if self.seq_states[corr][1] is None:
-                        self.seq_states[corr][1] = cur_encoder_out[i]
-                    else:
-                        new_hist = torch.cat([self.seq_states[corr][1],
-                                              cur_encoder_out[i]], axis=0)
-                        self.seq_states[corr][1] = new_hist
+                del self.seq_states[batch_idx2_corrid[i]]
 
         assert len(requests) == len(responses)
         return responses
@@ -13,6 +13,7 @@
 # limitations under the License.
 
 
+import itertools
 import multiprocessing
 import numpy as np
 import os
@@ -20,6 +21,41 @@ import torch
 import triton_python_backend_utils as pb_utils
 from torch.utils.dlpack import to_dlpack, from_dlpack
 from swig_decoders import ctc_beam_search_decoder_batch, Scorer, map_batch
+from torch.nn.utils.rnn import pad_sequence
+
+
+class EncoderHistory(object):
+    """Encoder output of a sequence, kept in a preallocated buffer which
+    doubles its capacity when it is full, so appending a chunk copies only
+    the chunk instead of the whole history.
+    """
+    def __init__(self, init_frames=64):
+        self.init_frames = init_frames
+        self.buffer = None
+        self.length = 0
+
+    def append(self, chunk):
+        """chunk: TxF, copied into the buffer
+        """
+        n = chunk.shape[0]
+        if self.buffer is None:
+            self.buffer = torch.empty((max(self.init_frames, n),
+                                       chunk.shape[1]),
+                                      dtype=chunk.dtype)
+        elif self.length + n > self.buffer.shape[0]:
+            capacity = max(2 * self.buffer.shape[0], self.length + n)
+            buffer = torch.empty((capacity, self.buffer.shape[1]),
+                                 dtype=self.buffer.dtype)
+            buffer[0:self.length] = self.buffer[0:self.length]
+            self.buffer = buffer
+        self.buffer[self.length:self.length + n] = chunk
+        self.length += n
+
+    def get(self):
+        """Return: length x F view of the history
+        """
+        return self.buffer[0:self.length]
+
 
 class WenetModel(object):
     def __init__(self, model_config, device):
@@ -67,8 +103,7 @@ class WenetModel(object):
             self.dtype = torch.float16
 
     def generate_init_cache(self):
-        encoder_out = None
-        return encoder_out
+        return EncoderHistory()
 
     def load_vocab(self, vocab_file):
         """
@@ -118,10 +153,11 @@ class WenetModel(object):
     def infer(self, batch_log_probs, batch_log_probs_idx,
               seq_lens, rescore_index, batch_states):
         """
-        batch_states = [trieVector, batch_start,
-                       batch_encoder_hist, cur_encoder_out]
+        batch_log_probs, batch_log_probs_idx: [len1xbeam, len2xbeam, ...]
+        batch_states = [trieVector, batch_start, batch_encoder_hist],
+        the current chunks are already in batch_encoder_hist
         """
-        trie_vector, batch_start, batch_encoder_hist, cur_encoder_out = batch_states
+        trie_vector, batch_start, batch_encoder_hist = batch_states
         num_processes = min(multiprocessing.cpu_count(), len(batch_log_probs))
 
         score_hyps = self.batch_ctc_prefix_beam_search_cpu(batch_log_probs,
@@ -138,25 +174,12 @@ class WenetModel(object):
 
         if self.rescoring and len(rescore_index) != 0:
             # find the end of sequence
-            rescore_encoder_hist = []
-            rescore_encoder_lens = []
-            rescore_hyps = []
             res_idx = list(rescore_index.keys())
-            max_length = -1
-            for idx in res_idx:
-                hist_enc = batch_encoder_hist[idx]
-                if hist_enc is None:
-                    cur_enc = cur_encoder_out[idx]
-                else:
-                    cur_enc = torch.cat([hist_enc, cur_encoder_out[idx]], axis=0)
-                rescore_encoder_hist.append(cur_enc)
-                cur_mask_len = int(len(hist_enc) + seq_lens[idx])
-                rescore_encoder_lens.append(cur_mask_len)
-                rescore_hyps.append(score_hyps[idx])
-                if cur_enc.shape[0] > max_length:
-                    max_length = cur_enc.shape[0]
-            best_index = self.batch_rescoring(rescore_hyps, rescore_encoder_hist,
-                                              rescore_encoder_lens, max_length)
+            rescore_encoder_hist = [batch_encoder_hist[idx].get()
+                                    for idx in res_idx]
+            rescore_hyps = [score_hyps[idx] for idx in res_idx]
+            best_index = self.batch_rescoring(rescore_hyps,
+                                              rescore_encoder_hist)
 
         best_sent = []
         j = 0
@@ -169,7 +192,7 @@ class WenetModel(object):
 
         final_result = map_batch(best_sent, self.vocab, num_processes)
 
-        return final_result, cur_encoder_out
+        return final_result
 
     def batch_ctc_prefix_beam_search_cpu(self, batch_log_probs_seq,
                                          batch_log_probs_idx,
@@ -179,17 +202,25 @@ class WenetModel(object):
                                          cutoff_prob, num_processes,
                                          scorer):
         """
+        batch_log_probs_seq, batch_log_probs_idx: tensors of lenxbeam
         Return: Batch x Beam_size elements, each element is a tuple
                 (score, list of ids),
         """
-
-        batch_len_list = batch_len
+        batch_len_list = [int(x) for x in batch_len]
+        # the decoder takes python lists, convert the whole batch at once
+        log_probs = torch.cat([x[0:n] for x, n in
+                               zip(batch_log_probs_seq, batch_len_list)])
+        log_probs_idx = torch.cat([x[0:n] for x, n in
+                                   zip(batch_log_probs_idx, batch_len_list)])
+        log_probs, log_probs_idx = log_probs.tolist(), log_probs_idx.tolist()
         batch_log_probs_seq_list = []
         batch_log_probs_idx_list = []
-        for i in range(len(batch_len_list)):
-            cur_len = int(batch_len_list[i])
-            batch_log_probs_seq_list.append(batch_log_probs_seq[i][0:cur_len].tolist())
-            batch_log_probs_idx_list.append(batch_log_probs_idx[i][0:cur_len].tolist())
+        start = 0
+        for cur_len in batch_len_list:
+            end = start + cur_len
+            batch_log_probs_seq_list.append(log_probs[start:end])
+            batch_log_probs_idx_list.append(log_probs_idx[start:end])
+            start = end
         score_hyps = ctc_beam_search_decoder_batch(batch_log_probs_seq_list,
                                                    batch_log_probs_idx_list,
                                                    batch_root,
@@ -202,58 +233,50 @@ class WenetModel(object):
                                                    scorer)
         return score_hyps
 
-    def batch_rescoring(self, score_hyps, hist_enc, hist_mask_len, max_len):
+    def batch_rescoring(self, score_hyps, hist_enc):
         """
         score_hyps: [((ctc_score, (id1, id2, id3, ....)), (), ...), ....]
         hist_enc: [len1xF, len2xF, .....]
-        hist_mask: [1x1xlen1, 1x1xlen2]
         return bzx1  best_index
         """
         bz = len(hist_enc)
-        f = hist_enc[0].shape[-1]
         beam_size = self.beam_size
-        encoder_lens = np.zeros((bz, 1), dtype=np.int32)
-        encoder_out = torch.zeros((bz, max_len, f), dtype=self.dtype)
-        hyps = []
-        ctc_score = torch.zeros((bz, beam_size), dtype=self.dtype)
-        max_seq_len = 0
-        for i in range(bz):
-            cur_len = hist_enc[i].shape[0]
-            encoder_out[i, 0:cur_len] = hist_enc[i]
-            encoder_lens[i, 0] = hist_mask_len[i]
+        encoder_out = pad_sequence(hist_enc, batch_first=True)
+        encoder_lens = np.array([[x.shape[0]] for x in hist_enc],
+                                dtype=np.int32)
 
-            # process candidate
-            if len(score_hyps[i]) < beam_size:
-                to_append = (beam_size - len(score_hyps[i])) * [(-10000, ())]
-                score_hyps[i] = list(score_hyps[i]) + to_append
-            for idx, c in enumerate(score_hyps[i]):
-                score, idlist = c
-                if score < -10000:
-                    score = -10000
-                ctc_score[i][idx] = score
-                hyps.append(list(idlist))
-                if len(hyps[-1]) > max_seq_len:
-                    max_seq_len = len(hyps[-1])
+        # pad every sequence to beam_size candidates, (bz * beam_size)
+        cands = []
+        for hyps in score_hyps:
+            cands.extend(hyps)
+            cands.extend((beam_size - len(hyps)) * [(-10000, ())])
+        scores = np.array([c[0] for c in cands], dtype=np.float32)
+        ctc_score = torch.from_numpy(
+            np.maximum(scores, -10000).reshape(bz, beam_size)).to(self.dtype)
+        lens = np.array([len(c[1]) for c in cands], dtype=np.int64)
+        ids = np.fromiter(itertools.chain.from_iterable(c[1] for c in cands),
+                          dtype=np.int64, count=int(lens.sum()))
 
-        max_seq_len += 2
-        hyps_pad_sos_eos = np.ones((bz, beam_size, max_seq_len), dtype=np.int64)
-        hyps_pad_sos_eos = hyps_pad_sos_eos * self.eos  # fill eos
+        # scatter the ids of all candidates to [sos, ids, eos, eos, ...]
+        max_seq_len = int(lens.max()) + 2
+        pos = np.arange(max_seq_len - 2)
+        mask = pos < lens[:, None]
+        hyps_pad_sos_eos = np.full((bz * beam_size, max_seq_len), self.eos,
+                                   dtype=np.int64)
+        hyps_pad_sos_eos[:, 0] = self.sos
+        hyps_pad_sos_eos[:, 1:-1][mask] = ids
+        hyps_pad_sos_eos = hyps_pad_sos_eos.reshape(bz, beam_size, -1)
         if self.bidecoder:
-            r_hyps_pad_sos_eos = np.ones((bz, beam_size, max_seq_len), dtype=np.int64)
-            r_hyps_pad_sos_eos = r_hyps_pad_sos_eos * self.eos
+            # position j of a reversed candidate is its id len - 1 - j
+            offsets = np.cumsum(lens) - lens
+            r_index = offsets[:, None] + lens[:, None] - 1 - pos
+            r_hyps_pad_sos_eos = np.full((bz * beam_size, max_seq_len),
+                                         self.eos, dtype=np.int64)
+            r_hyps_pad_sos_eos[:, 0] = self.sos
+            r_hyps_pad_sos_eos[:, 1:-1][mask] = ids[r_index[mask]]
+            r_hyps_pad_sos_eos = r_hyps_pad_sos_eos.reshape(bz, beam_size, -1)
 
-        hyps_lens_sos = np.ones((bz, beam_size), dtype=np.int32)
-        bz_id = 0
-        for idx, cand in enumerate(hyps):
-            bz_id = idx // beam_size
-            length = len(cand) + 2
-            bz_offset = idx % beam_size
-            pad_cand = [self.sos] + cand + [self.eos]
-            hyps_pad_sos_eos[bz_id][bz_offset][0 : length] = pad_cand
-            if self.bidecoder:
-                r_pad_cand = [self.sos] + cand[::-1] + [self.eos]
-                r_hyps_pad_sos_eos[bz_id][bz_offset][0:length] = r_pad_cand
-            hyps_lens_sos[bz_id][idx % beam_size] = len(cand) + 1
+        hyps_lens_sos = (lens + 1).astype(np.int32).reshape(bz, beam_size)
         in0 = pb_utils.Tensor.from_dlpack("encoder_out", to_dlpack(encoder_out))
         in1 = pb_utils.Tensor("encoder_out_lens", encoder_lens)
         in2 = pb_utils.Tensor("hyps_pad_sos_eos", hyps_pad_sos_eos)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import pytest
+import torch
+from torch.nn.utils.rnn import pad_sequence
+
+from wenet.transformer.asr_model import ASRModel
+from wenet.transformer.ctc import CTC
+from wenet.transformer.decoder import BiTransformerDecoder
+from wenet.transformer.encoder import ConformerEncoder
+from wenet.utils.common import IGNORE_ID
+
+
+def make_model():
+    torch.manual_seed(777)
+    vocab_size = 10
+    encoder = ConformerEncoder(20,
+                               32,
+                               attention_heads=2,
+                               linear_units=64,
+                               num_blocks=2)
+    decoder = BiTransformerDecoder(vocab_size,
+                                   32,
+                                   attention_heads=2,
+                                   linear_units=64,
+                                   num_blocks=2,
+                                   r_num_blocks=1)
+    ctc = CTC(vocab_size, 32)
+    model = ASRModel(vocab_size, encoder, decoder, ctc)
+    model.eval()
+    return model
+
+
+def rescoring_score_loop(model, encoder_out, hyp, reverse_weight):
+    """ Score a hyp alone on the decoder as the reference, encoder_out is
+        (1, T, D) without padding
+    """
+    encoder_mask = torch.ones(1, 1, encoder_out.size(1), dtype=torch.bool)
+    ys_in = torch.tensor([[model.sos] + hyp])
+    r_ys_in = torch.tensor([[model.sos] + hyp[::-1]])
+    decoder_out, r_decoder_out, _ = model.decoder(
+        encoder_out, encoder_mask, ys_in, torch.tensor([len(hyp) + 1]),
+        r_ys_in, reverse_weight)
+    decoder_out = decoder_out.log_softmax(dim=-1)[0]
+    score = sum(decoder_out[j, w] for j, w in enumerate(hyp))
+    score += decoder_out[len(hyp), model.eos]
+    if reverse_weight > 0:
+        r_decoder_out = r_decoder_out.log_softmax(dim=-1)[0]
+        r_score = sum(r_decoder_out[len(hyp) - j - 1, w]
+                      for j, w in enumerate(hyp))
+        r_score += r_decoder_out[len(hyp), model.eos]
+        score = score * (1 - reverse_weight) + r_score * reverse_weight
+    return float(score)
+
+
+@pytest.mark.parametrize("reverse_weight", [0.0, 0.3])
+def test_attention_rescoring_score(reverse_weight):
+    model = make_model()
+    torch.manual_seed(777)
+    # hyps of different utterances and lengths, including an empty one
+    hyp_lens = [0, 1, 5, 3, 8, 5]
+    encoder_lens = torch.tensor([17, 17, 9, 30, 4, 30])
+    hyps = [torch.randint(1, 9, (n, )).tolist() for n in hyp_lens]
+    encoder_out = torch.randn(len(hyps), int(encoder_lens.max()), 32)
+    encoder_mask = (torch.arange(encoder_out.size(1)).unsqueeze(0) <
+                    encoder_lens.unsqueeze(1)).unsqueeze(1)
+    hyps_pad = pad_sequence(
+        [torch.tensor(hyp, dtype=torch.long) for hyp in hyps], True,
+        IGNORE_ID)
+    with torch.no_grad():
+        scores = model._attention_rescoring_score(
+            encoder_out, encoder_mask, hyps_pad, torch.tensor(hyp_lens),
+            reverse_weight)
+        expected = [
+            rescoring_score_loop(model, encoder_out[i:i + 1, :n], hyp,
+                                 reverse_weight)
+            for i, (hyp, n) in enumerate(zip(hyps, encoder_lens.tolist()))
+        ]
+    assert scores.tolist() == pytest.approx(expected, abs=1e-4)
+
+
+@pytest.mark.parametrize("reverse_weight", [0.0, 0.3])
+def test_attention_rescoring(reverse_weight):
+    model = make_model()
+    torch.manual_seed(777)
+    speech_lengths = torch.tensor([100, 61, 37])
+    speech = torch.randn(3, 100, 20)
+    ctc_weight, beam_size = 0.5, 4
+    with torch.no_grad():
+        best_hyps, best_scores = model.attention_rescoring(
+            speech,
+            speech_lengths,
+            beam_size,
+            ctc_weight=ctc_weight,
+            reverse_weight=reverse_weight)
+        # the nbest of the batch, every hyp is scored alone with the
+        # encoder output of its utterance
+        hyps, encoder_out, encoder_mask = model._ctc_prefix_beam_search(
+            speech, speech_lengths, beam_size)
+        for i in range(speech.size(0)):
+            valid = int(encoder_mask[i].sum())
+            scores = [
+                rescoring_score_loop(model, encoder_out[i:i + 1, :valid],
+                                     list(hyp), reverse_weight) +
+                ctc_score * ctc_weight for hyp, ctc_score, _ in hyps[i]
+            ]
+            best = max(range(len(scores)), key=lambda j: scores[j])
+            assert best_hyps[i] == list(hyps[i][best][0])
+            assert best_scores[i] == pytest.approx(scores[best], abs=1e-4)
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import pytest
+import torch
+
+from wenet.dataset.batch_augment import (BatchSpecAugment, batch_spec_aug,
+                                         batch_spec_sub)
+
+
+@pytest.mark.parametrize("time_warp_w", [0, 5])
+def test_masks_within_lengths(time_warp_w):
+    torch.manual_seed(777)
+    feats = torch.rand(4, 300, 20) + 1.0
+    feats_lengths = torch.tensor([300, 120, 11, 0])
+    for _ in range(20):
+        for y in [
+                batch_spec_aug(feats, feats_lengths, num_t_mask=3,
+                               num_f_mask=3, max_t=60, max_f=8,
+                               time_warp_w=time_warp_w),
+                batch_spec_sub(feats, feats_lengths, max_t=60, num_t_sub=3)
+        ]:
+            assert y.size() == feats.size()
+            for i, n in enumerate(feats_lengths.tolist()):
+                assert torch.equal(y[i, n:], feats[i, n:])
+
+
+def test_max_w_ignored():
+    feats = torch.rand(2, 400, 20) + 1.0
+    feats_lengths = torch.tensor([400, 300])
+    conf = dict(num_t_mask=0, num_f_mask=0, max_w=80)
+    y = BatchSpecAugment(True, conf)(feats, feats_lengths)
+    # no mask and no time warp
+    assert torch.equal(y, feats)
+    conf = dict(num_t_mask=0, num_f_mask=0, time_warp_w=80)
+    y = BatchSpecAugment(True, conf)(feats, feats_lengths)
+    assert not torch.equal(y, feats)
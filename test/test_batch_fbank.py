@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import pytest
+import torch
+
+from wenet.dataset.batch_fbank import BatchFbank
+from wenet.dataset.processor import (compute_fbank, padding,
+                                     wav_for_batch_fbank)
+
+
+@pytest.mark.parametrize("sample_rate", [8000, 16000, 22050])
+def test_batch_fbank(sample_rate):
+    torch.manual_seed(777)
+    fbank_conf = dict(num_mel_bins=80, frame_length=25, frame_shift=10)
+    window_size = int(sample_rate * 0.025)
+    # exactly a window, and some odd lengths
+    lengths = [window_size, window_size + 1, 3 * sample_rate // 7,
+               sample_rate + 123, 2 * sample_rate]
+    samples = [
+        dict(key=str(i),
+             label=[1],
+             wav=torch.rand(1, n) * 2.0 - 1.0,
+             sample_rate=sample_rate) for i, n in enumerate(lengths)
+    ]
+    expected = {
+        x['key']: x['feat']
+        for x in compute_fbank(samples, **fbank_conf)
+    }
+    data = wav_for_batch_fbank(samples, 25, 10)
+    for x in data:
+        assert x['num_frames'] == expected[x['key']].size(0)
+    data = padding([list(wav_for_batch_fbank(samples, 25, 10))])
+    keys, waveforms, _, lengths, _ = next(data)
+    feats, feats_lengths = BatchFbank(fbank_conf, sample_rate)(waveforms,
+                                                               lengths)
+    for i, key in enumerate(keys):
+        assert feats_lengths[i] == expected[key].size(0)
+        # the same up to float rounding, as BLAS may take another path for
+        # the matrix multiply of a single frame
+        assert torch.allclose(feats[i, :feats_lengths[i]], expected[key],
+                              rtol=1e-6, atol=1e-5)
+        assert (feats[i, feats_lengths[i]:] == 0).all()
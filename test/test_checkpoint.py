@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+
+import pytest
+import torch
+
+import wenet.bin.average_model as average_model
+from wenet.utils.checkpoint import load_state_dict_mmap, save_ema_checkpoint
+
+
+def make_checkpoints(path, num):
+    torch.manual_seed(777)
+    states_list = []
+    for epoch in range(num):
+        states = {
+            'linear.weight': torch.randn(16, 8),
+            'linear.bias': torch.randn(16) * 1e3,
+            'norm.num_batches_tracked': torch.tensor(epoch * 10),
+            'half': torch.randn(4).half(),
+        }
+        torch.save(states, os.path.join(path, '{}.pt'.format(epoch)))
+        states_list.append(states)
+    return states_list
+
+
+@pytest.mark.parametrize("zipfile", [True, False])
+def test_load_state_dict_mmap(tmp_path, zipfile):
+    states = {'a': torch.randn(3, 4), 'b': torch.tensor([1, 2])}
+    path = str(tmp_path / 'a.pt')
+    torch.save(states, path, _use_new_zipfile_serialization=zipfile)
+    loaded = load_state_dict_mmap(path)
+    assert loaded.keys() == states.keys()
+    for k, v in states.items():
+        assert torch.equal(loaded[k], v)
+
+
+@pytest.mark.parametrize("ema_decay", [0.0, 0.9])
+def test_average_model(tmp_path, monkeypatch, ema_decay):
+    states_list = make_checkpoints(str(tmp_path), 4)
+    dst_model = str(tmp_path / 'avg.pt')
+    monkeypatch.setattr(sys, 'argv', [
+        'average_model.py', '--dst_model', dst_model, '--src_path',
+        str(tmp_path), '--num', '4', '--ema_decay',
+        str(ema_decay)
+    ])
+    average_model.main()
+    avg = torch.load(dst_model)
+    assert avg.keys() == states_list[0].keys()
+    for k, v in states_list[0].items():
+        if not v.is_floating_point():
+            expected = torch.true_divide(
+                sum(states[k] for states in states_list), 4)
+            assert torch.equal(avg[k], expected)
+            continue
+        assert avg[k].dtype == v.dtype
+        if ema_decay > 0.0:
+            # in epoch order
+            expected = states_list[0][k].double()
+            for states in states_list[1:]:
+                expected = expected * ema_decay + states[k].double() * (
+                    1.0 - ema_decay)
+            assert torch.equal(avg[k], expected.to(v.dtype))
+            continue
+        # the float64 average rounded once, and the plain float32 average
+        # up to its rounding
+        expected = sum(states[k].double() for states in states_list) / 4
+        assert torch.equal(avg[k], expected.to(v.dtype))
+        expected = torch.stack([states[k].float()
+                                for states in states_list]).mean(dim=0)
+        assert torch.allclose(avg[k].float(),
+                              expected,
+                              rtol=1e-3 if v.dtype == torch.half else 1e-5)
+
+def test_save_ema_checkpoint(tmp_path):
+    torch.manual_seed(777)
+    model = torch.nn.Sequential(torch.nn.Linear(8, 4),
+                                torch.nn.BatchNorm1d(4))
+    path = str(tmp_path / 'ema.pt')
+    decay = 0.9
+    expected = {k: v.clone() for k, v in model.state_dict().items()}
+    save_ema_checkpoint(model, path, decay)
+    for _ in range(3):
+        with torch.no_grad():
+            for p in model.parameters():
+                p.add_(torch.randn_like(p))
+        model(torch.randn(5, 8))  # update the batch norm statistics
+        for k, v in model.state_dict().items():
+            if v.is_floating_point():
+                expected[k] = expected[k] * decay + v * (1.0 - decay)
+            else:
+                expected[k] = v.clone()
+        save_ema_checkpoint(model, path, decay)
+    assert not os.path.exists(path + '.tmp')
+    ema = torch.load(path)
+    assert ema.keys() == expected.keys()
+    for k, v in expected.items():
+        assert ema[k].dtype == v.dtype
+        assert torch.allclose(ema[k], v, atol=1e-6)
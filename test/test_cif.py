@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import pytest
+import torch
+
+from wenet.cif.predictor import cif
+
+
+def cif_loop(hidden, alphas, threshold):
+    """ The frame-by-frame integrate-and-fire as the reference
+    """
+    batch_size, len_time, hidden_size = hidden.size()
+    integrate = torch.zeros([batch_size], dtype=torch.float64)
+    frame = torch.zeros([batch_size, hidden_size], dtype=torch.float64)
+    list_fires = []
+    list_frames = []
+    for t in range(len_time):
+        alpha = alphas[:, t]
+        distribution_completion = 1.0 - integrate
+        integrate = integrate + alpha
+        list_fires.append(integrate)
+        fire_place = integrate >= threshold
+        integrate = torch.where(fire_place, integrate - 1.0, integrate)
+        cur = torch.where(fire_place, distribution_completion, alpha)
+        remainds = alpha - cur
+        frame = frame + cur[:, None] * hidden[:, t, :]
+        list_frames.append(frame)
+        frame = torch.where(fire_place[:, None],
+                            remainds[:, None] * hidden[:, t, :], frame)
+    fires = torch.stack(list_fires, 1)
+    frames = torch.stack(list_frames, 1)
+    max_label_len = int(torch.round(alphas.sum(-1)).max())
+    list_ls = []
+    for b in range(batch_size):
+        ls = frames[b, fires[b] >= threshold][:max_label_len]
+        pad = torch.zeros([max_label_len - ls.size(0), hidden_size],
+                          dtype=ls.dtype)
+        list_ls.append(torch.cat([ls, pad], 0))
+    return torch.stack(list_ls, 0), fires
+
+
+@pytest.mark.parametrize("threshold", [1.0, 0.9])
+@pytest.mark.parametrize("scale", [0.5, 1.5])
+def test_cif(threshold, scale):
+    torch.manual_seed(777)
+    hidden = torch.randn(4, 50, 8, dtype=torch.float64)
+    # scale > 1 gives frames with alphas > 1, as the predictor does in
+    # training when it scales alphas to the target length
+    alphas = torch.rand(4, 50, dtype=torch.float64) * scale
+    alphas[2, 20:] = 0.0
+    frames, fires = cif(hidden, alphas, threshold)
+    ref_frames, ref_fires = cif_loop(hidden, alphas, threshold)
+    assert frames.size() == ref_frames.size()
+    assert torch.allclose(fires, ref_fires, atol=1e-9)
+    assert torch.allclose(frames, ref_frames, atol=1e-9)
+    if scale > 1.0:
+        assert (alphas > 1.0).any()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import itertools
+
+import pytest
+import torch
+
+from wenet.utils.ctc_util import (batch_forced_align, ctc_blank_skip,
+                                  ctc_prefix_beam_search, forced_align)
+
+
+@pytest.mark.parametrize("beam_size", [1, 3, 5])
+def test_ctc_prefix_beam_search_batch(beam_size):
+    torch.manual_seed(777)
+    ctc_probs = (torch.randn(4, 30, 6) * 3).log_softmax(-1)
+    ctc_lens = torch.tensor([30, 21, 7, 1])
+    hyps = ctc_prefix_beam_search(ctc_probs, ctc_lens, beam_size)
+    assert len(hyps) == 4
+    for i in range(4):
+        single = ctc_prefix_beam_search(ctc_probs[i:i + 1, :ctc_lens[i]],
+                                        ctc_lens[i:i + 1], beam_size)[0]
+        assert [h[0] for h in hyps[i]] == [h[0] for h in single]
+        assert [h[2] for h in hyps[i]] == [h[2] for h in single]
+        for h1, h2 in zip(hyps[i], single):
+            assert h1[1] == pytest.approx(h2[1], abs=1e-4)
+        scores = [h[1] for h in hyps[i]]
+        assert scores == sorted(scores, reverse=True)
+
+
+def test_ctc_prefix_beam_search_merge():
+    # frames: a, -, a  and  a, a, a
+    # prefix (a, a) only comes from a-a, prefix (a,) merges the other paths
+    probs = torch.tensor([[[0.1, 0.9], [0.6, 0.4], [0.1, 0.9]]])
+    hyps = ctc_prefix_beam_search(probs.log(), torch.tensor([3]), 3)[0]
+    prefixes = {h[0]: h[1] for h in hyps}
+    assert set(prefixes) == {(1, ), (1, 1), ()}
+    assert prefixes[(1, 1)] == pytest.approx(float(torch.tensor(
+        0.9 * 0.6 * 0.9).log()), abs=1e-5)
+    total = sum(torch.tensor(s).exp() for s in prefixes.values())
+    assert float(total) == pytest.approx(1.0, abs=1e-5)
+    times = {h[0]: h[2] for h in hyps}
+    assert times[(1, 1)] == (0, 2)
+
+
+def test_ctc_blank_skip():
+    # blank posterior of each frame, token 1 takes the rest
+    blank = torch.tensor([[0.1, 0.99, 0.99, 0.99, 0.1, 0.99],
+                          [0.99, 0.99, 0.1, 0.1, 0.99, 0.99]])
+    ctc_probs = torch.stack([blank, 1 - blank], dim=-1).log()
+    ctc_lens = torch.tensor([6, 5])
+    probs, lens, frame_index = ctc_blank_skip(ctc_probs, ctc_lens, 0.9)
+    assert lens.tolist() == [4, 4]
+    assert frame_index.tolist() == [[0, 1, 4, 5], [0, 2, 3, 4]]
+    assert torch.equal(probs[0], ctc_probs[0, [0, 1, 4, 5]])
+    hyps = ctc_prefix_beam_search(probs, lens, 2, frame_index=frame_index)
+    ref = ctc_prefix_beam_search(ctc_probs, ctc_lens, 2)
+    for i in range(2):
+        assert hyps[i][0][0] == ref[i][0][0]
+        assert hyps[i][0][2] == ref[i][0][2]
+
+
+def forced_align_loop(ctc_probs, y, blank_id=0):
+    """ The per state, per frame viterbi as the reference
+
+    Returns:
+        List[int]: aligned token of every frame
+        float: log probability of the best path
+    """
+    ext = [blank_id]
+    for token in y:
+        ext += [token, blank_id]
+    T, S = ctc_probs.size(0), len(ext)
+    neg_inf = -float('inf')
+    log_alpha = [[neg_inf] * S for _ in range(T)]
+    back = [[0] * S for _ in range(T)]
+    log_alpha[0][0] = float(ctc_probs[0][ext[0]])
+    if S > 1:
+        log_alpha[0][1] = float(ctc_probs[0][ext[1]])
+    for t in range(1, T):
+        for s in range(S):
+            prev_states = [s]
+            if s >= 1:
+                prev_states.append(s - 1)
+            if s >= 2 and ext[s] != blank_id and ext[s] != ext[s - 2]:
+                prev_states.append(s - 2)
+            best = max(prev_states, key=lambda x: log_alpha[t - 1][x])
+            log_alpha[t][s] = log_alpha[t - 1][best] + \
+                float(ctc_probs[t][ext[s]])
+            back[t][s] = best
+    final = [S - 1] if S == 1 else [S - 1, S - 2]
+    state = max(final, key=lambda x: log_alpha[T - 1][x])
+    score = log_alpha[T - 1][state]
+    path = [state]
+    for t in range(T - 1, 0, -1):
+        state = back[t][state]
+        path.append(state)
+    return [ext[s] for s in reversed(path)], score
+
+
+def brute_force_best_score(ctc_probs, y, blank_id=0):
+    """ Max log probability over all frame labelings collapsing to y
+    """
+    T, V = ctc_probs.size()
+    best = -float('inf')
+    for labels in itertools.product(range(V), repeat=T):
+        collapsed = [
+            x for i, x in enumerate(labels)
+            if x != blank_id and (i == 0 or labels[i - 1] != x)
+        ]
+        if collapsed == y:
+            best = max(best,
+                       sum(float(ctc_probs[t][x]) for t, x in
+                           enumerate(labels)))
+    return best
+
+
+def token_runs(alignment, blank_id=0):
+    """ [start, end) frames of every run of a non blank token
+    """
+    runs = []
+    for t, x in enumerate(alignment):
+        if x == blank_id:
+            continue
+        if t > 0 and alignment[t - 1] == x:
+            runs[-1][1] = t + 1
+        else:
+            runs.append([t, t + 1])
+    return [tuple(x) for x in runs]
+
+
+def test_batch_forced_align():
+    torch.manual_seed(777)
+    ctc_probs = (torch.randn(4, 40, 6) * 3).log_softmax(-1)
+    ctc_lens = torch.tensor([40, 33, 25, 12])
+    ys_lens = torch.tensor([6, 0, 4, 3])
+    ys = torch.randint(1, 6, (4, 6))
+    ys[0, 2] = ys[0, 1]  # repeated token
+    ys = ys.masked_fill(torch.arange(6) >= ys_lens.unsqueeze(1), -1)
+    alignments, segments, scores = batch_forced_align(
+        ctc_probs, ctc_lens, ys, ys_lens)
+    for i in range(4):
+        probs = ctc_probs[i, :ctc_lens[i]]
+        tokens = ys[i, :ys_lens[i]].tolist()
+        ref, ref_score = forced_align_loop(probs, tokens)
+        assert alignments[i] == ref
+        assert scores[i] == pytest.approx(ref_score, abs=1e-4)
+        # the score is the one of the returned path
+        path_score = sum(float(probs[t][x])
+                         for t, x in enumerate(alignments[i]))
+        assert scores[i] == pytest.approx(path_score, abs=1e-4)
+        assert segments[i] == token_runs(ref)
+        assert [alignments[i][s] for s, _ in segments[i]] == tokens
+        assert forced_align(probs, ys[i, :ys_lens[i]]) == ref
+
+
+def test_batch_forced_align_brute_force():
+    torch.manual_seed(777)
+    ctc_probs = (torch.randn(3, 6, 3) * 2).log_softmax(-1)
+    ctc_lens = torch.tensor([6, 5, 4])
+    ys = torch.tensor([[1, 1, 2], [2, 1, -1], [1, -1, -1]])
+    ys_lens = torch.tensor([3, 2, 1])
+    alignments, segments, scores = batch_forced_align(
+        ctc_probs, ctc_lens, ys, ys_lens)
+    for i in range(3):
+        probs = ctc_probs[i, :ctc_lens[i]]
+        tokens = ys[i, :ys_lens[i]].tolist()
+        best = brute_force_best_score(probs, tokens)
+        assert scores[i] == pytest.approx(best, abs=1e-4)
+        assert sum(float(probs[t][x])
+                   for t, x in enumerate(alignments[i])) == \
+            pytest.approx(best, abs=1e-4)
+        assert segments[i] == token_runs(alignments[i])
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import pytest
+import torch
+
+from wenet.transformer.decoder import BiTransformerDecoder, TransformerDecoder
+from wenet.utils.mask import make_pad_mask, subsequent_mask
+
+
+def make_decoder(decoder_type, normalize_before, src_attention):
+    torch.manual_seed(777)
+    if decoder_type == 'bitransformer':
+        decoder = BiTransformerDecoder(20,
+                                       32,
+                                       attention_heads=2,
+                                       linear_units=64,
+                                       num_blocks=2,
+                                       r_num_blocks=1,
+                                       normalize_before=normalize_before)
+    else:
+        decoder = TransformerDecoder(20,
+                                     32,
+                                     attention_heads=2,
+                                     linear_units=64,
+                                     num_blocks=2,
+                                     normalize_before=normalize_before,
+                                     src_attention=src_attention)
+    decoder.eval()
+    return decoder
+
+
+@pytest.mark.parametrize("decoder_type,src_attention",
+                         [('transformer', True), ('transformer', False),
+                          ('bitransformer', True)])
+@pytest.mark.parametrize("normalize_before", [True, False])
+def test_forward_step(decoder_type, src_attention, normalize_before):
+    decoder = make_decoder(decoder_type, normalize_before, src_attention)
+    batch_size, beam_size, max_steps = 3, 4, 9
+    running_size = batch_size * beam_size
+    memory = torch.randn(batch_size, 17, 32)
+    memory_mask = ~make_pad_mask(torch.tensor([17, 9, 1]), 17).unsqueeze(1)
+    # the memory of every beam for the full forward
+    beam_memory = memory.repeat_interleave(beam_size, dim=0)
+    beam_memory_mask = memory_mask.repeat_interleave(beam_size, dim=0)
+    hyps = torch.randint(0, 20, (running_size, max_steps))
+    with torch.no_grad():
+        self_cache, src_cache = decoder.init_step_cache(
+            memory, max_steps, beam_size)
+        for i in range(max_steps):
+            logp = decoder.forward_step(memory_mask, hyps[:, i:i + 1], i,
+                                        self_cache, src_cache)
+            tgt_mask = subsequent_mask(i + 1).unsqueeze(0)
+            expected, _ = decoder.forward_one_step(beam_memory,
+                                                   beam_memory_mask,
+                                                   hyps[:, :i + 1], tgt_mask)
+            assert torch.allclose(logp, expected, atol=1e-5)
+            # reorder the hyps within every utterance like beam search does,
+            # along with the first i + 1 steps of the self attention cache
+            index = torch.cat([
+                torch.randint(0, beam_size, (beam_size, )) + b * beam_size
+                for b in range(batch_size)
+            ])
+            hyps[:, :i + 1] = hyps[index, :i + 1]
+            for c in self_cache:
+                c[:, :, :i + 1] = c[index, :, :i + 1]
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import pytest
+import torch
+
+from wenet.transformer.asr_model import ASRModel
+from wenet.transformer.ctc import CTC
+from wenet.transformer.decoder import TransformerDecoder
+from wenet.transformer.embedding import (PositionalEncoding,
+                                         RelPositionalEncoding)
+from wenet.transformer.encoder import ConformerEncoder
+
+# float32 angles of the precomputed table lose precision with positions
+TABLE_ATOL = 1e-3
+
+
+@pytest.mark.parametrize("pos_enc_class",
+                         [PositionalEncoding, RelPositionalEncoding])
+def test_position_encoding_beyond_max_len(pos_enc_class):
+    pos_enc = pos_enc_class(16, 0.0, max_len=100)
+    table = pos_enc_class(16, 0.0, max_len=3000)
+    size = 20
+    # within the table, across max_len and beyond it
+    for offset in [0, 79, 80, 90, 100, 2900]:
+        expected = table.pe[:, offset:offset + size]
+        pos_emb = pos_enc.position_encoding(offset, size)
+        assert pos_emb.size() == (1, size, 16)
+        assert torch.allclose(pos_emb, expected, atol=TABLE_ATOL)
+        pos_emb = pos_enc.position_encoding(torch.tensor(offset), size)
+        assert torch.allclose(pos_emb, expected, atol=TABLE_ATOL)
+    # per stream offsets, negative positions are clamped to 0
+    offset = torch.tensor([-5, 0, 90, 2900])
+    pos_emb = pos_enc.position_encoding(offset, size)
+    assert pos_emb.size() == (4, size, 16)
+    for b, o in enumerate(offset.tolist()):
+        index = (torch.arange(size) + o).clamp(min=0)
+        assert torch.allclose(pos_emb[b], table.pe[0, index], atol=TABLE_ATOL)
+
+
+def make_model(max_len):
+    torch.manual_seed(777)
+    vocab_size = 10
+    encoder = ConformerEncoder(20,
+                               32,
+                               attention_heads=2,
+                               linear_units=64,
+                               num_blocks=2,
+                               use_dynamic_chunk=True,
+                               use_cnn_module=True,
+                               cnn_module_kernel=5,
+                               causal=True)
+    encoder.embed.pos_enc = RelPositionalEncoding(32, 0.0, max_len=max_len)
+    decoder = TransformerDecoder(vocab_size, 32, attention_heads=2,
+                                 linear_units=64, num_blocks=1)
+    ctc = CTC(vocab_size, 32)
+    model = ASRModel(vocab_size, encoder, decoder, ctc)
+    model.eval()
+    return model
+
+
+def test_forward_encoder_chunk_beyond_max_len():
+    chunk_size, required_cache_size = 4, 8
+    # 15 chunks of 4 encoder frames run across max_len 40
+    model = make_model(max_len=40)
+    script_model = torch.jit.script(model)
+    expected_model = make_model(max_len=5000)
+    subsampling = model.encoder.embed.subsampling_rate
+    context = model.encoder.embed.right_context + 1
+    stride = subsampling * chunk_size
+    decoding_window = (chunk_size - 1) * subsampling + context
+    feats = torch.randn(1, 15 * stride + 3, 20)
+    outputs = []
+    expected = []
+    offset = 0
+    att_cache = torch.zeros(0, 0, 0, 0)
+    cnn_cache = torch.zeros(0, 0, 0, 0)
+    expected_att_cache = torch.zeros(0, 0, 0, 0)
+    expected_cnn_cache = torch.zeros(0, 0, 0, 0)
+    with torch.no_grad():
+        for cur in range(0, feats.size(1) - context + 1, stride):
+            chunk = feats[:, cur:cur + decoding_window]
+            ys, att_cache, cnn_cache = script_model.forward_encoder_chunk(
+                chunk, offset, required_cache_size, att_cache, cnn_cache)
+            outputs.append(ys)
+            ys, expected_att_cache, expected_cnn_cache = \
+                expected_model.forward_encoder_chunk(
+                    chunk, offset, required_cache_size, expected_att_cache,
+                    expected_cnn_cache)
+            expected.append(ys)
+            offset += ys.size(1)
+    assert offset > 40
+    outputs = torch.cat(outputs, dim=1)
+    expected = torch.cat(expected, dim=1)
+    assert torch.allclose(outputs, expected, atol=1e-4)
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import pytest
+import torch
+
+from wenet.transformer.encoder import ConformerEncoder, TransformerEncoder
+
+ENCODER_TYPES = ['conformer', 'transformer']
+INPUT_LAYERS = ['conv2d', 'conv2d6', 'conv2d8']
+# (decoding_chunk_size, num_decoding_left_chunks)
+CHUNK_CONFS = [(1, 0), (1, 3), (4, 0), (4, 1), (4, 2), (5, 2)]
+
+
+def make_encoder(encoder_type, input_layer):
+    torch.manual_seed(777)
+    if encoder_type == 'conformer':
+        encoder = ConformerEncoder(20,
+                                   32,
+                                   attention_heads=2,
+                                   linear_units=64,
+                                   num_blocks=2,
+                                   input_layer=input_layer,
+                                   use_dynamic_chunk=True,
+                                   use_cnn_module=True,
+                                   cnn_module_kernel=5,
+                                   causal=True)
+    else:
+        encoder = TransformerEncoder(20,
+                                     32,
+                                     attention_heads=2,
+                                     linear_units=64,
+                                     num_blocks=2,
+                                     input_layer=input_layer,
+                                     use_dynamic_chunk=True)
+    encoder.eval()
+    return encoder
+
+
+@pytest.mark.parametrize("encoder_type", ENCODER_TYPES)
+@pytest.mark.parametrize("input_layer", INPUT_LAYERS)
+@pytest.mark.parametrize("chunk_conf", CHUNK_CONFS)
+def test_ring_cache(encoder_type, input_layer, chunk_conf):
+    encoder = make_encoder(encoder_type, input_layer)
+    decoding_chunk_size, num_left_chunks = chunk_conf
+    xs = torch.randn(1, 211, 20)
+    with torch.no_grad():
+        expected, _ = encoder.forward_chunk_by_chunk(xs, decoding_chunk_size,
+                                                     num_left_chunks)
+        ys, _ = encoder.forward_chunk_by_chunk(xs,
+                                               decoding_chunk_size,
+                                               num_left_chunks,
+                                               use_ring_cache=True)
+    assert ys.size() == expected.size()
+    assert torch.allclose(ys, expected, atol=1e-5)
+
+
+@pytest.mark.parametrize("encoder_type", ENCODER_TYPES)
+@pytest.mark.parametrize("input_layer", INPUT_LAYERS)
+@pytest.mark.parametrize("chunk_conf", CHUNK_CONFS + [(1, -1), (4, -1)])
+@pytest.mark.parametrize("use_ring_cache", [False, True])
+def test_subsampling_cache(encoder_type, input_layer, chunk_conf,
+                           use_ring_cache):
+    decoding_chunk_size, num_left_chunks = chunk_conf
+    if use_ring_cache and num_left_chunks < 0:
+        pytest.skip('ring cache requires num_decoding_left_chunks >= 0')
+    encoder = make_encoder(encoder_type, input_layer)
+    # odd lengths to end with a partial chunk
+    for num_frames in [211, 100, 37]:
+        xs = torch.randn(1, num_frames, 20)
+        with torch.no_grad():
+            expected, _ = encoder.forward_chunk_by_chunk(
+                xs, decoding_chunk_size, num_left_chunks)
+            ys, _ = encoder.forward_chunk_by_chunk(
+                xs,
+                decoding_chunk_size,
+                num_left_chunks,
+                use_ring_cache=use_ring_cache,
+                use_subsampling_cache=True)
+        assert ys.size() == expected.size()
+        assert torch.allclose(ys, expected, atol=1e-5)
+
+
+def stack_caches(caches, dim):
+    """ Stack caches of streams, zeros for the fresh ones (None)
+    """
+    like = next(c for c in caches if c is not None)
+    return torch.stack(
+        [torch.zeros_like(like) if c is None else c for c in caches], dim)
+
+
+@pytest.mark.parametrize("encoder_type", ENCODER_TYPES)
+@pytest.mark.parametrize("input_layer", INPUT_LAYERS)
+@pytest.mark.parametrize("chunk_conf",
+                         [c for c in CHUNK_CONFS if c[1] > 0])
+def test_forward_chunk_batch(encoder_type, input_layer, chunk_conf):
+    encoder = make_encoder(encoder_type, input_layer)
+    decoding_chunk_size, num_left_chunks = chunk_conf
+    required_cache_size = decoding_chunk_size * num_left_chunks
+    subsampling = encoder.embed.subsampling_rate
+    context = encoder.embed.right_context + 1
+    stride = subsampling * decoding_chunk_size
+    window = (decoding_chunk_size - 1) * subsampling + context
+    # streams of different lengths, the last two join the batch later
+    lengths = [211, 97, 150, 64]
+    start_steps = [0, 0, 2, 5]
+    streams = [torch.randn(1, n, 20) for n in lengths]
+    chunks = [[
+        xs[0, cur:cur + window]
+        for cur in range(0, xs.size(1) - context + 1, stride)
+    ] for xs in streams]
+    outputs = [[] for _ in streams]
+    offsets = [0 for _ in streams]
+    att_caches = [None for _ in streams]
+    cnn_caches = [None for _ in streams]
+    cache_masks = [None for _ in streams]
+    num_steps = max(s + len(c) for s, c in zip(start_steps, chunks))
+    with torch.no_grad():
+        for step in range(num_steps):
+            active = [
+                b for b in range(len(streams))
+                if 0 <= step - start_steps[b] < len(chunks[b])
+            ]
+            if len(active) == 0:
+                continue
+            xs = [chunks[b][step - start_steps[b]] for b in active]
+            xs_lens = torch.tensor([x.size(0) for x in xs])
+            xs = torch.nn.utils.rnn.pad_sequence(xs, batch_first=True)
+            offset = torch.tensor([offsets[b] for b in active])
+            if all(att_caches[b] is None for b in active):
+                caches = ()
+            else:
+                # no cnn cache for transformer
+                cnn_cache = torch.zeros(0, 0, 0, 0)
+                if any(cnn_caches[b] is not None for b in active):
+                    cnn_cache = stack_caches([cnn_caches[b] for b in active],
+                                             1)
+                caches = (stack_caches([att_caches[b] for b in active], 1),
+                          cnn_cache,
+                          stack_caches([cache_masks[b] for b in active], 0))
+            ys, masks, att_cache, cnn_cache, cache_mask = \
+                encoder.forward_chunk_batch(xs, xs_lens, offset,
+                                            required_cache_size, *caches)
+            for i, b in enumerate(active):
+                valid = int(masks[i].sum())
+                outputs[b].append(ys[i, :valid])
+                offsets[b] += valid
+                att_caches[b] = att_cache[:, i]
+                if cnn_cache.size(1) > 0:
+                    cnn_caches[b] = cnn_cache[:, i]
+                cache_masks[b] = cache_mask[i]
+        for b, xs in enumerate(streams):
+            expected, _ = encoder.forward_chunk_by_chunk(
+                xs, decoding_chunk_size, num_left_chunks)
+            ys = torch.cat(outputs[b], dim=0)
+            assert ys.size() == expected[0].size()
+            assert torch.allclose(ys, expected[0], atol=1e-5)
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import math
+from types import SimpleNamespace
+
+import pytest
+import torch
+import torchaudio
+import torchaudio.compliance.kaldi as kaldi
+
+from wenet.transformer.asr_model import ASRModel
+from wenet.transformer.ctc import CTC
+from wenet.transformer.decoder import TransformerDecoder
+from wenet.transformer.encoder import ConformerEncoder
+from wenet.utils.long_form import (FbankStream, StreamingCTCDecoder,
+                                   energy_vad, read_wav_blocks)
+
+
+def split(x, sizes):
+    """ Split x into blocks of the sizes in turn
+    """
+    blocks, i, j = [], 0, 0
+    while i < x.size(0):
+        blocks.append(x[i:i + sizes[j % len(sizes)]])
+        i += sizes[j % len(sizes)]
+        j += 1
+    return blocks
+
+
+@pytest.mark.parametrize("orig_freq,new_freq", [(44100, 16000),
+                                                (8000, 16000),
+                                                (48000, 16000),
+                                                (16000, 8000)])
+@pytest.mark.parametrize("block_seconds", [0.01, 0.7, 10.0])
+def test_read_wav_blocks(monkeypatch, orig_freq, new_freq, block_seconds):
+    torch.manual_seed(777)
+    wav = torch.randn(2, orig_freq * 3 + 123)
+
+    def info(wav_file):
+        return SimpleNamespace(sample_rate=orig_freq)
+
+    def load(wav_file, frame_offset=0, num_frames=-1):
+        return wav[:, frame_offset:frame_offset + num_frames], orig_freq
+
+    monkeypatch.setattr(torchaudio, 'info', info, raising=False)
+    monkeypatch.setattr(torchaudio, 'load', load)
+    sample_rate, blocks = read_wav_blocks('fake.wav', block_seconds,
+                                          new_freq)
+    assert sample_rate == new_freq
+    samples = torch.cat(list(blocks))
+    expected = torchaudio.functional.resample(wav.mean(dim=0), orig_freq,
+                                              new_freq)
+    assert samples.size() == expected.size()
+    assert torch.allclose(samples, expected, atol=1e-5)
+
+
+@pytest.mark.parametrize("sample_rate", [8000, 16000])
+def test_fbank_stream(sample_rate):
+    torch.manual_seed(777)
+    samples = torch.rand(3 * sample_rate + 77) * 2.0 - 1.0
+    fbank = FbankStream(sample_rate, num_mel_bins=40)
+    feats = torch.cat(
+        [fbank.accept(x) for x in split(samples, [100, 7, 1234, 4000])])
+    expected = kaldi.fbank(samples.unsqueeze(0) * (1 << 15),
+                           num_mel_bins=40,
+                           frame_length=25,
+                           frame_shift=10,
+                           dither=0.0,
+                           energy_floor=0.0,
+                           sample_frequency=sample_rate)
+    assert feats.size() == expected.size()
+    assert torch.allclose(feats, expected, atol=1e-4)
+
+
+def test_energy_vad():
+    torch.manual_seed(777)
+    sample_rate, frame, pad = 16000, 480, 3200
+    samples = torch.zeros(4 * sample_rate)
+    # two speech regions, 1.0s-2.0s and 3.0s-3.3s
+    speech = [(16000, 32000), (48000, 52800)]
+    for start, end in speech:
+        samples[start:end] = torch.randn(end - start) * 0.1
+    segments = list(
+        energy_vad(iter(split(samples, [7000, 333])), sample_rate))
+    assert len(segments) == len(speech)
+    last_end = 0
+    for (start, end), (seg_start, seg_samples) in zip(speech, segments):
+        # the frames with speech, padded by `pad` but not overlapped
+        expected_start = max(start // frame * frame - pad, last_end)
+        expected_end = math.ceil(end / frame) * frame + pad
+        assert seg_start == expected_start
+        assert seg_samples.size(0) == expected_end - expected_start
+        assert torch.equal(seg_samples, samples[expected_start:expected_end])
+        last_end = expected_end
+
+
+def test_energy_vad_max_segment():
+    torch.manual_seed(777)
+    sample_rate, frame = 16000, 480
+    samples = torch.randn(5 * sample_rate + 100) * 0.1
+    segments = list(
+        energy_vad(iter(split(samples, [7000, 333])),
+                   sample_rate,
+                   max_segment=2.0))
+    assert len(segments) == 3
+    pos = 0
+    for seg_start, seg_samples in segments:
+        # contiguous segments of max_segment seconds at most, rounded up to
+        # a frame
+        assert seg_start == pos
+        assert seg_samples.size(0) <= 2 * sample_rate + frame
+        assert torch.equal(seg_samples,
+                           samples[seg_start:seg_start + seg_samples.size(0)])
+        pos += seg_samples.size(0)
+    # the last segment is padded to the end of the samples
+    assert pos == samples.size(0)
+
+
+def make_model():
+    torch.manual_seed(777)
+    vocab_size = 10
+    encoder = ConformerEncoder(20,
+                               32,
+                               attention_heads=2,
+                               linear_units=64,
+                               num_blocks=2,
+                               use_dynamic_chunk=True,
+                               use_cnn_module=True,
+                               cnn_module_kernel=5,
+                               causal=True)
+    decoder = TransformerDecoder(vocab_size, 32, attention_heads=2,
+                                 linear_units=64, num_blocks=1)
+    ctc = CTC(vocab_size, 32)
+    model = ASRModel(vocab_size, encoder, decoder, ctc)
+    # sharpen ctc to emit tokens on random inputs
+    with torch.no_grad():
+        ctc.ctc_lo.weight.mul_(5.0)
+    model.eval()
+    return model
+
+
+@pytest.mark.parametrize("chunk_size,num_left_chunks", [(4, -1), (4, 2),
+                                                        (1, 3)])
+def test_streaming_ctc_decoder(chunk_size, num_left_chunks):
+    model = make_model()
+    feats = torch.randn(313, 20)
+    decoder = StreamingCTCDecoder(model, chunk_size, num_left_chunks)
+    decoder.reset(1.5)
+    segments = []
+    with torch.no_grad():
+        for x in split(feats, [50, 3, 17]):
+            segments += decoder.accept(x)
+        segments += decoder.finalize()
+        encoder_out, _ = model.encoder.forward_chunk_by_chunk(
+            feats.unsqueeze(0), chunk_size, num_left_chunks)
+        best = model.ctc_activation(encoder_out).argmax(dim=-1)[0].tolist()
+    tokens, times, prev = [], [], 0
+    for i, token in enumerate(best):
+        if token != 0 and token != prev:
+            tokens.append(token)
+            times.append(1.5 + i * 0.04)
+        prev = token
+    assert len(tokens) > 0
+    assert len(segments) == 1
+    assert segments[0]['tokens'] == tokens
+    assert segments[0]['times'] == pytest.approx(times)
+    assert segments[0]['start'] == pytest.approx(times[0])
+    assert segments[0]['end'] == pytest.approx(times[-1] + 0.04)
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import pytest
+import torch
+
+from wenet.paraformer.search.beam_search import (BatchBeamSearchCIF,
+                                                 BeamSearchCIF)
+from wenet.paraformer.search.ctc import CTCPrefixScorer
+from wenet.transformer.ctc import CTC
+
+
+@pytest.mark.parametrize("ctc_weight", [0.3, 0.5])
+def test_batch_beam_search_cif(ctc_weight):
+    torch.manual_seed(777)
+    vocab_size, encoder_size, beam_size = 20, 8, 4
+    sos = eos = vocab_size - 1
+    ctc = CTC(vocab_size, encoder_size)
+    ctc.eval()
+    kwargs = dict(scorers=dict(ctc=CTCPrefixScorer(ctc=ctc, eos=eos)),
+                  weights=dict(decoder=1.0 - ctc_weight,
+                               ctc=ctc_weight,
+                               length_bonus=0.0),
+                  beam_size=beam_size,
+                  vocab_size=vocab_size,
+                  sos=sos,
+                  eos=eos,
+                  pre_beam_score_key="full")
+    beam_search = BeamSearchCIF(**kwargs)
+    batch_beam_search = BatchBeamSearchCIF(**kwargs)
+    for _ in range(30):
+        batch_size = 4
+        # utterances of different lengths, the numpy CTC prefix score of
+        # BeamSearchCIF needs more frames than tokens
+        x_lens = torch.randint(8, 30, (batch_size, ))
+        am_lens = torch.randint(1, 8, (batch_size, ))
+        x = torch.randn(batch_size, int(x_lens.max()), encoder_size)
+        am_scores = torch.randn(batch_size, int(am_lens.max()),
+                                vocab_size).log_softmax(dim=-1)
+        with torch.no_grad():
+            batch_nbest = batch_beam_search(x=x,
+                                            x_lens=x_lens,
+                                            am_scores=am_scores,
+                                            am_lens=am_lens)
+            for b in range(batch_size):
+                nbest = beam_search(x=x[b, :x_lens[b]],
+                                    am_scores=am_scores[b, :am_lens[b]])
+                assert len(batch_nbest[b]) > 0
+                assert batch_nbest[b][0].yseq.tolist() == \
+                    nbest[0].yseq.tolist()
+                assert torch.allclose(batch_nbest[b][0].score,
+                                      nbest[0].score,
+                                      atol=1e-4)
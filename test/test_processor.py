@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import functools
+import io
+import json
+import os
+import tarfile
+import threading
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+
+import numpy as np
+import pytest
+import torch
+
+import wenet.dataset.processor as processor
+from wenet.dataset.dataset import DataList
+from wenet.dataset.processor import prefetch_url_opener
+
+
+@pytest.fixture
+def http_dir(tmp_path):
+    """ Serve tmp_path/www by http, the first request of every file fails
+    """
+    www = tmp_path / 'www'
+    www.mkdir()
+    failed = set()
+
+    class Handler(SimpleHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in failed:
+                failed.add(self.path)
+                self.send_error(503)
+                return
+            super().do_GET()
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0),
+                        functools.partial(Handler, directory=str(www)))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield www, 'http://127.0.0.1:{}'.format(server.server_port)
+    server.shutdown()
+
+
+def test_prefetch_url_opener(http_dir, tmp_path):
+    www, url = http_dir
+    srcs = []
+    for i in range(6):
+        (www / '{}.tar'.format(i)).write_bytes(bytes([i]) * (i + 1) * 100)
+        srcs.append('{}/{}.tar'.format(url, i))
+    srcs.insert(2, '{}/missing.tar'.format(url))
+    local = tmp_path / 'local.tar'
+    local.write_bytes(b'local')
+    srcs.append(str(local))
+    cache_dir = tmp_path / 'cache'
+    # 1000 bytes cache only keeps the most recent shards
+    samples = prefetch_url_opener([dict(src=x) for x in srcs],
+                                  num_prefetch=3,
+                                  max_retries=1,
+                                  backoff=0.01,
+                                  cache_dir=str(cache_dir),
+                                  cache_size=1000 / 1024**3)
+    contents = []
+    for sample in samples:
+        contents.append(sample['stream'].read())
+        sample['stream'].close()
+    assert contents == [bytes([i]) * (i + 1) * 100
+                        for i in range(6)] + [b'local']
+    cached = os.listdir(cache_dir)
+    assert sum(os.path.getsize(cache_dir / x) for x in cached) <= 1000
+    assert any(x.endswith('_5.tar') for x in cached)
+
+
+def test_feat_cache(tmp_path, monkeypatch):
+    num_loads = [0]
+
+    def load(path):
+        num_loads[0] += 1
+        return torch.from_numpy(np.fromfile(path, dtype=np.float32)) \
+            .unsqueeze(0), 16000
+
+    monkeypatch.setattr(processor.torchaudio, 'load', load)
+    cache_dir = processor.feat_cache_dir(str(tmp_path / 'cache'), {})
+    rng = np.random.RandomState(777)
+    lists = {}
+    # two corpora with the same utterance key
+    for corpus in ['a', 'b']:
+        wav = tmp_path / '{}.raw'.format(corpus)
+        rng.uniform(-1, 1, 16000).astype(np.float32).tofile(wav)
+        lists[corpus] = [
+            dict(src=json.dumps(dict(key='utt1', wav=str(wav), txt='x')))
+        ]
+
+    def extract(corpus):
+        data = processor.parse_raw(lists[corpus], cache_dir)
+        data = ({**x, 'label': [1]} for x in data)
+        data = processor.filter(data)
+        data = processor.resample(data)
+        data = processor.compute_fbank(data)
+        data = processor.save_feat_cache(data)
+        return [x['feat'].clone() for x in data]
+
+    feats_a = extract('a')
+    feats_b = extract('b')
+    assert num_loads[0] == 2
+    assert not torch.equal(feats_a[0], feats_b[0])
+    # the audio is not decoded for cached features
+    assert torch.equal(extract('a')[0], feats_a[0])
+    assert torch.equal(extract('b')[0], feats_b[0])
+    assert num_loads[0] == 2
+
+
+def fake_load(f):
+    """ torchaudio.load of raw float32 samples
+    """
+    if not hasattr(f, 'read'):
+        f = open(f, 'rb')
+    return torch.from_numpy(np.frombuffer(f.read(), dtype=np.float32)
+                            .copy()).unsqueeze(0), 16000
+
+
+@pytest.fixture
+def indexed_tar(tmp_path):
+    """ A tar file and its index `tar_file.idx`, as written by
+        tools/make_shard_list.py
+    """
+    tar_file = str(tmp_path / 'shard.tar')
+    rng = np.random.RandomState(777)
+    with tarfile.open(tar_file, 'w') as tar:
+        for i in range(6):
+            members = [('txt', 'text {}'.format(i).encode('utf8')),
+                       ('wav', rng.rand(100 + i).astype(np.float32)
+                        .tobytes())]
+            for postfix, content in members:
+                tarinfo = tarfile.TarInfo('utt{}.{}'.format(i, postfix))
+                tarinfo.size = len(content)
+                tar.addfile(tarinfo, io.BytesIO(content))
+    with tarfile.open(tar_file, 'r:') as tar, \
+            open(tar_file + '.idx', 'w', encoding='utf8') as fout:
+        for tarinfo in tar:
+            fout.write('{} {} {}\n'.format(tarinfo.name, tarinfo.offset_data,
+                                           tarinfo.size))
+    return tar_file
+
+
+def test_read_tar_index(indexed_tar):
+    utts = processor.read_tar_index(indexed_tar + '.idx')
+    assert [x[0] for x in utts] == ['utt{}'.format(i) for i in range(6)]
+    with open(indexed_tar, 'rb') as fin:
+        for key, members in utts:
+            assert [x[0] for x in members] == ['txt', 'wav']
+            fin.seek(members[0][1])
+            assert fin.read(members[0][2]) == \
+                'text {}'.format(key[3:]).encode('utf8')
+
+
+def test_indexed_tar_file_and_group(indexed_tar, monkeypatch):
+    monkeypatch.setattr(processor.torchaudio, 'load', fake_load)
+    expected = list(processor.tar_file_and_group(
+        processor.url_opener([dict(src=indexed_tar)])))
+    assert len(expected) == 6
+    utts = list(processor.indexed_tar_file_and_group([dict(src=indexed_tar)]))
+    assert [x['key'] for x in utts] == [x['key'] for x in expected]
+    for x, y in zip(utts, expected):
+        assert x['txt'] == y['txt']
+        assert torch.equal(x['wav'], y['wav'])
+    # deterministic shuffle given the epoch, resumed by skip
+    shuffled = [
+        x['key'] for x in processor.indexed_tar_file_and_group(
+            [dict(src=indexed_tar, epoch=3)], shuffle=True)
+    ]
+    assert sorted(shuffled) == sorted(x['key'] for x in expected)
+    resumed = [
+        x['key'] for x in processor.indexed_tar_file_and_group(
+            [dict(src=indexed_tar, epoch=3, skip=4)], shuffle=True)
+    ]
+    assert resumed == shuffled[4:]
+
+
+def test_data_list_resume():
+    lists = ['shard{}.tar'.format(i) for i in range(10)]
+    data_list = DataList(lists, shuffle=True, subset_ratio=0.5)
+    data_list.set_epoch(3)
+    epoch = [x['src'] for x in data_list]
+    assert len(epoch) == 5
+    data_list.set_epoch(4)
+    assert [x['src'] for x in data_list] != epoch
+    data_list.set_epoch(3)
+    data_list.set_start(2, 7)
+    resumed = list(data_list)
+    assert [x['src'] for x in resumed] == epoch[2:]
+    assert [x.get('skip', 0) for x in resumed] == [7, 0, 0]
+
+
+def test_data_list_subset_no_partition():
+    lists = ['shard{}.tar'.format(i) for i in range(10)]
+    # CV and test data lists are not partitioned, and always used in full
+    data_list = DataList(lists, shuffle=False, partition=False,
+                         subset_ratio=0.5)
+    data_list.set_epoch(3)
+    assert [x['src'] for x in data_list] == lists
+
+
+@pytest.mark.parametrize("durations", [False, True])
+def test_bucket_batch(tmp_path, durations):
+    torch.manual_seed(777)
+    lengths = torch.randint(10, 700, (500, )).tolist()
+    samples = [
+        dict(key=str(i), label=[1], feat=torch.zeros(n, 4))
+        for i, n in enumerate(lengths)
+    ]
+    if durations:
+        # equally populated buckets from the durations of 10ms frames
+        durations_file = str(tmp_path / 'durations')
+        with open(durations_file, 'w', encoding='utf8') as fout:
+            for i, n in enumerate(lengths):
+                fout.write('{} {}\n'.format(i, n / 100))
+        conf = dict(durations_file=durations_file, num_buckets=5)
+        boundaries = processor.__bucket_boundaries(durations_file, 5, 10)
+        assert len(boundaries) == 4
+    else:
+        boundaries = [50, 100, 200, 400]
+        conf = dict(bucket_boundaries=boundaries)
+    batches = list(
+        processor.batch(samples,
+                        batch_type='bucket',
+                        max_frames_in_batch=1500,
+                        **conf))
+    keys = [x['key'] for b in batches for x in b]
+    assert sorted(keys) == sorted(x['key'] for x in samples)
+    for b in batches:
+        frames = [x['feat'].size(0) for x in b]
+        # within the frame budget, unless a single utterance exceeds it
+        assert max(frames) * len(b) <= 1500 or len(b) == 1
+        # all the utterances of a batch are in the same bucket
+        buckets = set(
+            sum(n > boundary for boundary in boundaries) for n in frames)
+        assert len(buckets) == 1
+
+
+def test_batch_unknown_conf():
+    samples = [dict(key='0', label=[1], feat=torch.zeros(10, 4))]
+    with pytest.raises(ValueError):
+        processor.batch(samples, batch_type='static', bucket_boundaries=[1])
+    with pytest.raises(ValueError):
+        processor.batch(samples, batch_type='dynamic', max_frame_in_batch=1)
+    with pytest.raises(TypeError):
+        processor.batch(samples, batch_type='bucket', num_bucket=1)
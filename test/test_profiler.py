@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+
+import pytest
+from torch.utils.data import DataLoader
+
+from wenet.dataset.dataset import DataList, Processor
+from wenet.dataset.profiler import StageProfiler, merge_stats, profile
+
+
+def parse(data):
+    for sample in data:
+        yield dict(key=sample['src'])
+
+
+def batch(data, batch_size=2):
+    keys = []
+    for sample in data:
+        keys.append(sample['key'])
+        if len(keys) == batch_size:
+            yield (keys, )
+            keys = []
+    if len(keys) > 0:
+        yield (keys, )
+
+
+def make_dataset(num_utts):
+    lists = ['utt{:03d}'.format(i) for i in range(num_utts)]
+    dataset = DataList(lists, shuffle=False)
+    dataset = Processor(dataset, parse)
+    dataset = Processor(dataset, batch)
+    return dataset
+
+
+def test_dump_interval():
+    with pytest.raises(ValueError):
+        StageProfiler(dump_interval=0)
+
+
+@pytest.mark.parametrize('dump_interval', [1, 3, 100])
+def test_profile(tmp_path, dump_interval):
+    profile_dir = str(tmp_path / 'profile')
+    dataset = make_dataset(11)
+    profiler = profile(dataset, profile_dir, dump_interval)
+    batches = list(dataset)
+    assert len(batches) == 6
+    stats = profiler.stats()
+    assert [x['name'] for x in stats['stages']] == ['parse', 'batch']
+    assert [x['count'] for x in stats['stages']] == [11, 6]
+    for x in stats['stages']:
+        assert x['time'] >= 0.0
+        assert x['total_time'] >= x['time']
+
+    # one record per batch and one for the end of the epoch
+    with open(tmp_path / 'profile' / 'rank0_worker0.jsonl') as fin:
+        assert len(fin.readlines()) == 7
+    merged = merge_stats(profile_dir)
+    assert merged['num_workers'] == 1
+    assert [x['count'] for x in merged['stages']] == [11, 6]
+    consumed = set(x[0][0] for x in batches)
+    assert merge_stats(profile_dir, consumed) == merged
+    merged = merge_stats(profile_dir, consumed - {batches[-1][0][0]})
+    assert [x['count'] for x in merged['stages']] == [10, 5]
+    assert merge_stats(profile_dir, set()) is None
+
+    # stats of the previous runs are removed
+    profile(make_dataset(4), profile_dir)
+    assert merge_stats(profile_dir) is None
+
+
+@pytest.mark.parametrize('num_batches', [0, 3, -1])
+def test_profile_consumed(tmp_path, num_batches):
+    profile_dir = str(tmp_path / 'profile')
+    dataset = make_dataset(40)
+    dataset.set_epoch(0)
+    profile(dataset, profile_dir, dump_interval=1)
+    data_loader = DataLoader(dataset,
+                             batch_size=None,
+                             num_workers=2,
+                             prefetch_factor=4)
+    consumed = set()
+    it = iter(data_loader)
+    for keys, in it:
+        if len(consumed) == num_batches:
+            break
+        consumed.add(keys[0])
+    # let the workers prefetch
+    time.sleep(0.5)
+    del it
+
+    produced = merge_stats(profile_dir)
+    assert produced['num_workers'] == 2
+    merged = merge_stats(profile_dir, consumed)
+    if num_batches == 0:
+        assert merged is None
+    elif num_batches > 0:
+        assert [x['count'] for x in merged['stages']] == [6, 3]
+        assert produced['stages'][-1]['count'] > 3
+    else:
+        assert [x['count'] for x in merged['stages']] == [40, 20]
+        assert merged == produced
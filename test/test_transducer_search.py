@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import pytest
+import torch
+
+from wenet.transformer.ctc import CTC
+from wenet.transducer.joint import TransducerJoint
+from wenet.transducer.predictor import EmbeddingPredictor, RNNPredictor
+from wenet.transducer.search.greedy_search import (basic_greedy_search,
+                                                   batch_greedy_search)
+from wenet.transducer.search.predictor_cache import PredictorCache
+from wenet.transducer.search.prefix_beam_search import PrefixBeamSearch
+from wenet.utils.common import log_add
+
+
+class TinyTransducer(torch.nn.Module):
+
+    def __init__(self, predictor_type: str):
+        super().__init__()
+        self.blank = 0
+        voca_size, encoder_size = 10, 8
+        if predictor_type == 'rnn':
+            self.predictor = RNNPredictor(voca_size, 8, 8, 0.1, 8, 1,
+                                          dropout=0.0)
+        else:
+            self.predictor = EmbeddingPredictor(voca_size, 8, 0.1, 2)
+        self.joint = TransducerJoint(voca_size, encoder_size, 8, 16)
+        self.ctc = CTC(voca_size, encoder_size)
+
+
+class IdentityEncoder(torch.nn.Module):
+    """ Takes the encoder output as the input of the search
+    """
+
+    def forward(self, xs, xs_lens, decoding_chunk_size=-1,
+                num_decoding_left_chunks=-1):
+        return xs, torch.ones(xs.size(0), 1, xs.size(1), dtype=torch.bool)
+
+
+def sharpen(model: TinyTransducer):
+    # large joint weights to emit many non-blank tokens with shared
+    # prefixes, so that the cache gets hits
+    with torch.no_grad():
+        for p in model.joint.parameters():
+            p.mul_(4.0)
+
+
+@pytest.mark.parametrize("predictor_type", ['rnn', 'embedding'])
+def test_batch_greedy_search_predictor_cache(predictor_type):
+    torch.manual_seed(777)
+    model = TinyTransducer(predictor_type)
+    sharpen(model)
+    model.eval()
+    encoder_out = torch.randn(4, 30, 8)
+    # the same utterance twice to share prefixes
+    encoder_out[1] = encoder_out[0]
+    encoder_out_lens = torch.tensor([30, 30, 17, 5])
+    predictor_cache = PredictorCache()
+    with torch.no_grad():
+        hyps, _ = batch_greedy_search(model, encoder_out, encoder_out_lens,
+                                      max_symbols_per_frame=3)
+        cached_hyps, _ = batch_greedy_search(model,
+                                             encoder_out,
+                                             encoder_out_lens,
+                                             max_symbols_per_frame=3,
+                                             predictor_cache=predictor_cache)
+        assert cached_hyps == hyps
+        assert max(len(h) for h in hyps) > 0
+        assert predictor_cache.hits > 0
+        # all the steps of the second call hit
+        misses = predictor_cache.misses
+        cached_hyps, _ = batch_greedy_search(model,
+                                             encoder_out,
+                                             encoder_out_lens,
+                                             max_symbols_per_frame=3,
+                                             predictor_cache=predictor_cache)
+        assert cached_hyps == hyps
+        assert predictor_cache.misses == misses
+
+        # new weights invalidate the cached steps
+        torch.manual_seed(778)
+        other = TinyTransducer(predictor_type)
+        sharpen(other)
+        model.load_state_dict(other.state_dict())
+        hyps, _ = batch_greedy_search(model, encoder_out, encoder_out_lens,
+                                      max_symbols_per_frame=3)
+        cached_hyps, _ = batch_greedy_search(model,
+                                             encoder_out,
+                                             encoder_out_lens,
+                                             max_symbols_per_frame=3,
+                                             predictor_cache=predictor_cache)
+        assert cached_hyps == hyps
+        assert predictor_cache.misses > misses
+
+
+@pytest.mark.parametrize("predictor_type", ['rnn', 'embedding'])
+@pytest.mark.parametrize("n_steps", [1, 3, 64])
+def test_batch_greedy_search(predictor_type, n_steps):
+    torch.manual_seed(777)
+    model = TinyTransducer(predictor_type)
+    sharpen(model)
+    model.eval()
+    encoder_out = torch.randn(4, 30, 8)
+    encoder_out_lens = torch.tensor([30, 1, 17, 5])
+    with torch.no_grad():
+        expected = []
+        for i in range(encoder_out.size(0)):
+            expected += basic_greedy_search(
+                model,
+                encoder_out[i:i + 1, :encoder_out_lens[i]],
+                encoder_out_lens[i],
+                n_steps=n_steps)
+        hyps, _ = batch_greedy_search(model,
+                                      encoder_out,
+                                      encoder_out_lens,
+                                      max_symbols_per_frame=n_steps)
+        assert hyps == expected
+        assert max(len(h) for h in hyps) > encoder_out.size(1) // 2
+        # chunk by chunk with the state of the previous chunk
+        state = None
+        for offset in range(0, encoder_out.size(1), 7):
+            hyps, state = batch_greedy_search(
+                model,
+                encoder_out[:, offset:offset + 7],
+                (encoder_out_lens - offset).clamp(0, 7),
+                max_symbols_per_frame=n_steps,
+                state=state)
+        assert hyps == expected
+
+
+def test_predictor_cache_train_mode():
+    torch.manual_seed(777)
+    model = TinyTransducer('rnn')
+    model.train()
+    predictor_cache = PredictorCache()
+    encoder_out = torch.randn(2, 10, 8)
+    encoder_out_lens = torch.tensor([10, 10])
+    batch_greedy_search(model,
+                        encoder_out,
+                        encoder_out_lens,
+                        predictor_cache=predictor_cache)
+    assert len(predictor_cache.entries) == 0
+    assert predictor_cache.hits + predictor_cache.misses == 0
+
+
+def prefix_beam_search_loop(model, encoder_out, beam_size, ctc_weight,
+                            transducer_weight):
+    """ The hyp by hyp prefix beam search as the reference, also returns
+        the number of merged prefixes
+    """
+    ctc_probs = model.ctc.log_softmax(encoder_out).squeeze(0)
+    padding = torch.zeros(1, 1)
+    # (hyp, score, predictor output after hyp, predictor state)
+    cache = model.predictor.init_state(1, method="zero", device='cpu')
+    pred_out, cache = model.predictor.forward_step(
+        torch.tensor([[model.blank]]), padding, cache)
+    beam = [([model.blank], 0.0, pred_out,
+             model.predictor.batch_to_cache(cache)[0])]
+    num_merged = 0
+    for i in range(encoder_out.size(1)):
+        candidates = []
+        for hyp, score, pred_out, cache in beam:
+            logp = model.joint(encoder_out[:, i:i + 1],
+                               pred_out).log_softmax(dim=-1).view(-1)
+            logp = torch.log(transducer_weight * torch.exp(logp) +
+                             ctc_weight * torch.exp(ctc_probs[i]))
+            top_k_logp, top_k_index = logp.topk(beam_size)
+            for p, token in zip(top_k_logp.tolist(), top_k_index.tolist()):
+                if token == model.blank:
+                    candidates.append((hyp, score + p, pred_out, cache))
+                else:
+                    out, new_cache = model.predictor.forward_step(
+                        torch.tensor([[token]]), padding,
+                        model.predictor.cache_to_batch([cache]))
+                    candidates.append(
+                        (hyp + [token], score + p, out,
+                         model.predictor.batch_to_cache(new_cache)[0]))
+        merged = []
+        for c in candidates:
+            for j, m in enumerate(merged):
+                if m[0] == c[0]:
+                    merged[j] = (m[0], log_add([m[1], c[1]]), m[2], m[3])
+                    num_merged += 1
+                    break
+            else:
+                merged.append(c)
+        merged.sort(key=lambda x: x[1], reverse=True)
+        beam = merged[:beam_size]
+    return [(hyp, score) for hyp, score, _, _ in beam], num_merged
+
+
+@pytest.mark.parametrize("predictor_type", ['rnn', 'embedding'])
+@pytest.mark.parametrize("beam_size", [1, 4, 10])
+@pytest.mark.parametrize("ctc_weight", [0.3, 0.0])
+def test_prefix_beam_search(predictor_type, beam_size, ctc_weight):
+    torch.manual_seed(777)
+    model = TinyTransducer(predictor_type)
+    model.eval()
+    searcher = PrefixBeamSearch(IdentityEncoder(), model.predictor,
+                                model.joint, model.ctc, model.blank)
+    total_merged = 0
+    for num_frames in [1, 5, 20]:
+        encoder_out = torch.randn(1, num_frames, 8)
+        with torch.no_grad():
+            expected, num_merged = prefix_beam_search_loop(
+                model, encoder_out, beam_size, ctc_weight, 1.0 - ctc_weight)
+            beam, _ = searcher.prefix_beam_search(
+                encoder_out,
+                torch.tensor([num_frames]),
+                beam_size=beam_size,
+                ctc_weight=ctc_weight,
+                transducer_weight=1.0 - ctc_weight)
+        total_merged += num_merged
+        assert [s.hyp for s in beam] == [h for h, _ in expected]
+        assert torch.allclose(torch.tensor([s.score for s in beam]),
+                              torch.tensor([s for _, s in expected]),
+                              atol=1e-4)
+    if beam_size > 1:
+        # the same prefix reached by different paths
+        assert total_merged > 0
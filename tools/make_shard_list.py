@@ -16,10 +16,13 @@
 
 import argparse
 import io
+import json
 import logging
 import os
+import sys
 import tarfile
 import time
+import traceback
 import multiprocessing
 
 import torch
@@ -29,17 +32,65 @@ import torchaudio.backend.sox_io_backend as sox
 AUDIO_FORMAT_SETS = set(['flac', 'mp3', 'm4a', 'ogg', 'opus', 'wav', 'wma'])
 
 
+def resample_audio(audio, sample_rate, resample):
+    if sample_rate == resample:
+        return audio
+    if not audio.is_floating_point():
+        # normalize the audio before resample
+        # because resample can't process int audio
+        audio = audio / (1 << 15)
+        audio = torchaudio.transforms.Resample(sample_rate, resample)(audio)
+        audio = (audio * (1 << 15)).short()
+    else:
+        audio = torchaudio.transforms.Resample(sample_rate, resample)(audio)
+    return audio
+
+
+def encode_audio(audio, sample_rate, audio_format):
+    """ Encode audio to bytes of wav/flac (16 bits) or ogg (vorbis)
+    """
+    f = io.BytesIO()
+    bits_per_sample = 16 if audio_format in ['wav', 'flac'] else None
+    sox.save(f,
+             audio,
+             sample_rate,
+             format=audio_format,
+             bits_per_sample=bits_per_sample)
+    f.seek(0)
+    return f.read()
+
+
 def write_tar_file(data_list,
                    no_segments,
                    tar_file,
                    resample=16000,
                    index=0,
-                   total=1):
+                   total=1,
+                   audio_format=None):
+    """ Write the utterances to `tar_file`, along with its index
+        `tar_file.idx` and manifest `tar_file.manifest`, which has the
+        duration and text length of every utterance in json lines. The
+        manifest is written at last, so a shard is complete if its manifest
+        exists. The duration is null when the source audio is copied as it
+        is and sox can not read it (e.g. m4a/wma).
+
+        Args:
+            audio_format: wav/flac/ogg payload, None to keep the source
+                audio as it is when no segments, and wav for segments
+
+        Returns:
+            dict: stats of the shard
+    """
     logging.info('Processing {} {}/{}'.format(tar_file, index, total))
+    if audio_format is None and not no_segments:
+        # Save to wav for segments file
+        audio_format = 'wav'
     read_time = 0.0
     save_time = 0.0
     write_time = 0.0
-    with tarfile.open(tar_file, "w") as tar:
+    manifest = []
+    num_bytes = 0
+    with tarfile.open(tar_file + '.tmp', "w") as tar:
         prev_wav = None
         for item in data_list:
             if no_segments:
@@ -49,10 +100,11 @@ def write_tar_file(data_list,
 
             suffix = wav.split('.')[-1]
             assert suffix in AUDIO_FORMAT_SETS
-            if no_segments:
+            if no_segments and audio_format in [None, suffix]:
                 ts = time.time()
                 with open(wav, 'rb') as fin:
                     data = fin.read()
+                duration = audio_duration(wav)
                 read_time += (time.time() - ts)
             else:
                 if wav != prev_wav:
@@ -60,33 +112,27 @@ def write_tar_file(data_list,
                     waveforms, sample_rate = sox.load(wav, normalize=False)
                     read_time += (time.time() - ts)
                     prev_wav = wav
-                start = int(start * sample_rate)
-                end = int(end * sample_rate)
-                audio = waveforms[:1, start:end]
-
-                # resample
-                if sample_rate != resample:
-                    if not audio.is_floating_point():
-                        # normalize the audio before resample
-                        # because resample can't process int audio
-                        audio = audio / (1 << 15)
-                        audio = torchaudio.transforms.Resample(
-                            sample_rate, resample)(audio)
-                        audio = (audio * (1 << 15)).short()
-                    else:
-                        audio = torchaudio.transforms.Resample(
-                            sample_rate, resample)(audio)
+                if no_segments:
+                    audio = waveforms[:1]
+                else:
+                    audio = waveforms[:1,
+                                      int(start * sample_rate):
+                                      int(end * sample_rate)]
+                audio = resample_audio(audio, sample_rate, resample)
+                duration = audio.size(1) / resample
 
                 ts = time.time()
-                f = io.BytesIO()
-                sox.save(f, audio, resample, format="wav", bits_per_sample=16)
-                # Save to wav for segments file
-                suffix = "wav"
-                f.seek(0)
-                data = f.read()
+                data = encode_audio(audio, resample, audio_format)
+                suffix = audio_format
                 save_time += (time.time() - ts)
 
             assert isinstance(txt, str)
+            manifest.append(
+                dict(key=key,
+                     duration=None if duration is None else round(
+                         duration, 4),
+                     num_chars=len(txt.replace(' ', '')),
+                     num_words=len(txt.split())))
             ts = time.time()
             txt_file = key + '.txt'
             txt = txt.encode('utf8')
@@ -100,9 +146,59 @@ def write_tar_file(data_list,
             wav_info = tarfile.TarInfo(wav_file)
             wav_info.size = len(data)
             tar.addfile(wav_info, wav_data)
+            num_bytes += len(data) + len(txt)
             write_time += (time.time() - ts)
         logging.info('read {} save {} write {}'.format(read_time, save_time,
                                                        write_time))
+    os.replace(tar_file + '.tmp', tar_file)
+    write_tar_index(tar_file)
+    with open(tar_file + '.manifest.tmp', 'w', encoding='utf8') as fout:
+        for x in manifest:
+            fout.write(json.dumps(x, ensure_ascii=False) + '\n')
+    os.replace(tar_file + '.manifest.tmp', tar_file + '.manifest')
+    return dict(num_utts=len(manifest),
+                duration=sum(x['duration'] or 0.0 for x in manifest),
+                num_bytes=num_bytes)
+
+
+def audio_duration(wav):
+    """ Duration of `wav` from its header, None if sox can not read it
+    """
+    try:
+        info = sox.info(wav)
+    except Exception:
+        logging.warning('Failed to get the duration of {}'.format(wav))
+        return None
+    if info.sample_rate <= 0:
+        return None
+    return info.num_frames / info.sample_rate
+
+
+def write_tar_file_safe(args):
+    """ write_tar_file for the pool, errors are returned instead of raised
+
+        Returns:
+            (tar_file, stats, error)
+    """
+    tar_file = args[2]
+    try:
+        return tar_file, write_tar_file(*args), None
+    except Exception:
+        return tar_file, None, traceback.format_exc()
+
+
+def write_tar_index(tar_file):
+    """ Write sidecar index `tar_file.idx` with one `name offset size` line
+        per member, where offset is the byte offset of the member data, so
+        the reader can seek to any utterance directly.
+    """
+    with tarfile.open(tar_file, 'r:') as tar, \
+            open(tar_file + '.idx', 'w', encoding='utf8') as fout:
+        for tarinfo in tar:
+            if tarinfo.isfile():
+                fout.write('{} {} {}\n'.format(tarinfo.name,
+                                               tarinfo.offset_data,
+                                               tarinfo.size))
 
 
 if __name__ == '__main__':
@@ -118,11 +214,27 @@ if __name__ == '__main__':
     parser.add_argument('--prefix',
                         default='shards',
                         help='prefix of shards tar file')
-    parser.add_argument('--segments', default=None, help='segments file')
+    parser.add_argument('--segments',
+                        default=None,
+                        help='segments file, the segments are sorted by wav '
+                        'path and start time, so the shards are made of '
+                        'different utterances from the ones of old versions '
+                        'of this script, do not resume shards made by them')
     parser.add_argument('--resample',
                         type=int,
                         default=16000,
                         help='segments file')
+    parser.add_argument('--audio_format',
+                        default=None,
+                        choices=['wav', 'flac', 'ogg'],
+                        help='audio format in shards, by default the source '
+                        'audio is kept as it is, and wav for segments')
+    parser.add_argument('--manifest',
+                        default=None,
+                        help='output manifest of all the utterances, json '
+                        'lines with key, shard, duration, num_chars and '
+                        'num_words, duration is null for the copied audio '
+                        'which sox can not read')
     parser.add_argument('wav_file', help='wav file')
     parser.add_argument('text_file', help='text file')
     parser.add_argument('shards_dir', help='output shards dir')
@@ -164,12 +276,15 @@ if __name__ == '__main__':
                 wav = wav_table[wav_key]
                 data.append((key, txt, wav, start, end))
 
+    # Segments of the same wav are put together, so every wav is only
+    # loaded once when making shards
+    if not no_segments:
+        data.sort(key=lambda x: (x[2], x[3]))
+
     num = args.num_utts_per_shard
     chunks = [data[i:i + num] for i in range(0, len(data), num)]
     os.makedirs(args.shards_dir, exist_ok=True)
 
-    # Using thread pool to speedup
-    pool = multiprocessing.Pool(processes=args.num_threads)
     shards_list = []
     tasks_list = []
     num_chunks = len(chunks)
@@ -177,13 +292,49 @@ if __name__ == '__main__':
         tar_file = os.path.join(args.shards_dir,
                                 '{}_{:09d}.tar'.format(args.prefix, i))
         shards_list.append(tar_file)
-        pool.apply_async(
-            write_tar_file,
-            (chunk, no_segments, tar_file, args.resample, i, num_chunks))
+        # Resume, skip the shards which are completed
+        if os.path.exists(tar_file) and \
+                os.path.exists(tar_file + '.manifest'):
+            continue
+        tasks_list.append((chunk, no_segments, tar_file, args.resample, i,
+                           num_chunks, args.audio_format))
+    logging.info('{} shards, {} completed before, {} to make'.format(
+        num_chunks, num_chunks - len(tasks_list), len(tasks_list)))
 
-    pool.close()
-    pool.join()
+    # Using process pool to speedup
+    start_time = time.time()
+    num_utts, duration, num_bytes = 0, 0.0, 0
+    failed = []
+    with multiprocessing.Pool(processes=args.num_threads) as pool:
+        for i, (tar_file, stats, error) in enumerate(
+                pool.imap_unordered(write_tar_file_safe, tasks_list)):
+            if error is not None:
+                logging.error('Failed to make {}\n{}'.format(tar_file, error))
+                failed.append(tar_file)
+                continue
+            num_utts += stats['num_utts']
+            duration += stats['duration']
+            num_bytes += stats['num_bytes']
+            elapsed = time.time() - start_time
+            logging.info(
+                '{}/{} shards done, {:.1f} utts/s, {:.1f} MB/s, {:.1f}x '
+                'realtime'.format(i + 1, len(tasks_list), num_utts / elapsed,
+                                  num_bytes / 1e6 / elapsed,
+                                  duration / elapsed))
+    if len(failed) > 0:
+        logging.error('{} shards failed, rerun to make them: {}'.format(
+            len(failed), ' '.join(failed)))
+        sys.exit(1)
 
     with open(args.shards_list, 'w', encoding='utf8') as fout:
         for name in shards_list:
             fout.write(name + '\n')
+
+    if args.manifest is not None:
+        with open(args.manifest, 'w', encoding='utf8') as fout:
+            for name in shards_list:
+                with open(name + '.manifest', 'r', encoding='utf8') as fin:
+                    for line in fin:
+                        x = json.loads(line)
+                        x['shard'] = name
+                        fout.write(json.dumps(x, ensure_ascii=False) + '\n')
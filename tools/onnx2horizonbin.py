@@ -412,6 +412,8 @@ if __name__ == '__main__':
     conf['spec_aug'] = False
     conf['spec_sub'] = False
     conf['spec_trim'] = False
+    conf['batch_fbank'] = False
+    conf['subset_ratio'] = 1.0
     conf['shuffle'] = False
     conf['sort'] = False
     if 'fbank_conf' in conf:
@@ -19,7 +19,6 @@ import argparse
 import copy
 import logging
 import os
-import sys
 
 import torch
 import yaml
@@ -29,7 +28,7 @@ from textgrid import TextGrid, IntervalTier
 from wenet.dataset.dataset import Dataset
 from wenet.utils.checkpoint import load_checkpoint
 from wenet.utils.file_utils import read_symbol_table, read_non_lang_symbols
-from wenet.utils.ctc_util import forced_align
+from wenet.utils.ctc_util import batch_forced_align
 from wenet.utils.common import get_subsample
 from wenet.utils.init_model import init_model
 
@@ -108,7 +107,7 @@ if __name__ == '__main__':
     parser.add_argument('--input_file', required=True, help='format data file')
     parser.add_argument('--data_type',
                         default='raw',
-                        choices=['raw', 'shard'],
+                        choices=['raw', 'shard', 'indexed_shard'],
                         help='train and cv data type')
     parser.add_argument('--gpu',
                         type=int,
@@ -136,10 +135,6 @@ if __name__ == '__main__':
                         format='%(asctime)s %(levelname)s %(message)s')
     os.environ['CUDA_VISIBLE_DEVICES'] = str(args.gpu)
 
-    if args.batch_size > 1:
-        logging.fatal('alignment mode must be running with batch_size == 1')
-        sys.exit(1)
-
     with open(args.config, 'r') as fin:
         configs = yaml.load(fin, Loader=yaml.FullLoader)
 
@@ -165,6 +160,8 @@ if __name__ == '__main__':
     ali_conf['filter_conf']['min_output_input_ratio'] = 0
     ali_conf['speed_perturb'] = False
     ali_conf['spec_aug'] = False
+    ali_conf['batch_fbank'] = False
+    ali_conf['subset_ratio'] = 1.0
     ali_conf['shuffle'] = False
     ali_conf['sort'] = False
     ali_conf['fbank_conf']['dither'] = 0.0
@@ -206,30 +203,30 @@ if __name__ == '__main__':
             # 1. Encoder
             encoder_out, encoder_mask = model._forward_encoder(
                 feat, feats_length)  # (B, maxlen, encoder_dim)
-            maxlen = encoder_out.size(1)
+            encoder_lens = encoder_mask.squeeze(1).sum(1)
             ctc_probs = model.ctc.log_softmax(
-                encoder_out)  # (1, maxlen, vocab_size)
-            # print(ctc_probs.size(1))
-            ctc_probs = ctc_probs.squeeze(0)
-            target = target.squeeze(0)
-            alignment = forced_align(ctc_probs, target)
-            print(alignment)
-            fout.write('{} {}\n'.format(key[0], alignment))
-
-            if args.gen_praat:
-                timestamp = get_frames_timestamp(alignment)
-                print(timestamp)
-                subsample = get_subsample(configs)
-                labformat = get_labformat(timestamp, subsample)
-
-                lab_path = os.path.join(os.path.dirname(args.result_file),
-                                        key[0] + ".lab")
-                with open(lab_path, 'w', encoding='utf-8') as f:
-                    f.writelines(labformat)
-
-                textgrid_path = os.path.join(os.path.dirname(args.result_file),
-                                             key[0] + ".TextGrid")
-                generator_textgrid(maxtime=(len(alignment) + 1) * 0.01 *
-                                   subsample,
-                                   lines=labformat,
-                                   output=textgrid_path)
+                encoder_out)  # (B, maxlen, vocab_size)
+            alignments, _, _ = batch_forced_align(ctc_probs, encoder_lens,
+                                                  target, target_length)
+            for i, alignment in enumerate(alignments):
+                print(alignment)
+                fout.write('{} {}\n'.format(key[i], alignment))
+
+                if args.gen_praat:
+                    timestamp = get_frames_timestamp(alignment)
+                    print(timestamp)
+                    subsample = get_subsample(configs)
+                    labformat = get_labformat(timestamp, subsample)
+
+                    lab_path = os.path.join(
+                        os.path.dirname(args.result_file), key[i] + ".lab")
+                    with open(lab_path, 'w', encoding='utf-8') as f:
+                        f.writelines(labformat)
+
+                    textgrid_path = os.path.join(
+                        os.path.dirname(args.result_file),
+                        key[i] + ".TextGrid")
+                    generator_textgrid(maxtime=(len(alignment) + 1) * 0.01 *
+                                       subsample,
+                                       lines=labformat,
+                                       output=textgrid_path)
@@ -16,11 +16,17 @@
 import os
 import argparse
 import glob
+import re
 
 import yaml
 import numpy as np
 import torch
 
+from wenet.utils.checkpoint import load_state_dict_mmap
+
+# libyaml based loader is much faster when it is available
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
 
 def get_args():
     parser = argparse.ArgumentParser(description='average model')
@@ -43,6 +49,12 @@ def get_args():
                         default=65536,
                         type=int,
                         help='max epoch used for averaging model')
+    parser.add_argument('--ema_decay',
+                        default=0.0,
+                        type=float,
+                        help='exponential moving average of the selected '
+                        'models in epoch order instead of the plain '
+                        'average if > 0')
 
     args = parser.parse_args()
     print(args)
@@ -54,10 +66,14 @@ def main():
     checkpoints = []
     val_scores = []
     if args.val_best:
-        yamls = glob.glob('{}/[!train]*.yaml'.format(args.src_path))
+        # only {epoch}.yaml has cv_loss, skip train.yaml, init.yaml etc.
+        yamls = [
+            y for y in glob.glob('{}/*.yaml'.format(args.src_path))
+            if re.fullmatch(r'[0-9]+\.yaml', os.path.basename(y))
+        ]
         for y in yamls:
             with open(y, 'r') as f:
-                dic_yaml = yaml.load(f, Loader=yaml.FullLoader)
+                dic_yaml = yaml.load(f, Loader=YamlLoader)
                 loss = dic_yaml['cv_loss']
                 epoch = dic_yaml['epoch']
                 if epoch >= args.min_epoch and epoch <= args.max_epoch:
@@ -77,22 +93,37 @@ def main():
         path_list = sorted(path_list, key=os.path.getmtime)
         path_list = path_list[-args.num:]
     print(path_list)
-    avg = None
     num = args.num
     assert num == len(path_list)
+    # NOTE: The checkpoints are memory-mapped and averaged tensor by tensor
+    #   in float64, so only the result and one float64 tensor are held in
+    #   memory besides the page cache, whatever the number of checkpoints.
+    if args.ema_decay > 0.0:
+        path_list = sorted(path_list, key=lambda p: int(
+            re.sub(r'\.pt$', '', os.path.basename(p))))
+    states_list = []
     for path in path_list:
         print('Processing {}'.format(path))
-        states = torch.load(path, map_location=torch.device('cpu'))
-        if avg is None:
-            avg = states
-        else:
-            for k in avg.keys():
-                avg[k] += states[k]
-    # average
-    for k in avg.keys():
-        if avg[k] is not None:
+        states_list.append(load_state_dict_mmap(path))
+    avg = {}
+    for k, v in states_list[0].items():
+        if v is None:
+            avg[k] = None
+        elif not v.is_floating_point():
             # pytorch 1.6 use true_divide instead of /=
-            avg[k] = torch.true_divide(avg[k], num)
+            avg[k] = torch.true_divide(
+                sum(states[k] for states in states_list), num)
+        elif args.ema_decay > 0.0:
+            acc = v.to(torch.float64, copy=True)
+            for states in states_list[1:]:
+                acc.mul_(args.ema_decay).add_(states[k].double(),
+                                              alpha=1.0 - args.ema_decay)
+            avg[k] = acc.to(v.dtype)
+        else:
+            acc = v.to(torch.float64, copy=True)
+            for states in states_list[1:]:
+                acc.add_(states[k].double())
+            avg[k] = acc.div_(num).to(v.dtype)
     print('Saving to {}'.format(args.dst_model))
     torch.save(avg, args.dst_model)
 
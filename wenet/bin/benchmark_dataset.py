@@ -0,0 +1,183 @@
+# Copyright (c) 2021 Mobvoi Inc. (authors: Binbin Zhang)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import argparse
+import logging
+import math
+import tempfile
+import time
+
+import yaml
+from torch.utils.data import DataLoader
+
+from wenet.dataset.dataset import Dataset
+from wenet.dataset.profiler import merge_stats, profile
+from wenet.utils.config import override_config
+from wenet.utils.file_utils import read_symbol_table, read_non_lang_symbols
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description='benchmark the throughput of the data pipeline')
+    parser.add_argument('--config', required=True, help='config file')
+    parser.add_argument('--data_type',
+                        default='raw',
+                        choices=['raw', 'shard', 'indexed_shard'],
+                        help='train and cv data type')
+    parser.add_argument('--data_list', required=True, help='data list file')
+    parser.add_argument('--symbol_table',
+                        required=True,
+                        help='model unit symbol table for training')
+    parser.add_argument('--non_lang_syms',
+                        help="non-linguistic symbol file. One symbol per line.")
+    parser.add_argument('--bpe_model',
+                        default=None,
+                        type=str,
+                        help='bpe model for english part')
+    parser.add_argument('--override_config',
+                        action='append',
+                        default=[],
+                        help="override yaml config")
+    parser.add_argument('--num_workers',
+                        default=0,
+                        type=int,
+                        help='num of subprocess workers for reading')
+    parser.add_argument('--prefetch',
+                        default=100,
+                        type=int,
+                        help='prefetch number')
+    parser.add_argument('--pin_memory',
+                        action='store_true',
+                        default=False,
+                        help='Use pinned memory buffers used for reading')
+    parser.add_argument('--num_batches',
+                        default=-1,
+                        type=int,
+                        help='number of batches to read, -1 for one epoch')
+    parser.add_argument('--step_time',
+                        default=0.0,
+                        type=float,
+                        help='simulated seconds the model takes per batch')
+    parser.add_argument('--profile_dir',
+                        default=None,
+                        help='dir of the per worker stats, temp dir if unset')
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    with open(args.config, 'r') as fin:
+        configs = yaml.load(fin, Loader=yaml.FullLoader)
+    if len(args.override_config) > 0:
+        configs = override_config(configs, args.override_config)
+
+    symbol_table = read_symbol_table(args.symbol_table)
+    non_lang_syms = read_non_lang_symbols(args.non_lang_syms)
+    dataset = Dataset(args.data_type, args.data_list, symbol_table,
+                      configs['dataset_conf'], args.bpe_model, non_lang_syms,
+                      True)
+    dataset.set_epoch(0)
+    profile_dir = args.profile_dir
+    if profile_dir is None:
+        profile_dir = tempfile.mkdtemp(prefix='wenet_profile_')
+    # append the stats for every batch, so they are complete whenever the
+    # workers are stopped
+    profile(dataset, profile_dir, dump_interval=1)
+    if args.num_workers > 0:
+        data_loader = DataLoader(dataset,
+                                 batch_size=None,
+                                 pin_memory=args.pin_memory,
+                                 num_workers=args.num_workers,
+                                 prefetch_factor=args.prefetch)
+    else:
+        data_loader = DataLoader(dataset,
+                                 batch_size=None,
+                                 pin_memory=args.pin_memory)
+
+    # Time waiting for the next batch is time the model is starved
+    num_batches, num_samples, num_frames, padded_frames = 0, 0, 0, 0
+    wait_time, num_starved = 0.0, 0
+    # only the consumed batches are counted in the stage stats
+    consumed = set()
+    start = time.perf_counter()
+    it = iter(data_loader)
+    while num_batches != args.num_batches:
+        begin = time.perf_counter()
+        try:
+            batch = next(it)
+        except StopIteration:
+            break
+        wait = time.perf_counter() - begin
+        # the first batch is always waited for, don't count it
+        if num_batches > 0:
+            wait_time += wait
+            num_starved += int(wait > 1e-3)
+        key, feats, _, feats_lengths, _ = batch
+        consumed.add(key[0])
+        num_batches += 1
+        num_samples += len(key)
+        num_frames += int(feats_lengths.sum())
+        padded_frames += feats.size(0) * feats.size(1)
+        if args.step_time > 0:
+            time.sleep(args.step_time)
+    elapsed = time.perf_counter() - start
+    # shutdown and join the workers, so all their stats are written
+    del it
+
+    print('batches {} samples {} frames {} in {:.3f}s'.format(
+        num_batches, num_samples, num_frames, elapsed))
+    print('throughput {:.2f} samples/s {:.2f} batches/s'.format(
+        num_samples / elapsed, num_batches / elapsed))
+    print('padding efficiency {:.2f}%'.format(
+        100.0 * num_frames / max(padded_frames, 1)))
+    print('starved batches {}/{}, waited {:.3f}s ({:.1f}% of time)'.format(
+        num_starved, max(num_batches - 1, 0), wait_time,
+        100.0 * wait_time / elapsed))
+
+    stats = merge_stats(profile_dir, consumed)
+    if stats is None:
+        logging.warning('no stats found in {}'.format(profile_dir))
+        return
+    stages = stats['stages']
+    busy = sum(x['time'] for x in stages)
+    print('stats of {} worker(s) in {}'.format(stats['num_workers'],
+                                               profile_dir))
+    print('{:<28}{:>10}{:>12}{:>8}{:>14}'.format('stage', 'items',
+                                                 'time(s)', '%',
+                                                 'items/s'))
+    for x in stages:
+        rate = x['count'] / x['time'] if x['time'] > 0 else float('inf')
+        print('{:<28}{:>10}{:>12.3f}{:>8.1f}{:>14.1f}'.format(
+            x['name'], x['count'], x['time'],
+            100.0 * x['time'] / max(busy, 1e-9), rate))
+    if stats['bytes_read'] is not None:
+        print('bytes read {:.2f} MB, {:.2f} MB/s'.format(
+            stats['bytes_read'] / 1e6,
+            stats['bytes_read'] / 1e6 / max(elapsed, 1e-9)))
+    # A worker needs `busy / consumed batches` seconds of CPU per batch
+    if args.step_time > 0 and stages[-1]['count'] > 0:
+        cost = busy / stages[-1]['count']
+        print('cpu time per batch {:.4f}s, {} worker(s) needed to keep up '
+              'with a {:.4f}s step'.format(cost,
+                                           math.ceil(cost / args.step_time),
+                                           args.step_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -16,9 +16,9 @@ from __future__ import print_function
 
 import argparse
 import copy
+import json
 import logging
 import os
-import sys
 
 import torch
 import yaml
@@ -30,6 +30,8 @@ from wenet.utils.checkpoint import load_checkpoint
 from wenet.utils.file_utils import read_symbol_table, read_non_lang_symbols
 from wenet.utils.config import override_config
 from wenet.utils.init_model import init_model
+from wenet.utils.long_form import (FbankStream, StreamingCTCDecoder,
+                                   energy_vad, read_wav_blocks)
 
 
 def get_args():
@@ -38,7 +40,7 @@ def get_args():
     parser.add_argument('--test_data', required=True, help='test data file')
     parser.add_argument('--data_type',
                         default='raw',
-                        choices=['raw', 'shard'],
+                        choices=['raw', 'shard', 'indexed_shard'],
                         help='train and cv data type')
     parser.add_argument('--gpu',
                         type=int,
@@ -114,6 +116,12 @@ def get_args():
     parser.add_argument('--simulate_streaming',
                         action='store_true',
                         help='simulate streaming inference')
+    parser.add_argument('--blank_skip_thresh',
+                        type=float,
+                        default=1.0,
+                        help='frames whose ctc blank posterior is larger \
+                              than it are skipped in ctc and rnnt search, \
+                              1.0 means no skip')
     parser.add_argument('--reverse_weight',
                         type=float,
                         default=0.0,
@@ -131,6 +139,33 @@ def get_args():
                         default='',
                         type=str,
                         help='used to connect the output characters')
+    parser.add_argument('--long_form',
+                        action='store_true',
+                        help='decode long recordings of raw data segment by '
+                             'segment with bounded memory, only for '
+                             'ctc_greedy_search with decoding_chunk_size > 0')
+    parser.add_argument('--vad',
+                        default='energy',
+                        choices=['energy', 'ctc'],
+                        help='segment long recordings by frame energy or by '
+                             'ctc blank endpoints')
+    parser.add_argument('--vad_threshold_db',
+                        type=float,
+                        default=-40.0,
+                        help='frames quieter than it are silence in energy vad')
+    parser.add_argument('--min_silence',
+                        type=float,
+                        default=0.5,
+                        help='seconds of silence or ctc blanks to end a '
+                             'segment')
+    parser.add_argument('--max_segment',
+                        type=float,
+                        default=30.0,
+                        help='max seconds of a segment')
+    parser.add_argument('--segment_file',
+                        default=None,
+                        help='long form result of every segment, '
+                             '"key start end text" per line')
 
     parser.add_argument('--word',
                         default='',
@@ -158,19 +193,80 @@ def get_args():
     return args
 
 
+def recognize_long_form(args, test_conf, model, char_dict, eos):
+    """ Decode every recording of the raw data list by segments, see
+        wenet.utils.long_form
+    """
+    assert args.mode == 'ctc_greedy_search'
+    assert args.data_type == 'raw'
+    assert args.decoding_chunk_size > 0
+    assert 'fbank_conf' in test_conf
+    fbank_conf = test_conf['fbank_conf']
+    resample_rate = test_conf.get('resample_conf', {}).get('resample_rate')
+    decoder = StreamingCTCDecoder(
+        model,
+        args.decoding_chunk_size,
+        args.num_decoding_left_chunks,
+        frame_shift=fbank_conf.get('frame_shift', 10),
+        max_segment=args.max_segment,
+        endpoint_silence=args.min_silence if args.vad == 'ctc' else 0.0)
+
+    def to_text(tokens):
+        content = []
+        for w in tokens:
+            if w == eos:
+                break
+            content.append(char_dict[w])
+        return args.connect_symbol.join(content)
+
+    fseg = open(args.segment_file, 'w') if args.segment_file else None
+    with torch.no_grad(), open(args.test_data, 'r') as fin, \
+            open(args.result_file, 'w') as fout:
+        for line in fin:
+            obj = json.loads(line)
+            key = obj['key']
+            sample_rate, blocks = read_wav_blocks(obj['wav'],
+                                                  resample_rate=resample_rate)
+            fbank = FbankStream(sample_rate,
+                                num_mel_bins=fbank_conf['num_mel_bins'],
+                                frame_length=fbank_conf['frame_length'],
+                                frame_shift=fbank_conf['frame_shift'])
+            segments = []
+            if args.vad == 'energy':
+                for start, samples in energy_vad(
+                        blocks,
+                        sample_rate,
+                        threshold_db=args.vad_threshold_db,
+                        min_silence=args.min_silence,
+                        max_segment=args.max_segment):
+                    fbank.reset()
+                    decoder.reset(start / sample_rate)
+                    segments += decoder.accept(fbank.accept(samples))
+                    segments += decoder.finalize()
+            else:
+                decoder.reset(0.0)
+                for block in blocks:
+                    segments += decoder.accept(fbank.accept(block))
+                segments += decoder.finalize()
+            texts = []
+            for segment in segments:
+                text = to_text(segment['tokens'])
+                texts.append(text)
+                if fseg is not None:
+                    fseg.write('{} {:.2f} {:.2f} {}\n'.format(
+                        key, segment['start'], segment['end'], text))
+            logging.info('{} {} segments'.format(key, len(segments)))
+            fout.write('{} {}\n'.format(key, args.connect_symbol.join(texts)))
+    if fseg is not None:
+        fseg.close()
+
+
 def main():
     args = get_args()
     logging.basicConfig(level=logging.DEBUG,
                         format='%(asctime)s %(levelname)s %(message)s')
     os.environ['CUDA_VISIBLE_DEVICES'] = str(args.gpu)
 
-    if args.mode in ['ctc_prefix_beam_search', 'attention_rescoring',
-                     'paraformer_beam_search', ] and args.batch_size > 1:
-        logging.fatal(
-            'decoding mode {} must be running with batch_size == 1'.format(
-                args.mode))
-        sys.exit(1)
-
     with open(args.config, 'r') as fin:
         configs = yaml.load(fin, Loader=yaml.FullLoader)
     if len(args.override_config) > 0:
@@ -189,6 +285,8 @@ def main():
     test_conf['spec_aug'] = False
     test_conf['spec_sub'] = False
     test_conf['spec_trim'] = False
+    test_conf['batch_fbank'] = False
+    test_conf['subset_ratio'] = 1.0
     test_conf['shuffle'] = False
     test_conf['sort'] = False
     if 'fbank_conf' in test_conf:
@@ -223,6 +321,10 @@ def main():
 
     model.eval()
 
+    if args.long_form:
+        recognize_long_form(args, test_conf, model, char_dict, eos)
+        return
+
     # Build BeamSearchCIF object
     if args.mode == 'paraformer_beam_search':
         paraformer_beam_search = build_beam_search(model, args, device)
@@ -251,9 +353,9 @@ def main():
                     feats_lengths,
                     decoding_chunk_size=args.decoding_chunk_size,
                     num_decoding_left_chunks=args.num_decoding_left_chunks,
-                    simulate_streaming=args.simulate_streaming)
+                    simulate_streaming=args.simulate_streaming,
+                    blank_skip_thresh=args.blank_skip_thresh)
             elif args.mode == 'rnnt_greedy_search':
-                assert (feats.size(0) == 1)
                 assert 'predictor' in configs
                 hyps = model.greedy_search(
                     feats,
@@ -272,7 +374,8 @@ def main():
                     num_decoding_left_chunks=args.num_decoding_left_chunks,
                     simulate_streaming=args.simulate_streaming,
                     ctc_weight=args.search_ctc_weight,
-                    transducer_weight=args.search_transducer_weight)
+                    transducer_weight=args.search_transducer_weight,
+                    blank_skip_thresh=args.blank_skip_thresh)
             elif args.mode == 'rnnt_beam_attn_rescoring':
                 assert (feats.size(0) == 1)
                 assert 'predictor' in configs
@@ -288,7 +391,8 @@ def main():
                     attn_weight=args.attn_weight,
                     reverse_weight=args.reverse_weight,
                     search_ctc_weight=args.search_ctc_weight,
-                    search_transducer_weight=args.search_transducer_weight)
+                    search_transducer_weight=args.search_transducer_weight,
+                    blank_skip_thresh=args.blank_skip_thresh)
             elif args.mode == 'ctc_beam_td_attn_rescoring':
                 assert (feats.size(0) == 1)
                 assert 'predictor' in configs
@@ -305,23 +409,19 @@ def main():
                     reverse_weight=args.reverse_weight,
                     search_ctc_weight=args.search_ctc_weight,
                     search_transducer_weight=args.search_transducer_weight,
-                    beam_search_type='ctc')
-            # ctc_prefix_beam_search and attention_rescoring only return one
-            # result in List[int], change it to List[List[int]] for compatible
-            # with other batch decoding mode
+                    beam_search_type='ctc',
+                    blank_skip_thresh=args.blank_skip_thresh)
             elif args.mode == 'ctc_prefix_beam_search':
-                assert (feats.size(0) == 1)
-                hyp, _ = model.ctc_prefix_beam_search(
+                hyps, _ = model.ctc_prefix_beam_search(
                     feats,
                     feats_lengths,
                     args.beam_size,
                     decoding_chunk_size=args.decoding_chunk_size,
                     num_decoding_left_chunks=args.num_decoding_left_chunks,
-                    simulate_streaming=args.simulate_streaming)
-                hyps = [hyp]
+                    simulate_streaming=args.simulate_streaming,
+                    blank_skip_thresh=args.blank_skip_thresh)
             elif args.mode == 'attention_rescoring':
-                assert (feats.size(0) == 1)
-                hyp, _ = model.attention_rescoring(
+                hyps, _ = model.attention_rescoring(
                     feats,
                     feats_lengths,
                     args.beam_size,
@@ -329,8 +429,8 @@ def main():
                     num_decoding_left_chunks=args.num_decoding_left_chunks,
                     ctc_weight=args.ctc_weight,
                     simulate_streaming=args.simulate_streaming,
-                    reverse_weight=args.reverse_weight)
-                hyps = [hyp]
+                    reverse_weight=args.reverse_weight,
+                    blank_skip_thresh=args.blank_skip_thresh)
             elif args.mode == 'hlg_onebest':
                 hyps = model.hlg_onebest(
                     feats,
@@ -379,6 +479,10 @@ def main():
                                             .join(content)))
                 fout.write('{} {}\n'.format(key, args.connect_symbol
                                             .join(content)))
+    if getattr(model, 'bs', None) is not None:
+        cache = model.bs.predictor_cache
+        logging.info('predictor cache hits {} misses {} hit rate {:.3f}'.format(
+            cache.hits, cache.misses, cache.hit_rate()))
 
 
 if __name__ == '__main__':
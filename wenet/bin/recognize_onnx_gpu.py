@@ -70,7 +70,7 @@ def get_args():
     parser.add_argument('--test_data', required=True, help='test data file')
     parser.add_argument('--data_type',
                         default='raw',
-                        choices=['raw', 'shard'],
+                        choices=['raw', 'shard', 'indexed_shard'],
                         help='train and cv data type')
     parser.add_argument('--gpu',
                         type=int,
@@ -130,6 +130,8 @@ def main():
     test_conf['spec_aug'] = False
     test_conf['spec_sub'] = False
     test_conf['spec_trim'] = False
+    test_conf['batch_fbank'] = False
+    test_conf['subset_ratio'] = 1.0
     test_conf['shuffle'] = False
     test_conf['sort'] = False
     test_conf['fbank_conf']['dither'] = 0.0
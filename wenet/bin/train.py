@@ -26,8 +26,11 @@ import yaml
 from tensorboardX import SummaryWriter
 from torch.utils.data import DataLoader
 
+from wenet.dataset.batch_augment import BatchSpecAugment
+from wenet.dataset.batch_fbank import BatchFbank
 from wenet.dataset.dataset import Dataset
 from wenet.utils.checkpoint import (load_checkpoint, save_checkpoint,
+                                    save_ema_checkpoint,
                                     load_trained_modules)
 from wenet.utils.executor import Executor
 from wenet.utils.file_utils import read_symbol_table, read_non_lang_symbols
@@ -40,7 +43,7 @@ def get_args():
     parser.add_argument('--config', required=True, help='config file')
     parser.add_argument('--data_type',
                         default='raw',
-                        choices=['raw', 'shard'],
+                        choices=['raw', 'shard', 'indexed_shard'],
                         help='train and cv data type')
     parser.add_argument('--train_data', required=True, help='train data file')
     parser.add_argument('--cv_data', required=True, help='cv data file')
@@ -50,6 +53,19 @@ def get_args():
                         help='gpu id for this local rank, -1 for cpu')
     parser.add_argument('--model_dir', required=True, help='save model dir')
     parser.add_argument('--checkpoint', help='checkpoint model')
+    parser.add_argument('--resume_start',
+                        default=0,
+                        type=int,
+                        help='resume the first epoch from this item of the '
+                        'epoch order of the data list, the position is not '
+                        'recorded in checkpoints, and is only exact with one '
+                        'rank and num_workers 1, see docs/UIO.md')
+    parser.add_argument('--resume_skip',
+                        default=0,
+                        type=int,
+                        help='number of utterances to skip in the resumed '
+                        'item, for indexed_shard only, with the same '
+                        'limitation as --resume_start')
     parser.add_argument('--tensorboard_dir',
                         default='tensorboard',
                         help='tensorboard log dir')
@@ -155,6 +171,7 @@ def main():
     cv_conf['spec_sub'] = False
     cv_conf['spec_trim'] = False
     cv_conf['shuffle'] = False
+    cv_conf['subset_ratio'] = 1.0
     non_lang_syms = read_non_lang_symbols(args.non_lang_syms)
 
     train_dataset = Dataset(args.data_type, args.train_data, symbol_table,
@@ -209,7 +226,20 @@ def main():
     if args.rank == 0:
         script_model = torch.jit.script(model)
         script_model.save(os.path.join(args.model_dir, 'init.zip'))
-    executor = Executor()
+    feature = None
+    batch_fbank = train_conf.get('batch_fbank', False) and \
+        train_conf.get('feats_type', 'fbank') == 'fbank'
+    if batch_fbank:
+        feature = BatchFbank(
+            train_conf.get('fbank_conf', {}),
+            train_conf.get('resample_conf', {}).get('resample_rate', 16000))
+    augment = None
+    if train_conf.get('batch_spec_aug', False) or batch_fbank:
+        augment = BatchSpecAugment(train_conf.get('spec_aug', True),
+                                   train_conf.get('spec_aug_conf', {}),
+                                   train_conf.get('spec_sub', False),
+                                   train_conf.get('spec_sub_conf', {}))
+    executor = Executor(augment, feature)
     # If specify checkpoint, load some info from checkpoint
     if args.checkpoint is not None:
         infos = load_checkpoint(model, args.checkpoint)
@@ -266,9 +296,14 @@ def main():
     configs['rank'] = args.rank
     configs['is_distributed'] = distributed
     configs['use_amp'] = args.use_amp
+    # Exponential moving average of the weights, updated at every save
+    ema_decay = configs.get('ema_decay', 0.0)
+    ema_model_path = os.path.join(model_dir, 'ema.pt')
     if start_epoch == 0 and args.rank == 0:
         save_model_path = os.path.join(model_dir, 'init.pt')
         save_checkpoint(model, save_model_path)
+        if os.path.exists(ema_model_path):
+            os.remove(ema_model_path)
 
     # Start training loop
     executor.step = step
@@ -280,6 +315,10 @@ def main():
 
     for epoch in range(start_epoch, num_epochs):
         train_dataset.set_epoch(epoch)
+        if epoch == start_epoch:
+            train_dataset.set_start(args.resume_start, args.resume_skip)
+        else:
+            train_dataset.set_start()
         configs['epoch'] = epoch
         lr = optimizer.param_groups[0]['lr']
         logging.info('Epoch {} TRAIN info lr {}'.format(epoch, lr))
@@ -299,6 +338,9 @@ def main():
                     'cv_loss': cv_loss,
                     'step': executor.step
                 })
+            if ema_decay > 0.0:
+                save_ema_checkpoint(model, ema_model_path, ema_decay,
+                                    {'epoch': epoch, 'step': executor.step})
             writer.add_scalar('epoch/cv_loss', cv_loss, epoch)
             writer.add_scalar('epoch/lr', lr, epoch)
         final_epoch = epoch
@@ -192,48 +192,63 @@ class MAELoss(nn.Module):
 
 
 def cif(hidden: torch.Tensor, alphas: torch.Tensor, threshold: float):
+    """ Continuous integrate-and-fire on the whole batch at once.
+
+    Let's denote the cumulative sum of alphas as c and the number of
+    tokens fired up to frame t as k[t], a token fires at t if the weight
+    integrated since the last fire, c[t] - k[t - 1], reaches threshold,
+    and at most one token fires per frame as the frame-by-frame loop does,
+    even if alphas > 1. With f[t] = floor(c[t] + 1 - threshold), that is
+    k[t] = min(k[t - 1] + 1, f[t]), i.e. k[t] = t + min(1, min_{s <= t}
+    (f[s] - s)). At a firing frame, alpha is split into the part which
+    completes the current token to 1 and the remainder which starts the
+    next one, the acoustic embeddings are then the alpha weighted sum of
+    the hidden states of every token, by a scatter add over the frames.
+
+    Args:
+        hidden (torch.Tensor): (B, T, D)
+        alphas (torch.Tensor): (B, T)
+        threshold (float): fire threshold
+
+    Returns:
+        torch.Tensor: acoustic embeddings of the fired tokens, (B, L, D),
+            L = round(max(sum(alphas)))
+        torch.Tensor: integrated weight at every frame before reset, (B, T)
+    """
     batch_size, len_time, hidden_size = hidden.size()
+    # float64 to avoid the error of cumsum on long utterances
+    alphas_d = alphas.double()
+    csum = torch.cumsum(alphas_d, dim=1)
+    prev_csum = csum - alphas_d
+    max_fired = torch.floor(csum + (1.0 - threshold)).clamp(min=0)
+    t = torch.arange(len_time, dtype=csum.dtype, device=csum.device)
+    num_fired = t + torch.cummin(max_fired - t, dim=1)[0].clamp(max=1.0)
+    prev_fired = torch.cat([
+        torch.zeros([batch_size, 1], dtype=csum.dtype, device=csum.device),
+        num_fired[:, :-1]
+    ], dim=1)
+    fire_place = num_fired > prev_fired
+    fires = (csum - prev_fired).type_as(alphas)
+    # weight of the current token, and the remainder for the next token
+    cur = torch.where(fire_place, prev_fired + 1.0 - prev_csum, alphas_d)
+    remainds = alphas_d - cur
 
-    # loop varss
-    integrate = torch.zeros([batch_size], device=hidden.device)
-    frame = torch.zeros([batch_size, hidden_size], device=hidden.device)
-    # intermediate vars along time
-    list_fires = []
-    list_frames = []
-
-    for t in range(len_time):
-        alpha = alphas[:, t]
-        distribution_completion = torch.ones([batch_size],
-                                             device=hidden.device) - integrate
-
-        integrate += alpha
-        list_fires.append(integrate)
-
-        fire_place = integrate >= threshold
-        integrate = torch.where(fire_place, integrate -
-                                torch.ones([batch_size], device=hidden.device),
-                                integrate)
-        cur = torch.where(fire_place,
-                          distribution_completion,
-                          alpha)
-        remainds = alpha - cur
-
-        frame += cur[:, None] * hidden[:, t, :]
-        list_frames.append(frame)
-        frame = torch.where(fire_place[:, None].repeat(1, hidden_size),
-                            remainds[:, None] * hidden[:, t, :],
-                            frame)
-
-    fires = torch.stack(list_fires, 1)
-    frames = torch.stack(list_frames, 1)
-    list_ls = []
     len_labels = torch.round(alphas.sum(-1)).int()
-    max_label_len = len_labels.max()
-    for b in range(batch_size):
-        fire = fires[b, :]
-        l = torch.index_select(frames[b, :, :], 0,
-                               torch.nonzero(fire >= threshold).squeeze())
-        pad_l = torch.zeros([int(max_label_len - l.size(0)), hidden_size],
-                            device=hidden.device)
-        list_ls.append(torch.cat([l, pad_l], 0))
-    return torch.stack(list_ls, 0), fires
+    max_label_len = int(len_labels.max())
+    index = prev_fired.long()
+    frames = torch.zeros([batch_size, max_label_len + 2, hidden_size],
+                         dtype=hidden.dtype,
+                         device=hidden.device)
+    frames.scatter_add_(
+        1, index.clamp(max=max_label_len + 1).unsqueeze(-1).expand(
+            -1, -1, hidden_size),
+        cur.type_as(hidden).unsqueeze(-1) * hidden)
+    frames.scatter_add_(
+        1, (index + 1).clamp(max=max_label_len + 1).unsqueeze(-1).expand(
+            -1, -1, hidden_size),
+        (remainds * fire_place).type_as(hidden).unsqueeze(-1) * hidden)
+    # only the fired tokens are output
+    token_mask = torch.arange(max_label_len, device=hidden.device) < \
+        num_fired[:, -1:].long()
+    frames = frames[:, :max_label_len, :] * token_mask.unsqueeze(-1)
+    return frames, fires
@@ -0,0 +1,188 @@
+# Copyright (c) 2021 Mobvoi Inc. (authors: Binbin Zhang)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import torch
+
+
+def _randint(low: torch.Tensor, high: torch.Tensor,
+             size: int) -> torch.Tensor:
+    """ Random integers in [low, high) of every utterance
+
+        Args:
+            low (torch.Tensor): (B,)
+            high (torch.Tensor): (B,), high > low
+
+        Returns:
+            torch.Tensor: (B, size)
+    """
+    r = torch.rand((low.size(0), size), device=low.device)
+    return low.unsqueeze(1) + (r * (high - low).unsqueeze(1)).long()
+
+
+def batch_time_warp(feats: torch.Tensor, feats_lengths: torch.Tensor,
+                    max_w: int = 80) -> torch.Tensor:
+    """ Time warp as SpecAugment, the frames before a random center are
+        stretched or squeezed to end at a random warped position by linear
+        interpolation, and so are the frames after it. Utterances not
+        longer than 2 * max_w + 1 frames are kept as they are.
+
+        Args:
+            feats (torch.Tensor): padded features (B, T, D)
+            feats_lengths (torch.Tensor): (B,)
+            max_w (int): max distance of the warp
+
+        Returns:
+            torch.Tensor: warped features (B, T, D)
+    """
+    B, T, D = feats.size()
+    lens = feats_lengths.to(feats.device).long()
+    warp = lens > 2 * max_w + 1
+    # center in [max_w, len - max_w), warped in (center - max_w,
+    # center + max_w]
+    center = _randint(torch.full_like(lens, max_w),
+                      torch.where(warp, lens - max_w, max_w + 1),
+                      1).squeeze(1)
+    warped = _randint(center - max_w + 1, center + max_w + 1, 1).squeeze(1)
+    t = torch.arange(T, device=feats.device).unsqueeze(0)  # (1, T)
+    center, warped, lens_f = (x.unsqueeze(1).to(feats.dtype)
+                              for x in (center, warped, lens))
+    src = torch.where(
+        t < warped, t * center / warped,
+        center + (t - warped) * (lens_f - center) / (lens_f - warped))
+    valid = t < lens.unsqueeze(1)
+    src = torch.where(warp.unsqueeze(1) & valid,
+                      torch.minimum(src, lens_f - 1),
+                      t.to(feats.dtype))  # (B, T), padding frames unchanged
+    low = src.floor().long()
+    high = torch.where(valid, torch.minimum(low + 1, lens.unsqueeze(1) - 1),
+                       low)
+    frac = (src - low).unsqueeze(2)
+    y_low = feats.gather(1, low.unsqueeze(2).expand(-1, -1, D))
+    y_high = feats.gather(1, high.unsqueeze(2).expand(-1, -1, D))
+    return y_low * (1 - frac) + y_high * frac
+
+
+def batch_spec_aug(feats: torch.Tensor,
+                   feats_lengths: torch.Tensor,
+                   num_t_mask: int = 2,
+                   num_f_mask: int = 2,
+                   max_t: int = 50,
+                   max_f: int = 10,
+                   time_warp_w: int = 0) -> torch.Tensor:
+    """ processor.spec_aug on a padded batch, masks are within the real
+        frames of each utterance.
+
+        Args:
+            feats (torch.Tensor): padded features (B, T, D)
+            feats_lengths (torch.Tensor): (B,)
+            num_t_mask: number of time mask to apply
+            num_f_mask: number of freq mask to apply
+            max_t: max width of time mask
+            max_f: max width of freq mask
+            time_warp_w: max width of time warp, no time warp if 0
+
+        Returns:
+            torch.Tensor: augmented features (B, T, D)
+    """
+    B, T, D = feats.size()
+    device = feats.device
+    lens = feats_lengths.to(device).long()
+    if time_warp_w > 0:
+        feats = batch_time_warp(feats, lens, time_warp_w)
+    ones = torch.ones_like(lens)
+    # time mask, start in [0, len), width in [1, max_t]
+    t = torch.arange(T, device=device).view(1, 1, T)
+    start = _randint(torch.zeros_like(lens), lens.clamp(min=1), num_t_mask)
+    end = torch.minimum(start + _randint(ones, ones + max_t, num_t_mask),
+                        lens.unsqueeze(1))
+    t_mask = ((t >= start.unsqueeze(2)) &
+              (t < end.unsqueeze(2))).any(1)  # (B, T)
+    # freq mask, start in [0, D), width in [1, max_f]
+    f = torch.arange(D, device=device).view(1, 1, D)
+    start = _randint(torch.zeros_like(lens), torch.full_like(lens, D),
+                     num_f_mask)
+    end = (start + _randint(ones, ones + max_f, num_f_mask)).clamp(max=D)
+    f_mask = ((f >= start.unsqueeze(2)) &
+              (f < end.unsqueeze(2))).any(1)  # (B, D)
+    valid = t.view(1, T) < lens.unsqueeze(1)  # (B, T)
+    mask = t_mask.unsqueeze(2) | (f_mask.unsqueeze(1) & valid.unsqueeze(2))
+    return feats.masked_fill(mask, 0.0)
+
+
+def batch_spec_sub(feats: torch.Tensor,
+                   feats_lengths: torch.Tensor,
+                   max_t: int = 20,
+                   num_t_sub: int = 3) -> torch.Tensor:
+    """ processor.spec_sub on a padded batch, every substituted segment
+        is copied from an earlier segment of the same utterance.
+
+        Args:
+            feats (torch.Tensor): padded features (B, T, D)
+            feats_lengths (torch.Tensor): (B,)
+            max_t: max width of time substitute
+            num_t_sub: number of time substitute to apply
+
+        Returns:
+            torch.Tensor: augmented features (B, T, D)
+    """
+    B, T, D = feats.size()
+    device = feats.device
+    lens = feats_lengths.to(device).long()
+    ones = torch.ones_like(lens)
+    start = _randint(torch.zeros_like(lens), lens.clamp(min=1), num_t_sub)
+    end = torch.minimum(start + _randint(ones, ones + max_t, num_t_sub),
+                        lens.unsqueeze(1))
+    # only substitute the earlier time chosen randomly for current time,
+    # shift in [0, start]
+    shift = (torch.rand(start.size(), device=device) *
+             (start + 1)).long()
+    t = torch.arange(T, device=device).unsqueeze(0).expand(B, -1)
+    src = t
+    # as the per utterance one, later substitutes override earlier ones
+    for i in range(num_t_sub):
+        inside = (t >= start[:, i:i + 1]) & (t < end[:, i:i + 1])
+        src = torch.where(inside, t - shift[:, i:i + 1], src)
+    return feats.gather(1, src.unsqueeze(2).expand(-1, -1, D))
+
+
+class BatchSpecAugment:
+    """ Do spec_aug and spec_sub of dataset_conf on padded batches on the
+        training device, instead of per utterance in the data workers.
+    """
+    def __init__(self,
+                 spec_aug: bool = True,
+                 spec_aug_conf: dict = None,
+                 spec_sub: bool = False,
+                 spec_sub_conf: dict = None):
+        self.spec_aug = spec_aug
+        # max_w of spec_aug_conf is ignored by processor.spec_aug, time warp
+        # is only enabled by time_warp_w so that the augmentation of
+        # existing configs doesn't change
+        self.spec_aug_conf = {
+            k: v
+            for k, v in (spec_aug_conf or {}).items() if k != 'max_w'
+        }
+        self.spec_sub = spec_sub
+        self.spec_sub_conf = spec_sub_conf or {}
+
+    @torch.no_grad()
+    def __call__(self, feats: torch.Tensor,
+                 feats_lengths: torch.Tensor) -> torch.Tensor:
+        if self.spec_aug:
+            feats = batch_spec_aug(feats, feats_lengths,
+                                   **self.spec_aug_conf)
+        if self.spec_sub:
+            feats = batch_spec_sub(feats, feats_lengths,
+                                   **self.spec_sub_conf)
+        return feats
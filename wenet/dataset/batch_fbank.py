@@ -0,0 +1,149 @@
+# Copyright (c) 2021 Mobvoi Inc. (authors: Binbin Zhang)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from functools import lru_cache
+from typing import Tuple
+
+import torch
+import torch.nn.functional as F
+import torchaudio.compliance.kaldi as kaldi
+
+EPSILON = torch.finfo(torch.float).eps
+
+
+@lru_cache(maxsize=8)
+def _mel_banks(num_mel_bins: int, padded_window_size: int,
+               sample_frequency: float) -> torch.Tensor:
+    # size (num_mel_bins, padded_window_size // 2 + 1), same defaults as
+    # kaldi.fbank: low_freq=20, high_freq=0, no vtln
+    mel_banks, _ = kaldi.get_mel_banks(num_mel_bins, padded_window_size,
+                                       sample_frequency, 20.0, 0.0, 100.0,
+                                       -500.0, 1.0)
+    return F.pad(mel_banks, (0, 1), mode='constant', value=0)
+
+
+def _frames_to_fbank(frames: torch.Tensor, window: torch.Tensor,
+                     mel_banks: torch.Tensor,
+                     padded_window_size: int) -> torch.Tensor:
+    # remove dc offset
+    frames.sub_(torch.mean(frames, dim=1, keepdim=True))
+    # preemphasis, frames[i] -= 0.97 * frames[max(0, i - 1)]
+    offset_frames = frames[:, :-1] * 0.97
+    frames[:, 0].sub_(frames[:, 0] * 0.97)
+    frames[:, 1:].sub_(offset_frames)
+    frames.mul_(window)
+    # (N, padded_window_size // 2 + 1), zero padded to padded_window_size
+    spectrum = torch.fft.rfft(frames, n=padded_window_size).abs().pow(2.0)
+    mel_energies = torch.mm(spectrum, mel_banks.T)  # (N, num_mel_bins)
+    return torch.clamp(mel_energies, min=EPSILON).log()
+
+
+def batch_fbank(waveforms: torch.Tensor,
+                lengths: torch.Tensor,
+                num_mel_bins: int = 23,
+                frame_length: float = 25.0,
+                frame_shift: float = 10.0,
+                dither: float = 0.0,
+                sample_frequency: float = 16000.0,
+                block_frames: int = 1024
+                ) -> Tuple[torch.Tensor, torch.Tensor]:
+    """ Kaldi compatible fbank of a padded waveform batch at once
+
+        It follows torchaudio.compliance.kaldi.fbank with the arguments used
+        by processor.compute_fbank (povey window, snip_edges, 0.97
+        preemphasis, power spectrum, log mel), but the real frames of all
+        utterances are gathered and go through FFT and mel filtering
+        together, on the device of `waveforms`. The result equals the
+        per-utterance one up to float rounding when dither is 0.0, with
+        dither only the random noise differs.
+
+        Args:
+            waveforms (torch.Tensor): padded waveforms (B, T)
+            lengths (torch.Tensor): number of samples of each waveform (B,)
+            block_frames (int): number of frames processed at a time
+
+        Returns:
+            torch.Tensor: padded fbank (B, num_frames, num_mel_bins), padding
+                frames are 0
+            torch.Tensor: number of frames of each fbank (B,)
+    """
+    window_shift = int(sample_frequency * frame_shift * 0.001)
+    window_size = int(sample_frequency * frame_length * 0.001)
+    padded_window_size = 1 << (window_size - 1).bit_length()
+    device, dtype = waveforms.device, waveforms.dtype
+
+    if waveforms.size(1) < window_size:
+        waveforms = F.pad(waveforms, (0, window_size - waveforms.size(1)))
+    num_frames = torch.div(lengths - window_size, window_shift,
+                           rounding_mode='floor') + 1
+    num_frames = num_frames.clamp(min=0)
+    # (B, M, window_size), snip_edges
+    frames = waveforms.unfold(1, window_size, window_shift)
+    mask = torch.arange(frames.size(1), device=device) < \
+        num_frames.unsqueeze(1)  # (B, M)
+    # Only gather the real frames of all utterances, (N, window_size), so
+    # no computation is wasted on padding
+    frames = frames[mask]
+
+    if dither != 0.0:
+        frames.add_(torch.randn_like(frames) * dither)
+    window = torch.hann_window(window_size, periodic=False, device=device,
+                               dtype=dtype).pow(0.85)  # povey window
+    mel_banks = _mel_banks(num_mel_bins, padded_window_size,
+                           float(sample_frequency))
+    mel_banks = mel_banks.to(device=device, dtype=dtype)
+    # NOTE: Frames are processed by blocks to keep the intermediate tensors
+    #   cache friendly, which is much faster than one huge call on CPU.
+    feats = torch.zeros((mask.size(0), mask.size(1), num_mel_bins),
+                        device=device, dtype=dtype)
+    if frames.size(0) > 0:
+        mel_energies = [
+            _frames_to_fbank(x, window, mel_banks, padded_window_size)
+            for x in torch.split(frames, block_frames)
+        ]
+        # (N, num_mel_bins)
+        feats[mask] = torch.cat(mel_energies, dim=0)
+    return feats, num_frames
+
+
+class BatchFbank:
+    """ Compute fbank of dataset_conf on padded waveform batches on the
+        training device, instead of per utterance in the data workers, see
+        processor.wav_for_batch_fbank.
+    """
+    def __init__(self,
+                 fbank_conf: dict = None,
+                 sample_rate: int = 16000):
+        self.fbank_conf = fbank_conf or {}
+        self.sample_rate = sample_rate
+
+    @torch.no_grad()
+    def __call__(self, waveforms: torch.Tensor,
+                 lengths: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """ Args:
+                waveforms (torch.Tensor): padded waveforms (B, T)
+                lengths (torch.Tensor): (B,)
+
+            Returns:
+                torch.Tensor: padded fbank (B, num_frames, num_mel_bins)
+                torch.Tensor: (B,)
+        """
+        feats, feats_lengths = batch_fbank(
+            waveforms * (1 << 15), lengths,
+            num_mel_bins=self.fbank_conf.get('num_mel_bins', 23),
+            frame_length=self.fbank_conf.get('frame_length', 25),
+            frame_shift=self.fbank_conf.get('frame_shift', 10),
+            dither=self.fbank_conf.get('dither', 0.0),
+            sample_frequency=self.sample_rate)
+        return feats, feats_lengths.to(lengths.dtype)
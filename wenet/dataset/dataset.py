@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import logging
 import random
 
 import torch
@@ -29,17 +30,24 @@ class Processor(IterableDataset):
         self.f = f
         self.args = args
         self.kw = kw
+        self.profiler = None
 
     def set_epoch(self, epoch):
         self.source.set_epoch(epoch)
 
+    def set_start(self, start=0, skip=0):
+        self.source.set_start(start, skip)
+
     def __iter__(self):
         """ Return an iterator over the source dataset processed by the
             given processor.
         """
         assert self.source is not None
         assert callable(self.f)
-        return self.f(iter(self.source), *self.args, **self.kw)
+        it = self.f(iter(self.source), *self.args, **self.kw)
+        if self.profiler is not None:
+            it = self.profiler.wrap(self.f.__name__, it)
+        return it
 
     def apply(self, f):
         assert callable(f)
@@ -47,11 +55,15 @@ class Processor(IterableDataset):
 
 
 class DistributedSampler:
-    def __init__(self, shuffle=True, partition=True):
+    def __init__(self, shuffle=True, partition=True, subset_ratio=1.0):
         self.epoch = -1
         self.update()
         self.shuffle = shuffle
         self.partition = partition
+        self.subset_ratio = subset_ratio
+        self.start = 0
+        self.skip = 0
+        self.start_index = None
 
     def update(self):
         assert dist.is_available()
@@ -71,11 +83,20 @@ class DistributedSampler:
         return dict(rank=self.rank,
                     world_size=self.world_size,
                     worker_id=self.worker_id,
-                    num_workers=self.num_workers)
+                    num_workers=self.num_workers,
+                    epoch=self.epoch)
 
     def set_epoch(self, epoch):
         self.epoch = epoch
 
+    def set_start(self, start=0, skip=0):
+        """ Resume the epoch from the `start`-th item of its order, which
+            is deterministic given the epoch, and skip the first `skip`
+            utterances of that item (only indexed shards support it)
+        """
+        self.start = start
+        self.skip = skip
+
     def sample(self, data):
         """ Sample data according to rank/world_size/num_workers
 
@@ -86,26 +107,36 @@ class DistributedSampler:
                 List: data list after sample
         """
         data = list(range(len(data)))
+        if self.partition and self.shuffle:
+            random.Random(self.epoch).shuffle(data)
+        # a subset of the epoch order for training, a different one every
+        # epoch when shuffled, CV and test data are always used in full
+        if self.partition and self.subset_ratio < 1.0:
+            data = data[:max(1, int(len(data) * self.subset_ratio))]
+        data = data[self.start:]
+        self.start_index = data[0] if len(data) > 0 else None
         # TODO(Binbin Zhang): fix this
         # We can not handle uneven data for CV on DDP, so we don't
         # sample data by rank, that means every GPU gets the same
         # and all the CV data
         if self.partition:
-            if self.shuffle:
-                random.Random(self.epoch).shuffle(data)
             data = data[self.rank::self.world_size]
         data = data[self.worker_id::self.num_workers]
         return data
 
 
 class DataList(IterableDataset):
-    def __init__(self, lists, shuffle=True, partition=True):
+    def __init__(self, lists, shuffle=True, partition=True,
+                 subset_ratio=1.0):
         self.lists = lists
-        self.sampler = DistributedSampler(shuffle, partition)
+        self.sampler = DistributedSampler(shuffle, partition, subset_ratio)
 
     def set_epoch(self, epoch):
         self.sampler.set_epoch(epoch)
 
+    def set_start(self, start=0, skip=0):
+        self.sampler.set_start(start, skip)
+
     def __iter__(self):
         sampler_info = self.sampler.update()
         indexes = self.sampler.sample(self.lists)
@@ -113,6 +144,8 @@ class DataList(IterableDataset):
             # yield dict(src=src)
             data = dict(src=self.lists[index])
             data.update(sampler_info)
+            if index == self.sampler.start_index and self.sampler.skip > 0:
+                data['skip'] = self.sampler.skip
             yield data
 
 
@@ -130,44 +163,90 @@ def Dataset(data_type,
         at training samples level.
 
         Args:
-            data_type(str): raw/shard
+            data_type(str): raw/shard/indexed_shard
             bpe_model(str): model for english bpe part
             partition(bool): whether to do data partition in terms of rank
     """
-    assert data_type in ['raw', 'shard']
+    assert data_type in ['raw', 'shard', 'indexed_shard']
     lists = read_lists(data_list_file)
     shuffle = conf.get('shuffle', True)
-    dataset = DataList(lists, shuffle=shuffle, partition=partition)
+    resample_conf = conf.get('resample_conf', {})
+    speed_perturb = conf.get('speed_perturb', False)
+    feats_type = conf.get('feats_type', 'fbank')
+    assert feats_type in ['fbank', 'mfcc']
+    feat_conf = conf.get('{}_conf'.format(feats_type), {})
+
+    # fbank is computed on the training device by BatchFbank if batch_fbank,
+    # the batches have padded waveforms instead of features
+    batch_fbank = feats_type == 'fbank' and conf.get('batch_fbank', False)
+
+    # Feature is only cached when it is deterministic, that is, without
+    # speed perturb and dither. The readers load cached features instead
+    # of decoding the audio.
+    feat_cache_root = conf.get('feat_cache_dir', None)
+    if feat_cache_root is not None and batch_fbank:
+        logging.warning('feat_cache_dir is ignored since batch_fbank '
+                        'computes feature on the training device')
+        feat_cache_root = None
+    if feat_cache_root is not None and \
+            (speed_perturb or feat_conf.get('dither', 0.0) != 0.0):
+        logging.warning('feat_cache_dir is ignored since speed_perturb or '
+                        'dither makes feature random')
+        feat_cache_root = None
+    feat_cache_dir = None
+    if feat_cache_root is not None:
+        feat_cache_dir = processor.feat_cache_dir(
+            feat_cache_root,
+            dict(feats_type=feats_type, feat_conf=feat_conf,
+                 resample_conf=resample_conf))
+
+    dataset = DataList(lists, shuffle=shuffle, partition=partition,
+                       subset_ratio=conf.get('subset_ratio', 1.0))
     if data_type == 'shard':
-        dataset = Processor(dataset, processor.url_opener)
-        dataset = Processor(dataset, processor.tar_file_and_group)
+        if conf.get('shard_prefetch', False):
+            shard_prefetch_conf = conf.get('shard_prefetch_conf', {})
+            dataset = Processor(dataset, processor.prefetch_url_opener,
+                                **shard_prefetch_conf)
+        else:
+            dataset = Processor(dataset, processor.url_opener)
+        dataset = Processor(dataset, processor.tar_file_and_group,
+                            feat_cache_dir)
+    elif data_type == 'indexed_shard':
+        dataset = Processor(dataset, processor.indexed_tar_file_and_group,
+                            shuffle, feat_cache_dir)
     else:
-        dataset = Processor(dataset, processor.parse_raw)
+        dataset = Processor(dataset, processor.parse_raw, feat_cache_dir)
 
     dataset = Processor(dataset, processor.tokenize, symbol_table, bpe_model,
                         non_lang_syms, conf.get('split_with_space', False))
     filter_conf = conf.get('filter_conf', {})
     dataset = Processor(dataset, processor.filter, **filter_conf)
 
-    resample_conf = conf.get('resample_conf', {})
     dataset = Processor(dataset, processor.resample, **resample_conf)
 
-    speed_perturb = conf.get('speed_perturb', False)
     if speed_perturb:
         dataset = Processor(dataset, processor.speed_perturb)
 
-    feats_type = conf.get('feats_type', 'fbank')
-    assert feats_type in ['fbank', 'mfcc']
-    if feats_type == 'fbank':
-        fbank_conf = conf.get('fbank_conf', {})
-        dataset = Processor(dataset, processor.compute_fbank, **fbank_conf)
+    if batch_fbank:
+        dataset = Processor(dataset, processor.wav_for_batch_fbank,
+                            feat_conf.get('frame_length', 25),
+                            feat_conf.get('frame_shift', 10))
+    elif feats_type == 'fbank':
+        dataset = Processor(dataset, processor.compute_fbank, **feat_conf)
     elif feats_type == 'mfcc':
-        mfcc_conf = conf.get('mfcc_conf', {})
-        dataset = Processor(dataset, processor.compute_mfcc, **mfcc_conf)
+        dataset = Processor(dataset, processor.compute_mfcc, **feat_conf)
+    if feat_cache_dir is not None:
+        dataset = Processor(dataset, processor.save_feat_cache)
 
-    spec_aug = conf.get('spec_aug', True)
-    spec_sub = conf.get('spec_sub', False)
+    # spec_aug and spec_sub are done on the training device by
+    # BatchSpecAugment if batch_spec_aug, which batch_fbank implies
+    batch_spec_aug = conf.get('batch_spec_aug', False) or batch_fbank
+    spec_aug = conf.get('spec_aug', True) and not batch_spec_aug
+    spec_sub = conf.get('spec_sub', False) and not batch_spec_aug
     spec_trim = conf.get('spec_trim', False)
+    if spec_trim and batch_fbank:
+        logging.warning('spec_trim is ignored with batch_fbank')
+        spec_trim = False
     if spec_aug:
         spec_aug_conf = conf.get('spec_aug_conf', {})
         dataset = Processor(dataset, processor.spec_aug, **spec_aug_conf)
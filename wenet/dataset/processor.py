@@ -12,19 +12,32 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import bisect
+import collections
+import hashlib
+import io
 import logging
+import math
 import json
+import os
 import random
 import re
 import tarfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from subprocess import PIPE, Popen
 from urllib.parse import urlparse
+from urllib.request import urlopen
 
+import numpy as np
 import torch
 import torchaudio
 import torchaudio.compliance.kaldi as kaldi
 from torch.nn.utils.rnn import pad_sequence
 
+
 AUDIO_FORMAT_SETS = set(['flac', 'mp3', 'm4a', 'ogg', 'opus', 'wav', 'wma'])
 
 
@@ -59,12 +72,169 @@ def url_opener(data):
             logging.warning('Failed to open {}'.format(url))
 
 
-def tar_file_and_group(data):
+def __download(url, timeout):
+    """ Read the whole content of an url
+    """
+    pr = urlparse(url)
+    if pr.scheme in ['http', 'https', 'ftp']:
+        with urlopen(url, timeout=timeout) as fin:
+            return fin.read()
+    # other network file, such as HDFS/OSS/S3/SCP, by wget as url_opener
+    process = Popen(f'wget -q -O - {url}', shell=True, stdout=PIPE)
+    content, _ = process.communicate()
+    if process.returncode != 0:
+        raise IOError('wget exit with {}'.format(process.returncode))
+    return content
+
+
+def __evict_shard_cache(cache_dir, cache_size):
+    """ Remove the least recently used shards until the total size of
+        `cache_dir` is no more than `cache_size` bytes
+    """
+    files = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.endswith('.tmp'):
+            continue
+        try:
+            st = os.stat(path)
+        except OSError:  # removed by other workers
+            continue
+        files.append((st.st_mtime, st.st_size, path))
+    total = sum(x[1] for x in files)
+    for _, size, path in sorted(files):
+        if total <= cache_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+
+def __fetch_shard(url, max_retries, backoff, timeout, cache_dir, cache_size):
+    """ Download a shard with retry, the shard is kept in memory, or in
+        `cache_dir` if given.
+
+        Returns:
+            file object of the shard
+    """
+    cache_path = None
+    if cache_dir is not None:
+        h = hashlib.md5(url.encode('utf8')).hexdigest()
+        cache_path = os.path.join(cache_dir,
+                                  h + '_' + os.path.basename(urlparse(url).path))
+        if os.path.exists(cache_path):
+            try:
+                os.utime(cache_path)  # most recently used
+                return open(cache_path, 'rb')
+            except OSError:  # evicted by other workers
+                pass
+    for i in range(max_retries + 1):
+        try:
+            content = __download(url, timeout)
+            break
+        except Exception as ex:
+            if i == max_retries:
+                raise
+            delay = backoff * (2**i) * (1.0 + random.random())
+            logging.warning('Failed to download {} ({}), retry in {:.1f}s'
+                            .format(url, ex, delay))
+            time.sleep(delay)
+    if cache_path is None:
+        return io.BytesIO(content)
+    tmp_path = '{}.{}.{}.tmp'.format(cache_path, os.getpid(),
+                                     threading.get_ident())
+    with open(tmp_path, 'wb') as fout:
+        fout.write(content)
+    os.replace(tmp_path, cache_path)
+    __evict_shard_cache(cache_dir, cache_size)
+    return io.BytesIO(content)
+
+
+def prefetch_url_opener(data,
+                        num_prefetch=4,
+                        max_retries=3,
+                        backoff=1.0,
+                        timeout=60,
+                        cache_dir=None,
+                        cache_size=100):
+    """ Give url or local file, return file descriptor like url_opener,
+        but the next `num_prefetch` network shards are downloaded by a
+        thread pool ahead of time, so that reading a shard does not wait
+        for the network. Failed downloads are retried with exponential
+        backoff, the shards are optionally kept in a LRU disk cache.
+        Inplace operation.
+
+        Args:
+            data(Iterable[str]): url or local file list
+            num_prefetch(int): max number of shards downloaded or
+                downloading ahead, which bounds the memory used
+            max_retries(int): max retries of a failed download
+            backoff(float): delay in seconds of the first retry
+            timeout(float): socket timeout in seconds of http/ftp
+            cache_dir(str): local dir to cache the shards, no cache if None
+            cache_size(float): max size of `cache_dir` in GB
+
+        Returns:
+            Iterable[{src, stream}]
+    """
+    assert num_prefetch > 0
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+    cache_size = int(cache_size * 1024**3)
+    executor = ThreadPoolExecutor(max_workers=num_prefetch)
+    pending = collections.deque()
+    try:
+        data = iter(data)
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < num_prefetch:
+                try:
+                    sample = next(data)
+                except StopIteration:
+                    exhausted = True
+                    break
+                assert 'src' in sample
+                url = sample['src']
+                pr = urlparse(url)
+                # local file
+                if pr.scheme == '' or pr.scheme == 'file':
+                    future = None
+                else:
+                    future = executor.submit(__fetch_shard, url, max_retries,
+                                             backoff, timeout, cache_dir,
+                                             cache_size)
+                pending.append((sample, future))
+            if len(pending) == 0:
+                break
+            sample, future = pending.popleft()
+            url = sample['src']
+            try:
+                if future is None:
+                    stream = open(url, 'rb')
+                else:
+                    stream = future.result()
+                sample.update(stream=stream)
+                yield sample
+            except Exception as ex:
+                logging.warning('Failed to open {}'.format(url))
+    finally:
+        for _, future in pending:
+            if future is not None:
+                future.cancel()
+        executor.shutdown(wait=False)
+
+
+def tar_file_and_group(data, feat_cache_dir=None):
     """ Expand a stream of open tar files into a stream of tar file contents.
         And groups the file with same prefix
 
         Args:
             data: Iterable[{src, stream}]
+            feat_cache_dir(str): feature cache directory, see
+                feat_cache_dir, the audio of cached utterances is not
+                decoded
 
         Returns:
             Iterable[{key, wav, txt, sample_rate}]
@@ -91,9 +261,13 @@ def tar_file_and_group(data):
                     if postfix == 'txt':
                         example['txt'] = file_obj.read().decode('utf8').strip()
                     elif postfix in AUDIO_FORMAT_SETS:
-                        waveform, sample_rate = torchaudio.load(file_obj)
-                        example['wav'] = waveform
-                        example['sample_rate'] = sample_rate
+                        src = '{}:{}:{}:{}'.format(sample['src'], name,
+                                                   tarinfo.size,
+                                                   tarinfo.mtime)
+                        if feat_cache_dir is None or not __load_feat_cache(
+                                example, feat_cache_dir, src, prefix):
+                            waveform, sample_rate = torchaudio.load(file_obj)
+                            __set_audio(example, waveform, sample_rate)
                     else:
                         example[postfix] = file_obj.read()
                 except Exception as ex:
@@ -109,11 +283,99 @@ def tar_file_and_group(data):
         sample['stream'].close()
 
 
-def parse_raw(data):
+def read_tar_index(index_file):
+    """ Read sidecar index of tar file written by tools/make_shard_list.py
+        and group members with the same prefix
+
+        Args:
+            index_file(str): index file, one `name offset size` per line
+
+        Returns:
+            List[Tuple[key, List[Tuple[postfix, offset, size]]]]
+    """
+    utts = []
+    with open(index_file, 'r', encoding='utf8') as fin:
+        for line in fin:
+            name, offset, size = line.strip().rsplit(maxsplit=2)
+            pos = name.rfind('.')
+            assert pos > 0
+            prefix, postfix = name[:pos], name[pos + 1:]
+            if len(utts) == 0 or utts[-1][0] != prefix:
+                utts.append((prefix, []))
+            utts[-1][1].append((postfix, int(offset), int(size)))
+    return utts
+
+
+def indexed_tar_file_and_group(data, shuffle=False, feat_cache_dir=None):
+    """ Read utterances of local tar files by seeking to their byte offsets
+        in the sidecar index `tar_file.idx`, instead of streaming the whole
+        tar, so only the bytes of consumed utterances are read.
+
+        Args:
+            data: Iterable[{src, epoch, skip}], src is local tar file, the
+                first `skip` utterances in the order of the epoch are
+                skipped to resume from the middle of the tar file, see
+                DistributedSampler.set_start
+            shuffle(bool): shuffle utterances in a tar file, the order is
+                deterministic given the epoch and the tar file
+            feat_cache_dir(str): feature cache directory, see
+                feat_cache_dir, the audio of cached utterances is not read
+
+        Returns:
+            Iterable[{key, wav, txt, sample_rate}]
+    """
+    for sample in data:
+        assert 'src' in sample
+        tar_file = sample['src']
+        try:
+            utts = read_tar_index(tar_file + '.idx')
+            stream = open(tar_file, 'rb')
+            mtime = os.path.getmtime(tar_file)
+        except Exception as ex:
+            logging.warning('Failed to open {}'.format(tar_file))
+            continue
+        if shuffle:
+            seed = '{}-{}'.format(sample.get('epoch', 0), tar_file)
+            random.Random(seed).shuffle(utts)
+        utts = utts[sample.get('skip', 0):]
+        for key, members in utts:
+            example = dict(key=key)
+            valid = True
+            for postfix, offset, size in members:
+                try:
+                    if postfix in AUDIO_FORMAT_SETS:
+                        src = '{}:{}:{}:{}'.format(tar_file, offset, size,
+                                                   mtime)
+                        if feat_cache_dir is not None and __load_feat_cache(
+                                example, feat_cache_dir, src, key):
+                            continue
+                    stream.seek(offset)
+                    content = stream.read(size)
+                    if postfix == 'txt':
+                        example['txt'] = content.decode('utf8').strip()
+                    elif postfix in AUDIO_FORMAT_SETS:
+                        waveform, sample_rate = torchaudio.load(
+                            io.BytesIO(content))
+                        __set_audio(example, waveform, sample_rate)
+                    else:
+                        example[postfix] = content
+                except Exception as ex:
+                    valid = False
+                    logging.warning('error to parse {}.{}'.format(
+                        key, postfix))
+            if valid:
+                yield example
+        stream.close()
+
+
+def parse_raw(data, feat_cache_dir=None):
     """ Parse key/wav/txt from json line
 
         Args:
             data: Iterable[str], str is a json line has key/wav/txt
+            feat_cache_dir(str): feature cache directory, see
+                feat_cache_dir, the audio of cached utterances is not
+                decoded
 
         Returns:
             Iterable[{key, wav, txt, sample_rate}]
@@ -128,6 +390,19 @@ def parse_raw(data):
         key = obj['key']
         wav_file = obj['wav']
         txt = obj['txt']
+        example = dict(key=key, txt=txt)
+        if feat_cache_dir is not None:
+            try:
+                stat = os.stat(wav_file)
+                src = '{}:{}:{}:{}:{}'.format(wav_file, obj.get('start'),
+                                              obj.get('end'), stat.st_size,
+                                              stat.st_mtime)
+            except Exception as ex:
+                src = '{}:{}:{}'.format(wav_file, obj.get('start'),
+                                        obj.get('end'))
+            if __load_feat_cache(example, feat_cache_dir, src, key):
+                yield example
+                continue
         try:
             if 'start' in obj:
                 assert 'end' in obj
@@ -141,10 +416,7 @@ def parse_raw(data):
                     frame_offset=start_frame)
             else:
                 waveform, sample_rate = torchaudio.load(wav_file)
-            example = dict(key=key,
-                           txt=txt,
-                           wav=waveform,
-                           sample_rate=sample_rate)
+            __set_audio(example, waveform, sample_rate)
             yield example
         except Exception as ex:
             logging.warning('Failed to read {}'.format(wav_file))
@@ -179,10 +451,14 @@ def filter(data,
     """
     for sample in data:
         assert 'sample_rate' in sample
-        assert 'wav' in sample
         assert 'label' in sample
-        # sample['wav'] is torch.Tensor, we have 100 frames every second
-        num_frames = sample['wav'].size(1) / sample['sample_rate'] * 100
+        # sample['wav'] is torch.Tensor, we have 100 frames every second,
+        # samples with cached feat only have the number of samples
+        if 'wav' in sample:
+            num_samples = sample['wav'].size(1)
+        else:
+            num_samples = sample['num_samples']
+        num_frames = num_samples / sample['sample_rate'] * 100
         if num_frames < min_length:
             continue
         if num_frames > max_length:
@@ -211,6 +487,9 @@ def resample(data, resample_rate=16000):
             Iterable[{key, wav, label, sample_rate}]
     """
     for sample in data:
+        if 'feat' in sample:  # loaded from feat cache
+            yield sample
+            continue
         assert 'sample_rate' in sample
         assert 'wav' in sample
         sample_rate = sample['sample_rate']
@@ -264,10 +543,14 @@ def compute_fbank(data,
             Iterable[{key, feat, label}]
     """
     for sample in data:
-        assert 'sample_rate' in sample
-        assert 'wav' in sample
         assert 'key' in sample
         assert 'label' in sample
+        if 'feat' in sample:  # loaded from feat cache
+            yield dict(key=sample['key'], label=sample['label'],
+                       feat=sample['feat'])
+            continue
+        assert 'sample_rate' in sample
+        assert 'wav' in sample
         sample_rate = sample['sample_rate']
         waveform = sample['wav']
         waveform = waveform * (1 << 15)
@@ -279,7 +562,35 @@ def compute_fbank(data,
                           dither=dither,
                           energy_floor=0.0,
                           sample_frequency=sample_rate)
-        yield dict(key=sample['key'], label=sample['label'], feat=mat)
+        yield __keep_feat_cache(
+            sample, dict(key=sample['key'], label=sample['label'], feat=mat))
+
+
+def wav_for_batch_fbank(data, frame_length=25, frame_shift=10):
+    """ Keep the waveform as `feat` for BatchFbank, which computes fbank of
+        the padded batch on the training device, and the number of fbank
+        frames for sort and batch.
+
+        Args:
+            data: Iterable[{key, wav, label, sample_rate}]
+
+        Returns:
+            Iterable[{key, feat, label, num_frames}], feat is (num_samples,)
+    """
+    for sample in data:
+        assert 'sample_rate' in sample
+        assert 'wav' in sample
+        assert 'key' in sample
+        assert 'label' in sample
+        sample_rate = sample['sample_rate']
+        waveform = sample['wav'][0]
+        window_size = int(sample_rate * frame_length * 0.001)
+        window_shift = int(sample_rate * frame_shift * 0.001)
+        num_frames = 0
+        if waveform.size(0) >= window_size:
+            num_frames = (waveform.size(0) - window_size) // window_shift + 1
+        yield dict(key=sample['key'], label=sample['label'], feat=waveform,
+                   num_frames=num_frames)
 
 
 def compute_mfcc(data,
@@ -299,10 +610,14 @@ def compute_mfcc(data,
             Iterable[{key, feat, label}]
     """
     for sample in data:
-        assert 'sample_rate' in sample
-        assert 'wav' in sample
         assert 'key' in sample
         assert 'label' in sample
+        if 'feat' in sample:  # loaded from feat cache
+            yield dict(key=sample['key'], label=sample['label'],
+                       feat=sample['feat'])
+            continue
+        assert 'sample_rate' in sample
+        assert 'wav' in sample
         sample_rate = sample['sample_rate']
         waveform = sample['wav']
         waveform = waveform * (1 << 15)
@@ -316,7 +631,112 @@ def compute_mfcc(data,
                          high_freq=high_freq,
                          low_freq=low_freq,
                          sample_frequency=sample_rate)
-        yield dict(key=sample['key'], label=sample['label'], feat=mat)
+        yield __keep_feat_cache(
+            sample, dict(key=sample['key'], label=sample['label'], feat=mat))
+
+
+def feat_cache_dir(cache_root, feat_conf):
+    """ Get the feature cache directory of a feature config, so caches of
+        different feature configs never mix up
+
+        Args:
+            cache_root(str): root directory of feature cache
+            feat_conf(Dict): everything affecting the feature, such as
+                feats_type, fbank_conf/mfcc_conf and resample_conf
+
+        Returns:
+            str: cache directory
+    """
+    conf_str = json.dumps(feat_conf, sort_keys=True)
+    conf_hash = hashlib.md5(conf_str.encode('utf8')).hexdigest()[:16]
+    return os.path.join(cache_root, conf_hash)
+
+
+def __feat_cache_path(cache_dir, src, key):
+    """ Cache path of the utterance `key` of the audio source `src`, which
+        identifies the audio, such as the wav file with its segment, size
+        and mtime, so utterances of different data sharing a key, or
+        re-segmented audio, never share features. Without extension.
+    """
+    key_hash = hashlib.md5('{}\t{}'.format(src, key).encode('utf8'))
+    key_hash = key_hash.hexdigest()
+    return os.path.join(cache_dir, key_hash[:2], key_hash)
+
+
+def __load_feat_cache(example, cache_dir, src, key):
+    """ Load the cached feature of an utterance by memory mapping, along
+        with the length of its audio for filter, so the audio needn't be
+        decoded. Otherwise the utterance is marked to be cached by
+        save_feat_cache.
+        Inplace operation.
+
+        Returns:
+            bool: whether the feature is cached
+    """
+    path = __feat_cache_path(cache_dir, src, key)
+    if os.path.exists(path + '.npy'):
+        try:
+            with open(path + '.json', 'r', encoding='utf8') as fin:
+                info = json.load(fin)
+            # copy-on-write mapping, only the touched pages are read
+            mat = np.load(path + '.npy', mmap_mode='c')
+            example['feat'] = torch.from_numpy(mat)
+            example['num_samples'] = info['num_samples']
+            example['sample_rate'] = info['sample_rate']
+            return True
+        except Exception as ex:
+            logging.warning('Failed to load feat cache {}'.format(path))
+    example['feat_cache'] = dict(path=path)
+    return False
+
+
+def __set_audio(example, waveform, sample_rate):
+    """ Set the decoded audio of an example, and keep its length for the
+        feature cache
+    """
+    example['wav'] = waveform
+    example['sample_rate'] = sample_rate
+    if 'feat_cache' in example:
+        example['feat_cache'].update(num_samples=waveform.size(1),
+                                     sample_rate=sample_rate)
+
+
+def __keep_feat_cache(sample, new_sample):
+    """ Keep the feature cache mark of sample for save_feat_cache
+    """
+    if 'feat_cache' in sample:
+        new_sample['feat_cache'] = sample['feat_cache']
+    return new_sample
+
+
+def save_feat_cache(data):
+    """ Save feature of samples which are not cached yet, they are marked
+        by the readers when the feature cache is enabled
+
+        Args:
+            data: Iterable[{key, feat, label, feat_cache}]
+
+        Returns:
+            Iterable[{key, feat, label}]
+    """
+    for sample in data:
+        assert 'feat' in sample
+        info = sample.pop('feat_cache', None)
+        if info is not None and 'num_samples' in info:
+            path = info.pop('path')
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # write to tmp files first, other workers may read them,
+                # and the feature last, which marks the cache complete
+                tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+                with open(tmp_path + '.json', 'w', encoding='utf8') as fout:
+                    json.dump(info, fout)
+                os.replace(tmp_path + '.json', path + '.json')
+                np.save(tmp_path + '.npy', sample['feat'].numpy())
+                os.replace(tmp_path + '.npy', path + '.npy')
+            except Exception as ex:
+                logging.warning('Failed to save feat cache {}'.format(path))
+        yield sample
 
 
 def __tokenize_by_bpe_model(sp, txt):
@@ -520,6 +940,14 @@ def shuffle(data, shuffle_size=10000):
         yield x
 
 
+def __num_frames(sample):
+    """ Number of feature frames of a sample, see wav_for_batch_fbank
+    """
+    if 'num_frames' in sample:
+        return sample['num_frames']
+    return sample['feat'].size(0)
+
+
 def sort(data, sort_size=500):
     """ Sort the data by feature length.
         Sort is used after shuffle and before batch, so we can group
@@ -538,12 +966,12 @@ def sort(data, sort_size=500):
     for sample in data:
         buf.append(sample)
         if len(buf) >= sort_size:
-            buf.sort(key=lambda x: x['feat'].size(0))
+            buf.sort(key=lambda x: __num_frames(x))
             for x in buf:
                 yield x
             buf = []
     # The sample left over
-    buf.sort(key=lambda x: x['feat'].size(0))
+    buf.sort(key=lambda x: __num_frames(x))
     for x in buf:
         yield x
 
@@ -584,7 +1012,7 @@ def dynamic_batch(data, max_frames_in_batch=12000):
     for sample in data:
         assert 'feat' in sample
         assert isinstance(sample['feat'], torch.Tensor)
-        new_sample_frames = sample['feat'].size(0)
+        new_sample_frames = __num_frames(sample)
         longest_frames = max(longest_frames, new_sample_frames)
         frames_after_padding = longest_frames * (len(buf) + 1)
         if frames_after_padding > max_frames_in_batch:
@@ -597,13 +1025,114 @@ def dynamic_batch(data, max_frames_in_batch=12000):
         yield buf
 
 
-def batch(data, batch_type='static', batch_size=16, max_frames_in_batch=12000):
-    """ Wrapper for static/dynamic batch
+@lru_cache(maxsize=4)
+def __bucket_boundaries(durations_file, num_buckets, frame_shift):
+    """ Frame boundaries of `num_buckets` equally populated buckets
+        according to the utterance durations (in seconds) in
+        `durations_file`, which is in the format of `key duration` per line
+        as generated by tools/wav2dur.py, or the json lines manifest
+        generated by tools/make_shard_list.py, where unknown durations are
+        null and skipped
+    """
+    frames = []
+    with open(durations_file, 'r', encoding='utf8') as fin:
+        for line in fin:
+            if line.startswith('{'):
+                duration = json.loads(line)['duration']
+                if duration is None:
+                    continue
+            else:
+                arr = line.strip().split()
+                if len(arr) != 2:
+                    continue
+                duration = float(arr[1])
+            frames.append(duration * 1000 / frame_shift)
+    assert len(frames) > 0
+    quantiles = np.quantile(frames, np.linspace(0, 1, num_buckets + 1)[1:-1])
+    return sorted(set(int(math.ceil(x)) for x in quantiles))
+
+
+def bucket_batch(data,
+                 max_frames_in_batch=12000,
+                 bucket_boundaries=None,
+                 durations_file=None,
+                 num_buckets=30,
+                 frame_shift=10):
+    """ Put the data into buckets of similar lengths, and a bucket is
+        batched when its padded frames would exceed `max_frames_in_batch`,
+        so there is much less padding than sort + dynamic batch.
+
+        Args:
+            data: Iterable[{key, feat, label}]
+            max_frames_in_batch: max padded frames in one batch
+            bucket_boundaries: upper frame bounds of the buckets
+            durations_file: durations of the utterances to compute
+                `num_buckets` equally populated buckets when
+                `bucket_boundaries` is not given
+            num_buckets: number of buckets from `durations_file`
+            frame_shift: frame shift in ms of the feature
+
+        Returns:
+            Iterable[List[{key, feat, label}]]
+    """
+    if bucket_boundaries is None:
+        if durations_file is not None:
+            bucket_boundaries = __bucket_boundaries(durations_file,
+                                                    num_buckets, frame_shift)
+        else:
+            # 5% wider each bucket, from 0.5s to 60s for 10ms frame shift
+            bucket_boundaries = [int(50 * 1.05**i) for i in range(99)]
+    bucket_boundaries = sorted(bucket_boundaries)
+    buckets = [[] for _ in range(len(bucket_boundaries) + 1)]
+    longest = [0] * len(buckets)
+    real_frames, padded_frames, num_batches = 0, 0, 0
+    for sample in data:
+        assert 'feat' in sample
+        assert isinstance(sample['feat'], torch.Tensor)
+        new_sample_frames = __num_frames(sample)
+        i = bisect.bisect_left(bucket_boundaries, new_sample_frames)
+        longest_frames = max(longest[i], new_sample_frames)
+        if longest_frames * (len(buckets[i]) + 1) > max_frames_in_batch \
+                and len(buckets[i]) > 0:
+            real_frames += sum(__num_frames(x) for x in buckets[i])
+            padded_frames += longest[i] * len(buckets[i])
+            num_batches += 1
+            yield buckets[i]
+            buckets[i] = [sample]
+            longest[i] = new_sample_frames
+        else:
+            buckets[i].append(sample)
+            longest[i] = longest_frames
+    # The buckets left over
+    for i, buf in enumerate(buckets):
+        if len(buf) > 0:
+            real_frames += sum(__num_frames(x) for x in buf)
+            padded_frames += longest[i] * len(buf)
+            num_batches += 1
+            yield buf
+    if padded_frames > 0:
+        logging.info('bucket_batch: {} batches, padding efficiency '
+                     '{:.2f}%'.format(num_batches,
+                                      100.0 * real_frames / padded_frames))
+
+
+def batch(data,
+          batch_type='static',
+          batch_size=16,
+          max_frames_in_batch=12000,
+          **bucket_conf):
+    """ Wrapper for static/dynamic/bucket batch, `bucket_conf` is only for
+        bucket batch
     """
+    if batch_type != 'bucket' and len(bucket_conf) > 0:
+        raise ValueError('Unsupported {} for {} batch'.format(
+            ', '.join(sorted(bucket_conf)), batch_type))
     if batch_type == 'static':
         return static_batch(data, batch_size)
     elif batch_type == 'dynamic':
         return dynamic_batch(data, max_frames_in_batch)
+    elif batch_type == 'bucket':
+        return bucket_batch(data, max_frames_in_batch, **bucket_conf)
     else:
         logging.fatal('Unsupported batch type {}'.format(batch_type))
 
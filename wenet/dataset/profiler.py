@@ -0,0 +1,250 @@
+# Copyright (c) 2021 Mobvoi Inc. (authors: Binbin Zhang)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import glob
+import json
+import os
+import time
+
+import torch
+import torch.distributed as dist
+
+
+def _read_bytes():
+    """ Bytes read by the process so far, None if it is not available
+    """
+    try:
+        with open('/proc/self/io', 'r') as fin:
+            for line in fin:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _batch_key(item):
+    """ First utterance key of a batch made by `padding`, None for other
+        items
+    """
+    try:
+        return item[0][0]
+    except (TypeError, IndexError, KeyError):
+        return None
+
+
+class StageProfiler:
+    """ Collect the time and number of items of every stage of a
+        Processor chain in the current process (DataLoader worker).
+
+        A stage pulls from its source inside its own `next`, so the
+        measured time of a stage includes all its upstream stages, the
+        time of the stage itself is obtained by subtracting the time of
+        its source in `stats`.
+
+        Every item output by the last stage appends one record of the
+        stats so far to {profile_dir}/rank{rank}_worker{id}.jsonl, tagged
+        by the key of the item. The DataLoader prefetches items the
+        trainer may never consume, `merge_stats` uses the keys to only
+        count the consumed ones.
+
+        Records are buffered and appended every `dump_interval` items and
+        when the iteration ends. A worker terminated while iterating loses
+        its buffered records, so `dump_interval=1` is the exact setting,
+        it costs one line appended to the same file per item.
+    """
+    def __init__(self, profile_dir=None, dump_interval=10):
+        if dump_interval < 1:
+            raise ValueError(
+                'dump_interval should be >= 1, got {}'.format(dump_interval))
+        self.profile_dir = profile_dir
+        self.dump_interval = dump_interval
+        self.stages = []
+        self.counts = {}
+        self.times = {}
+        self.start_time = None
+        self.start_bytes = None
+        self.records = []
+
+    def wrap(self, name, it):
+        """ Return an iterator over `it` which records the time spent
+            to get every item from it.
+        """
+        # Stages are wrapped from the source to the last one, stats are
+        # accumulated over epochs
+        if name not in self.counts:
+            self.stages.append(name)
+            self.counts[name] = 0
+            self.times[name] = 0.0
+        if self.start_time is None:
+            self.start_time = time.time()
+            self.start_bytes = _read_bytes()
+        return self._profile(name, it)
+
+    def _profile(self, name, it):
+        last = name == self.stages[-1]
+        try:
+            while True:
+                begin = time.perf_counter()
+                try:
+                    item = next(it)
+                except StopIteration:
+                    self.times[name] += time.perf_counter() - begin
+                    break
+                self.times[name] += time.perf_counter() - begin
+                self.counts[name] += 1
+                if last:
+                    self.record(_batch_key(item))
+                    if len(self.records) >= self.dump_interval:
+                        self.dump()
+                yield item
+        finally:
+            if last:
+                # the end of the iteration, key None
+                self.record(None)
+                self.dump()
+
+    def stats(self):
+        """ Returns:
+                dict: stats of the stages in pipeline order and the bytes
+                    read since the first stage starts
+        """
+        stages = []
+        upstream = 0.0
+        for name in self.stages:
+            total = self.times[name]
+            stages.append(
+                dict(name=name,
+                     count=self.counts[name],
+                     total_time=total,
+                     time=max(total - upstream, 0.0)))
+            upstream = total
+        end_bytes = _read_bytes()
+        bytes_read = None
+        if end_bytes is not None and self.start_bytes is not None:
+            bytes_read = end_bytes - self.start_bytes
+        elapsed = 0.0
+        if self.start_time is not None:
+            elapsed = time.time() - self.start_time
+        return dict(stages=stages, bytes_read=bytes_read, elapsed=elapsed)
+
+    def record(self, key):
+        """ Buffer the stats so far, tagged by the key of the last item
+        """
+        if self.profile_dir is None:
+            return
+        stats = self.stats()
+        stats['key'] = key
+        self.records.append(stats)
+
+    def dump(self):
+        """ Append the buffered records to
+            {profile_dir}/rank{rank}_worker{id}.jsonl
+        """
+        if self.profile_dir is None or len(self.records) == 0:
+            return
+        rank = dist.get_rank() if dist.is_available() and \
+            dist.is_initialized() else 0
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id = 0 if worker_info is None else worker_info.id
+        path = os.path.join(self.profile_dir,
+                            'rank{}_worker{}.jsonl'.format(rank, worker_id))
+        with open(path, 'a', encoding='utf8') as fout:
+            for x in self.records:
+                fout.write(json.dumps(x) + '\n')
+        self.records = []
+
+
+def profile(dataset, profile_dir=None, dump_interval=10):
+    """ Instrument every Processor stage of `dataset` built by
+        `wenet.dataset.dataset.Dataset`
+
+        Every DataLoader worker gets its own copy of the profiler, and
+        appends its stats to `profile_dir` every `dump_interval` output
+        items and when the iteration ends, see `StageProfiler`. The stats
+        left in `profile_dir` by previous runs of the current rank are
+        removed.
+
+        Returns:
+            StageProfiler: the profiler of the current process
+    """
+    if profile_dir is not None:
+        os.makedirs(profile_dir, exist_ok=True)
+        rank = dist.get_rank() if dist.is_available() and \
+            dist.is_initialized() else 0
+        pattern = os.path.join(profile_dir, 'rank{}_worker*.json*'.format(rank))
+        for path in glob.glob(pattern):
+            os.remove(path)
+    profiler = StageProfiler(profile_dir, dump_interval)
+    stage = dataset
+    while hasattr(stage, 'f'):
+        stage.profiler = profiler
+        stage = stage.source
+    return profiler
+
+
+def _last_record(path, consumed=None):
+    """ The stats of a worker at its last consumed item, None if none of
+        its items is consumed
+    """
+    last = None
+    with open(path, 'r', encoding='utf8') as fin:
+        for line in fin:
+            record = json.loads(line)
+            if consumed is None or record['key'] in consumed:
+                last = record
+            elif record['key'] is not None:
+                # the items of a worker are consumed in order, the rest
+                # were prefetched only
+                break
+            elif last is not None:
+                # all the items are consumed, count the end of the epoch
+                last = record
+    return last
+
+
+def merge_stats(profile_dir, consumed=None):
+    """ Merge the stats dumped by all the workers in `profile_dir`
+
+        Args:
+            consumed (set): keys of the first utterance of the batches the
+                trainer consumed, the stats of batches which are only
+                prefetched by the DataLoader are not counted. None to
+                count all the batches.
+
+        Returns:
+            dict: merged stats, time and count are summed over workers
+    """
+    merged = None
+    num_workers = 0
+    for path in sorted(glob.glob(os.path.join(profile_dir, '*.jsonl'))):
+        stats = _last_record(path, consumed)
+        if stats is None:
+            continue
+        stats.pop('key')
+        num_workers += 1
+        if merged is None:
+            merged = stats
+            continue
+        for x, y in zip(merged['stages'], stats['stages']):
+            for k in ['count', 'total_time', 'time']:
+                x[k] += y[k]
+        if merged['bytes_read'] is None or stats['bytes_read'] is None:
+            merged['bytes_read'] = None
+        else:
+            merged['bytes_read'] += stats['bytes_read']
+        merged['elapsed'] = max(merged['elapsed'], stats['elapsed'])
+    if merged is not None:
+        merged['num_workers'] = num_workers
+    return merged
@@ -20,13 +20,13 @@ from typing import Dict, Optional, Tuple
 import torch
 
 from wenet.cif.predictor import MAELoss
-from wenet.paraformer.search.beam_search import Hypothesis
+from wenet.paraformer.search.beam_search import BatchBeamSearchCIF, \
+    Hypothesis
 from wenet.transformer.asr_model import ASRModel
 from wenet.transformer.ctc import CTC
 from wenet.transformer.decoder import TransformerDecoder
 from wenet.transformer.encoder import TransformerEncoder
 from wenet.utils.common import (IGNORE_ID, add_sos_eos, th_accuracy)
-from wenet.utils.mask import make_pad_mask
 
 
 class Paraformer(ASRModel):
@@ -149,9 +149,6 @@ class Paraformer(ASRModel):
 
     def calc_predictor(self, encoder_out, encoder_mask):
 
-        encoder_mask = (~make_pad_mask(
-            encoder_mask, max_len=encoder_out.size(1))[:, None, :]).to(
-                encoder_out.device)
         pre_acoustic_embeds, pre_token_length, alphas, pre_peak_index = \
             self.predictor(
                 encoder_out, None,
@@ -159,10 +156,10 @@ class Paraformer(ASRModel):
                 ignore_id=self.ignore_id)
         return pre_acoustic_embeds, pre_token_length, alphas, pre_peak_index
 
-    def cal_decoder_with_predictor(self, encoder_out, encoder_out_lens,
+    def cal_decoder_with_predictor(self, encoder_out, encoder_mask,
                                    sematic_embeds, ys_pad_lens):
 
-        decoder_out, _, _ = self.decoder(encoder_out, encoder_out_lens,
+        decoder_out, _, _ = self.decoder(encoder_out, encoder_mask,
                                          sematic_embeds, ys_pad_lens)
         decoder_out = torch.log_softmax(decoder_out, dim=-1)
         return decoder_out, ys_pad_lens
@@ -216,7 +213,7 @@ class Paraformer(ASRModel):
             return torch.tensor([]), torch.tensor([])
         # 2. Decoder forward
         decoder_outs = self.cal_decoder_with_predictor(encoder_out,
-                                                       encoder_out_lens,
+                                                       encoder_mask,
                                                        pre_acoustic_embeds,
                                                        pre_token_length)
         decoder_out, ys_pad_lens = decoder_outs[0], decoder_outs[1]
@@ -298,16 +295,26 @@ class Paraformer(ASRModel):
             return torch.tensor([]), torch.tensor([])
         # 2. Decoder forward
         decoder_outs = self.cal_decoder_with_predictor(encoder_out,
-                                                       encoder_out_lens,
+                                                       encoder_mask,
                                                        pre_acoustic_embeds,
                                                        pre_token_length)
         decoder_out, ys_pad_lens = decoder_outs[0], decoder_outs[1]
         hyps = []
         b, n, d = decoder_out.size()
+        if isinstance(beam_search, BatchBeamSearchCIF):
+            # all the utterances are searched at once
+            batch_nbest = beam_search(x=encoder_out,
+                                      x_lens=encoder_out_lens,
+                                      am_scores=decoder_out,
+                                      am_lens=pre_token_length)
         for i in range(b):
             x = encoder_out[i, :encoder_out_lens[i], :]
             am_scores = decoder_out[i, :pre_token_length[i], :]
-            if beam_search is not None:
+            if isinstance(beam_search, BatchBeamSearchCIF):
+                nbest_hyps = batch_nbest[i][:1]
+                if len(nbest_hyps) == 0:
+                    hyps.append([])
+            elif beam_search is not None:
                 nbest_hyps = beam_search(x=x, am_scores=am_scores)
                 nbest_hyps = nbest_hyps[:1]
             else:
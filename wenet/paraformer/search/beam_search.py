@@ -25,7 +25,7 @@ import torch
 from wenet.paraformer.utils import end_detect
 from wenet.paraformer.search.ctc import CTCPrefixScorer
 from wenet.paraformer.search.scorer_interface import ScorerInterface, \
-    PartialScorerInterface
+    PartialScorerInterface, BatchScorerInterface, BatchPartialScorerInterface
 
 
 class Hypothesis(NamedTuple):
@@ -447,6 +447,138 @@ class BeamSearchCIF(torch.nn.Module):
         return remained_hyps
 
 
+class BatchBeamSearchCIF(BeamSearchCIF):
+    """Beam search over a batch of utterances.
+
+    The running hypotheses of all utterances are kept as tensors of
+    `(batch * beam)` rows, they are scored by one call of every scorer at
+    each step, and pruned by one topk over `(beam * n_vocab)` candidates of
+    every utterance. The partial scorers must keep batched states which are
+    selected by `index_select_state`, e.g. CTCPrefixScorer.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        for k, v in self.full_scorers.items():
+            assert isinstance(v, BatchScorerInterface), \
+                f"{k} ({type(v)}) does not implement BatchScorerInterface"
+        for k, v in self.part_scorers.items():
+            assert isinstance(v, BatchPartialScorerInterface) and \
+                hasattr(v, "index_select_state"), \
+                f"{k} ({type(v)}) does not support batched states"
+
+    def forward(
+            self, x: torch.Tensor, x_lens: torch.Tensor,
+            am_scores: torch.Tensor, am_lens: torch.Tensor,
+            maxlenratio: float = 0.0
+    ) -> List[List[Hypothesis]]:
+        """Perform beam search for a batch of utterances.
+
+        Args:
+            x (torch.Tensor): Encoded speech feature (B, T, D)
+            x_lens (torch.Tensor): (B,)
+            am_scores (torch.Tensor): Decoder log probs (B, L, n_vocab)
+            am_lens (torch.Tensor): Number of tokens of every utterance,
+                the search of an utterance ends at its own length (B,)
+            maxlenratio (float): If maxlenratio=0.0 (default), it uses a
+                end-detect function to stop an utterance before am_lens
+
+        Returns:
+            List[List[Hypothesis]]: N-best decoding results of every
+                utterance
+
+        """
+        device = x.device
+        batch_size = x.size(0)
+        n_hyps = self.beam_size
+        # (B * beam, i + 1), (B, beam), all hyps start from the same sos
+        # but only the first one is alive
+        yseq = torch.full((batch_size * n_hyps, 1), self.sos,
+                          dtype=torch.long, device=device)
+        score = torch.full((batch_size, n_hyps), -float("inf"),
+                           dtype=x.dtype, device=device)
+        score[:, 0] = 0.0
+        states = dict()
+        for k, d in self.full_scorers.items():
+            states[k] = [d.init_state(x[b, :x_lens[b]])
+                         for b in range(batch_size) for _ in range(n_hyps)]
+        for k, d in self.part_scorers.items():
+            states[k] = d.batch_init_state(x, x_lens)
+        am_lens = am_lens.to(device)
+        finished = am_lens < 1
+        ended_hyps = [[] for _ in range(batch_size)]
+        for i in range(am_scores.size(1)):
+            if bool(finished.all()):
+                break
+            # 1. score all the running hyps of all utterances at once
+            weighted_scores = am_scores[:, i].repeat_interleave(n_hyps, 0)
+            scores = dict()
+            if len(self.full_scorers) > 0:
+                xs = x.repeat_interleave(n_hyps, 0)
+            for k, d in self.full_scorers.items():
+                scores[k], states[k] = d.batch_score(yseq, states[k], xs)
+                weighted_scores = weighted_scores + \
+                    self.weights[k] * scores[k]
+            part_ids = None
+            if self.do_pre_beam:
+                pre_beam_scores = (
+                    weighted_scores
+                    if self.pre_beam_score_key == "full"
+                    else scores[self.pre_beam_score_key]
+                )
+                part_ids = torch.topk(pre_beam_scores, self.pre_beam_size)[1]
+            part_states = dict()
+            for k, d in self.part_scorers.items():
+                # tokens pruned in pre-beam get a logzero score
+                part_score, part_states[k] = d.batch_score_partial(
+                    yseq, part_ids, states[k], x)
+                weighted_scores = weighted_scores + \
+                    self.weights[k] * part_score
+            weighted_scores = weighted_scores + score.view(-1, 1)
+
+            # 2. prune (n_hyps * n_vocab) -> beam for every utterance
+            score, best_ids = weighted_scores.view(batch_size, -1).topk(
+                self.beam_size, dim=1)  # (B, beam)
+            prev_ids = torch.div(best_ids, self.n_vocab,
+                                 rounding_mode='floor')
+            token_ids = best_ids % self.n_vocab
+            prev_ids = (prev_ids + torch.arange(
+                batch_size, device=device).unsqueeze(1) * n_hyps).view(-1)
+            yseq = torch.cat([yseq[prev_ids], token_ids.view(-1, 1)], dim=1)
+            prev_ids = prev_ids.tolist()
+            for k in self.full_scorers:
+                states[k] = [states[k][j] for j in prev_ids]
+            for k, d in self.part_scorers.items():
+                states[k] = d.index_select_state(part_states[k], best_ids)
+
+            # 3. move ended hyps out of the beam, eos is appended to all the
+            # running hyps at the last step of an utterance
+            last = am_lens - 1 == i
+            ended = (token_ids == self.eos) | last.unsqueeze(1)
+            ended &= ~finished.unsqueeze(1) & torch.isfinite(score)
+            for b, w in ended.nonzero().tolist():
+                j = b * n_hyps + w
+                hyp = Hypothesis(yseq=yseq[j], score=score[b, w])
+                if bool(last[b]):
+                    hyp = hyp._replace(
+                        yseq=self.append_token(hyp.yseq, self.eos))
+                for k, d in self.full_scorers.items():
+                    s = d.final_score(states[k][j])
+                    hyp = hyp._replace(score=hyp.score + self.weights[k] * s)
+                ended_hyps[b].append(hyp)
+            finished |= last
+            if maxlenratio == 0.0:
+                for b in range(batch_size):
+                    if not finished[b] and end_detect(
+                            [h.asdict() for h in ended_hyps[b]], i):
+                        finished[b] = True
+            score = score.masked_fill(ended | finished.unsqueeze(1),
+                                      -float("inf"))
+
+        return [sorted(hyps, key=lambda x: x.score, reverse=True)
+                for hyps in ended_hyps]
+
+
 def build_beam_search(model, args, device):
     scorers = {}
     if model.ctc is not None:
@@ -457,7 +589,7 @@ def build_beam_search(model, args, device):
         ctc=args.ctc_weight,
         length_bonus=args.penalty,
     )
-    beam_search = BeamSearchCIF(
+    beam_search = BatchBeamSearchCIF(
         beam_size=args.beam_size,
         weights=weights,
         scorers=scorers,
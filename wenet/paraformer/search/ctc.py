@@ -100,18 +100,24 @@ class CTCPrefixScorer(BatchPartialScorerInterface):
         )
         return tscore, (presub_score, new_st)
 
-    def batch_init_state(self, x: torch.Tensor):
+    def batch_init_state(self, x: torch.Tensor, xlens: torch.Tensor = None):
         """Get an initial state for decoding.
 
         Args:
-            x (torch.Tensor): The encoded feature tensor
+            x (torch.Tensor): The encoded feature tensor, (T, D) or
+                (B, T, D) for a batch of utterances
+            xlens (torch.Tensor): The lengths of x if it is batched, (B,)
 
         Returns: initial state
 
         """
-        logp = self.ctc.log_softmax(x.unsqueeze(0))  # assuming batch_size = 1
-        xlen = torch.tensor([logp.size(1)])
-        self.impl = CTCPrefixScoreTH(logp, xlen, 0, self.eos)
+        if x.dim() == 2:
+            x = x.unsqueeze(0)  # assuming batch_size = 1
+        logp = self.ctc.log_softmax(x)
+        if xlens is None:
+            xlens = torch.full((logp.size(0),), logp.size(1),
+                               dtype=torch.long)
+        self.impl = CTCPrefixScoreTH(logp, xlens, 0, self.eos)
         return None
 
     def batch_score_partial(self, y, ids, state, x):
@@ -120,7 +126,9 @@ class CTCPrefixScorer(BatchPartialScorerInterface):
         Args:
             y (torch.Tensor): 1D prefix token
             ids (torch.Tensor): torch.int64 next token to score
-            state: decoder state for prefix tokens
+            state: decoder state for prefix tokens, a list of the states
+                of every hypothesis, or the batched state returned by
+                `index_select_state`
             x (torch.Tensor): 2D encoder feature that generates ys
 
         Returns:
@@ -129,17 +137,32 @@ class CTCPrefixScorer(BatchPartialScorerInterface):
                 `(len(next_tokens),)` and next state for ys
 
         """
-        batch_state = (
-            (
-                torch.stack([s[0] for s in state], dim=2),
-                torch.stack([s[1] for s in state]),
-                state[0][2],
-                state[0][3],
+        if isinstance(state, list):
+            state = (
+                (
+                    torch.stack([s[0] for s in state], dim=2),
+                    torch.stack([s[1] for s in state]),
+                    state[0][2],
+                    state[0][3],
+                )
+                if state[0] is not None
+                else None
             )
-            if state[0] is not None
-            else None
-        )
-        return self.impl(y, batch_state, ids)
+        return self.impl(y, state, ids)
+
+    def index_select_state(self, state, best_ids):
+        """Select the batched states of the best hypotheses.
+
+        Args:
+            state: batched state returned by `batch_score_partial`
+            best_ids (torch.Tensor): ids in the flattened (n_hyps * odim)
+                space of every utterance, (B, W)
+
+        Returns:
+            state: batched state of the B * W selected hypotheses
+
+        """
+        return self.impl.index_select_state(state, best_ids)
 
     def extend_prob(self, x: torch.Tensor):
         """Extend probs for decoding.
@@ -1,7 +1,11 @@
-from typing import List
+from typing import Any, Dict, List, Optional, Tuple
 
 import torch
 
+from wenet.transducer.search.predictor_cache import (INIT_PREFIX_KEY,
+                                                     PredictorCache,
+                                                     extend_prefix_key)
+
 
 def basic_greedy_search(
     model: torch.nn.Module,
@@ -52,3 +56,106 @@ def basic_greedy_search(
             per_frame_noblk = 0
 
     return [hyps]
+
+
+def batch_greedy_search(
+    model: torch.nn.Module,
+    encoder_out: torch.Tensor,
+    encoder_out_lens: torch.Tensor,
+    max_symbols_per_frame: int = 64,
+    state: Optional[Dict[str, Any]] = None,
+    predictor_cache: Optional[PredictorCache] = None,
+) -> Tuple[List[List[int]], Dict[str, Any]]:
+    """ Frame synchronous greedy search of a padded batch
+
+    All the utterances step through the frames together, at every frame
+    the joint network runs on the whole batch up to `max_symbols_per_frame`
+    times, and stops once every utterance emits blank. The predictor
+    only advances for the utterances which emit a non-blank token.
+
+    The search can run chunk by chunk, pass the returned state to the call
+    of the next chunk of encoder output.
+
+    Args:
+        encoder_out (torch.Tensor): [B, T, E]
+        encoder_out_lens (torch.Tensor): [B], number of valid frames of
+            this chunk
+        max_symbols_per_frame (int): max non-blank tokens of a frame
+        state (Dict[str, Any]): state returned by the previous chunk, None
+            for the first chunk
+        predictor_cache (PredictorCache): if given, predictor steps are
+            looked up by the prefix before running the predictor
+
+    Returns:
+        List[List[int]]: best path of every utterance so far
+        Dict[str, Any]: state for the next chunk
+    """
+    batch_size = encoder_out.size(0)
+    device = encoder_out.device
+    if state is None:
+        # predictor output and cache after sos(blank)
+        cache = model.predictor.init_state(batch_size,
+                                           method="zero",
+                                           device=device)
+        pred_input = torch.full((batch_size, 1),
+                                model.blank,
+                                dtype=torch.long,
+                                device=device)
+        keys = [INIT_PREFIX_KEY] * batch_size
+        pred_out, cache = _predictor_step(model.predictor, predictor_cache,
+                                          keys, pred_input, cache)
+        state = {
+            "pred_out": pred_out,
+            "cache": cache,
+            "hyps": [[] for _ in range(batch_size)],
+            "keys": keys
+        }
+    pred_out, cache = state["pred_out"], state["cache"]
+    hyps, keys = state["hyps"], state["keys"]
+    encoder_out_lens = encoder_out_lens.to(device)
+
+    for t in range(encoder_out.size(1)):
+        encoder_out_step = encoder_out[:, t:t + 1, :]  # [B, 1, E]
+        active = encoder_out_lens > t  # [B]
+        for _ in range(max_symbols_per_frame):
+            if not bool(active.any()):
+                break
+            joint_out_step = model.joint(encoder_out_step,
+                                         pred_out)  # [B, 1, 1, V]
+            best = joint_out_step.argmax(dim=-1).view(-1)  # [B]
+            emit = active & (best != model.blank)
+            if not bool(emit.any()):
+                break
+            index = emit.nonzero().view(-1).tolist()
+            for i in index:
+                hyps[i].append(int(best[i]))
+                keys[i] = extend_prefix_key(keys[i], hyps[i][-1])
+            # predictor forward for the utterances emitting non-blank,
+            # the others keep their caches
+            cache_list = model.predictor.batch_to_cache(cache)
+            step_out, step_cache = _predictor_step(
+                model.predictor, predictor_cache, [keys[i] for i in index],
+                best[index].unsqueeze(1),
+                model.predictor.cache_to_batch([cache_list[i]
+                                                for i in index]))
+            pred_out = pred_out.index_copy(
+                0, torch.tensor(index, device=device), step_out)
+            for i, c in zip(index,
+                            model.predictor.batch_to_cache(step_cache)):
+                cache_list[i] = c
+            cache = model.predictor.cache_to_batch(cache_list)
+            active = emit
+
+    state = {"pred_out": pred_out, "cache": cache, "hyps": hyps, "keys": keys}
+    return hyps, state
+
+
+def _predictor_step(
+    predictor: torch.nn.Module, predictor_cache: Optional[PredictorCache],
+    keys: List[Tuple[int, int, int]], input: torch.Tensor,
+    cache: List[torch.Tensor]
+) -> Tuple[torch.Tensor, List[torch.Tensor]]:
+    if predictor_cache is not None:
+        return predictor_cache.forward_step(predictor, keys, input, cache)
+    padding = torch.zeros(input.size(0), 1, device=input.device)
+    return predictor.forward_step(input, padding, cache)
@@ -0,0 +1,117 @@
+from collections import OrderedDict
+from typing import Hashable, List, Tuple
+
+import torch
+
+# Two rolling hashes of the prefixes, (hash * base + token + 1) % mod, a
+# prefix is keyed by both its hashes and its length
+HASH_BASES = [1000003, 999983]
+HASH_MODS = [2147483647, 2147483629]
+
+# key of the prefix which only has the initial blank
+INIT_PREFIX_KEY = (0, 0, 1)
+
+
+def extend_prefix_key(key: Tuple[int, int, int],
+                      token: int) -> Tuple[int, int, int]:
+    """ Key of the prefix `key` followed by `token`
+    """
+    return ((key[0] * HASH_BASES[0] + token + 1) % HASH_MODS[0],
+            (key[1] * HASH_BASES[1] + token + 1) % HASH_MODS[1], key[2] + 1)
+
+
+class PredictorCache():
+    """ Bounded LRU cache of predictor steps
+
+    The predictor output and state only depend on the label prefix, so
+    they are cached by the key of the prefix (see `extend_prefix_key`) and
+    shared by all the hypotheses, frames and utterances. The entries are
+    dropped once the predictor weights change (loaded or updated in place),
+    and the cache is bypassed in train mode, where dropout makes the steps
+    random.
+    """
+
+    def __init__(self, max_size: int = 4096):
+        self.max_size = max_size
+        self.entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.weights_version: Tuple = ()
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+        self.weights_version = ()
+
+    @staticmethod
+    def get_weights_version(predictor: torch.nn.Module) -> Tuple:
+        """ Changes whenever a weight of predictor is replaced or modified
+            in place, by load_state_dict, an optimizer step or `to`
+        """
+        return tuple((id(p), p.data_ptr(), p._version)
+                     for p in list(predictor.parameters()) +
+                     list(predictor.buffers()))
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def forward_step(
+        self, predictor: torch.nn.Module, keys: List[Hashable],
+        input: torch.Tensor, cache: List[torch.Tensor]
+    ) -> Tuple[torch.Tensor, List[torch.Tensor]]:
+        """ predictor.forward_step of a batch, only the prefixes not cached
+            are forwarded
+
+        Args:
+            keys (List[Hashable]): keys of the prefixes ending with input
+            input (torch.Tensor): [batch_size, 1], last token of prefixes
+            cache: batched predictor state before input
+
+        Returns:
+            torch.Tensor: predictor output, [batch_size, 1, P]
+            List[torch.Tensor]: batched predictor state after input
+        """
+        if predictor.training:
+            padding = torch.zeros(input.size(0), 1, device=input.device)
+            return predictor.forward_step(input, padding, cache)
+        weights_version = self.get_weights_version(predictor)
+        if weights_version != self.weights_version:
+            self.entries.clear()
+            self.weights_version = weights_version
+        outs: List = [None] * len(keys)
+        misses = []
+        # the same prefix of several utterances is forwarded only once
+        first_miss = {}
+        duplicates = []
+        for i, key in enumerate(keys):
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                outs[i] = entry
+            elif key in first_miss:
+                duplicates.append(i)
+            else:
+                first_miss[key] = i
+                misses.append(i)
+        self.hits += len(keys) - len(misses)
+        self.misses += len(misses)
+        if len(misses) > 0:
+            if len(misses) < len(keys):
+                cache_list = predictor.batch_to_cache(cache)
+                input = input[misses]
+                cache = predictor.cache_to_batch(
+                    [cache_list[i] for i in misses])
+            padding = torch.zeros(input.size(0), 1, device=input.device)
+            out, new_cache = predictor.forward_step(input, padding, cache)
+            for i, o, c in zip(misses, torch.split(out, 1, dim=0),
+                               predictor.batch_to_cache(new_cache)):
+                outs[i] = (o, c)
+                self.entries[keys[i]] = outs[i]
+                if len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+            for i in duplicates:
+                outs[i] = outs[first_miss[keys[i]]]
+        return (torch.cat([o[0] for o in outs], dim=0),
+                predictor.cache_to_batch([o[1] for o in outs]))
@@ -1,7 +1,10 @@
 from typing import List, Tuple
 
 import torch
-from wenet.utils.common import log_add
+from wenet.transducer.search.predictor_cache import (HASH_BASES, HASH_MODS,
+                                                     INIT_PREFIX_KEY,
+                                                     PredictorCache)
+from wenet.utils.ctc_util import ctc_blank_skip
 
 
 class Sequence():
@@ -21,23 +24,34 @@ class Sequence():
 
 class PrefixBeamSearch():
 
-    def __init__(self, encoder, predictor, joint, ctc, blank):
+    def __init__(self, encoder, predictor, joint, ctc, blank,
+                 predictor_cache_size: int = 4096):
         self.encoder = encoder
         self.predictor = predictor
         self.joint = joint
         self.ctc = ctc
         self.blank = blank
+        # predictor steps of prefixes, shared by hyps, frames and utterances
+        self.predictor_cache = PredictorCache(predictor_cache_size)
 
-    def forward_decoder_one_step(
-            self, encoder_x: torch.Tensor, pre_t: torch.Tensor,
+    def forward_predictor_step(
+            self, keys: List[Tuple[int, int, int]], pre_t: torch.Tensor,
             cache: List[torch.Tensor]
     ) -> Tuple[torch.Tensor, List[torch.Tensor]]:
-        padding = torch.zeros(pre_t.size(0), 1, device=encoder_x.device)
-        pre_t, new_cache = self.predictor.forward_step(pre_t.unsqueeze(-1),
-                                                       padding, cache)
-        x = self.joint(encoder_x, pre_t)  # [beam, 1, 1, vocab]
-        x = x.log_softmax(dim=-1)
-        return x, new_cache
+        return self.predictor_cache.forward_step(self.predictor, keys, pre_t,
+                                                 cache)
+
+    def _select_cache(self, cache: List[torch.Tensor],
+                      index: List[int]) -> List[torch.Tensor]:
+        cache_list = self.predictor.batch_to_cache(cache)
+        return self.predictor.cache_to_batch([cache_list[i] for i in index])
+
+    def _merge_cache(self, cache: List[torch.Tensor], index: List[int],
+                     new_cache: List[torch.Tensor]) -> List[torch.Tensor]:
+        cache_list = self.predictor.batch_to_cache(cache)
+        for i, c in zip(index, self.predictor.batch_to_cache(new_cache)):
+            cache_list[i] = c
+        return self.predictor.cache_to_batch(cache_list)
 
     def prefix_beam_search(self,
                            speech: torch.Tensor,
@@ -47,9 +61,13 @@ class PrefixBeamSearch():
                            num_decoding_left_chunks: int = -1,
                            simulate_streaming: bool = False,
                            ctc_weight: float = 0.3,
-                           transducer_weight: float = 0.7):
+                           transducer_weight: float = 0.7,
+                           blank_skip_thresh: float = 1.0):
         """prefix beam search
            also see wenet.transducer.transducer.beam_search
+
+           frames whose ctc blank posterior is larger than blank_skip_thresh
+           are skipped in search, 1.0 means no skip
         """
         assert speech.shape[0] == speech_lengths.shape[0]
         assert decoding_chunk_size != 0
@@ -58,91 +76,114 @@ class PrefixBeamSearch():
         assert batch_size == 1
 
         # 1. Encoder
-        encoder_out, _ = self.encoder(
+        encoder_out, encoder_mask = self.encoder(
             speech, speech_lengths, decoding_chunk_size,
             num_decoding_left_chunks)  # (B, maxlen, encoder_dim)
         maxlen = encoder_out.size(1)
 
-        ctc_probs = self.ctc.log_softmax(encoder_out).squeeze(0)
-        beam_init: List[Sequence] = []
-
-        # 2. init beam using Sequence to save beam unit
+        ctc_probs = self.ctc.log_softmax(encoder_out)
+        # frames to search, the full encoder_out is still returned for
+        # rescoring
+        search_out = encoder_out
+        if blank_skip_thresh < 1.0:
+            ctc_probs, _, frame_index = ctc_blank_skip(
+                ctc_probs, encoder_mask.squeeze(1).sum(1), blank_skip_thresh,
+                self.blank)
+            search_out = encoder_out.index_select(1, frame_index[0])
+            maxlen = search_out.size(1)
+        ctc_probs = ctc_probs.squeeze(0)
+
+        # 2. init beam, hyp i is tokens[i, :hyp_lens[i]] with an initial
+        # blank, hashes[i] are its rolling prefix hashes, pred_out[i] and
+        # cache[i] are the predictor output and state after its last token
+        tokens = torch.full((1, 1), self.blank, dtype=torch.long,
+                            device=device)
+        hyp_lens = torch.ones(1, dtype=torch.long, device=device)
+        hashes = torch.zeros(1, 2, dtype=torch.long, device=device)
+        hash_bases = torch.tensor(HASH_BASES, device=device)
+        hash_mods = torch.tensor(HASH_MODS, device=device)
+        scores = torch.zeros(1, device=device)
         cache = self.predictor.init_state(1, method="zero", device=device)
-        beam_init.append(Sequence(hyp=[self.blank], score=0.0, cache=cache))
+        pred_out, cache = self.forward_predictor_step([INIT_PREFIX_KEY],
+                                                      tokens, cache)
         # 3. start decoding (notice: we use breathwise first searching)
         # !!!! In this decoding method: one frame do not output multi units. !!!!
         # !!!!    Experiments show that this strategy has little impact      !!!!
         for i in range(maxlen):
-            # 3.1 building input
-            # decoder taking the last token to predict the next token
-            input_hyp = [s.hyp[-1] for s in beam_init]
-            input_hyp_tensor = torch.tensor(input_hyp,
-                                            dtype=torch.int,
-                                            device=device)
-            # building statement from beam
-            cache_batch = self.predictor.cache_to_batch(
-                [s.cache for s in beam_init])
-            # build score tensor to do torch.add() function
-            scores = torch.tensor([s.score for s in beam_init]).to(device)
-
-            # 3.2 forward decoder
-            logp, new_cache = self.forward_decoder_one_step(
-                encoder_out[:, i, :].unsqueeze(1),
-                input_hyp_tensor,
-                cache_batch,
-            )  # logp: (N, 1, 1, vocab_size)
-            logp = logp.squeeze(1).squeeze(1)  # logp: (N, vocab_size)
-            new_cache = self.predictor.batch_to_cache(new_cache)
-
-            # 3.3 shallow fusion for transducer score
+            num_hyps = scores.size(0)
+            # 3.1 joint of all hyps, (N, vocab_size)
+            logp = self.joint(search_out[:, i:i + 1, :].expand(
+                num_hyps, -1, -1), pred_out).log_softmax(dim=-1)
+            logp = logp.squeeze(1).squeeze(1)
+
+            # 3.2 shallow fusion for transducer score
             #     and ctc score where we can also add the LM score
             logp = torch.log(
                 torch.add(transducer_weight * torch.exp(logp),
                           ctc_weight * torch.exp(ctc_probs[i].unsqueeze(0))))
 
-            # 3.4 first beam prune
+            # 3.3 first beam prune, N * N candidates
             top_k_logp, top_k_index = logp.topk(beam_size)  # (N, N)
-            scores = torch.add(scores.unsqueeze(1), top_k_logp)
-
-            # 3.5 generate new beam (N*N)
-            beam_A = []
-            for j in range(len(beam_init)):
-                # update seq
-                base_seq = beam_init[j]
-                for t in range(beam_size):
-                    # blank: only update the score
-                    if top_k_index[j, t] == self.blank:
-                        new_seq = Sequence(hyp=base_seq.hyp.copy(),
-                                           score=scores[j, t].item(),
-                                           cache=base_seq.cache)
-
-                        beam_A.append(new_seq)
-                    # other unit: update hyp score statement and last
-                    else:
-                        hyp_new = base_seq.hyp.copy()
-                        hyp_new.append(top_k_index[j, t].item())
-                        new_seq = Sequence(hyp=hyp_new,
-                                           score=scores[j, t].item(),
-                                           cache=new_cache[j])
-                        beam_A.append(new_seq)
-
-            # 3.6 prefix fusion
-            fusion_A = [beam_A[0]]
-            for j in range(1, len(beam_A)):
-                s1 = beam_A[j]
-                if_do_append = True
-                for t in range(len(fusion_A)):
-                    # notice: A_ can not fusion with A
-                    if s1.hyp == fusion_A[t].hyp:
-                        fusion_A[t].score = log_add(
-                            [fusion_A[t].score, s1.score])
-                        if_do_append = False
-                        break
-                if if_do_append:
-                    fusion_A.append(s1)
-
-            # 4. second pruned
-            fusion_A.sort(key=lambda x: x.score, reverse=True)
-            beam_init = fusion_A[:beam_size]
-
-        return beam_init, encoder_out
+            cand_scores = (scores.unsqueeze(1) + top_k_logp).view(-1)
+            cand_tokens = top_k_index.view(-1)
+            cand_parents = torch.arange(
+                num_hyps, device=device).repeat_interleave(beam_size)
+            # blank: only update the score, other unit: extend the prefix
+            extend = cand_tokens != self.blank
+            cand_lens = hyp_lens[cand_parents] + extend.long()
+            cand_hashes = torch.where(
+                extend.unsqueeze(1),
+                (hashes[cand_parents] * hash_bases +
+                 cand_tokens.unsqueeze(1) + 1) % hash_mods,
+                hashes[cand_parents])
+
+            # 3.4 prefix fusion, candidates of the same prefix are merged
+            keys = torch.cat([cand_hashes, cand_lens.unsqueeze(1)], dim=1)
+            _, group = torch.unique(keys, dim=0, return_inverse=True)
+            num_groups = int(group.max()) + 1
+            group_max = torch.full((num_groups, ), -float('inf'),
+                                   device=device).scatter_reduce(
+                                       0, group, cand_scores, 'amax')
+            group_scores = torch.zeros(num_groups, device=device).index_add(
+                0, group, torch.exp(cand_scores - group_max[group]))
+            group_scores = group_max + torch.log(group_scores)
+            # any candidate of a group represents it, the predictor states
+            # only depend on the prefix
+            rep = torch.zeros(num_groups, dtype=torch.long,
+                              device=device).scatter_(
+                                  0, group,
+                                  torch.arange(group.size(0), device=device))
+
+            # 4. second prune
+            scores, best = group_scores.topk(min(beam_size, num_groups))
+            best = rep[best]
+            parents, new_tokens = cand_parents[best], cand_tokens[best]
+            extend, hyp_lens = extend[best], cand_lens[best]
+            hashes = cand_hashes[best]
+            pred_out = pred_out[parents]
+            cache = self._select_cache(cache, parents.tolist())
+            tokens = tokens[parents]
+            if bool(extend.any()):
+                if int(hyp_lens.max()) > tokens.size(1):
+                    tokens = torch.nn.functional.pad(tokens, (0, 1),
+                                                     value=self.blank)
+                idx = extend.nonzero().squeeze(1)
+                tokens[idx, hyp_lens[idx] - 1] = new_tokens[idx]
+                # 4.1 predictor steps of the extended hyps only, the
+                # prefixes seen before are looked up in the cache
+                keys = torch.cat([hashes[idx], hyp_lens[idx].unsqueeze(1)],
+                                 dim=1).tolist()
+                step_out, step_cache = self.forward_predictor_step(
+                    [tuple(k) for k in keys], new_tokens[idx].unsqueeze(1),
+                    self._select_cache(cache, idx.tolist()))
+                pred_out[idx] = step_out
+                cache = self._merge_cache(cache, idx.tolist(), step_cache)
+
+        beam: List[Sequence] = []
+        cache_list = self.predictor.batch_to_cache(cache)
+        for j, score in enumerate(scores.tolist()):
+            beam.append(
+                Sequence(hyp=tokens[j, :hyp_lens[j]].tolist(),
+                         score=score,
+                         cache=cache_list[j]))
+        return beam, encoder_out
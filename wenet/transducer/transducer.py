@@ -6,7 +6,7 @@ from torch import nn
 from torch.nn.utils.rnn import pad_sequence
 
 from wenet.transducer.predictor import PredictorBase
-from wenet.transducer.search.greedy_search import basic_greedy_search
+from wenet.transducer.search.greedy_search import batch_greedy_search
 from wenet.transducer.search.prefix_beam_search import PrefixBeamSearch
 from wenet.transformer.asr_model import ASRModel
 from wenet.transformer.ctc import CTC
@@ -202,6 +202,7 @@ class Transducer(ASRModel):
         simulate_streaming: bool = False,
         ctc_weight: float = 0.3,
         transducer_weight: float = 0.7,
+        blank_skip_thresh: float = 1.0,
     ):
         """beam search
 
@@ -221,6 +222,8 @@ class Transducer(ASRModel):
                 final_prob = ctc_weight * ctc_prob + transducer_weight * transducer_prob
             transducer_weight (float): transducer probability weight in
                 prefix beam search
+            blank_skip_thresh (float): frames whose ctc blank posterior is
+                larger than it are skipped in search, 1.0 means no skip
         Returns:
             List[List[int]]: best path result
 
@@ -235,6 +238,7 @@ class Transducer(ASRModel):
             simulate_streaming,
             ctc_weight,
             transducer_weight,
+            blank_skip_thresh,
         )
         return beam[0].hyp[1:], beam[0].score
 
@@ -252,7 +256,8 @@ class Transducer(ASRModel):
             transducer_weight: float = 0.0,
             search_ctc_weight: float = 1.0,
             search_transducer_weight: float = 0.0,
-            beam_search_type: str = 'transducer') -> List[List[int]]:
+            beam_search_type: str = 'transducer',
+            blank_skip_thresh: float = 1.0) -> List[List[int]]:
         """beam search
 
         Args:
@@ -277,6 +282,8 @@ class Transducer(ASRModel):
                                in rnnt beam search (seeing in self.beam_search)
             search_transducer_weight (float): transducer weight using
                                in rnnt beam search (seeing in self.beam_search)
+            blank_skip_thresh (float): frames whose ctc blank posterior is
+                larger than it are skipped in search, 1.0 means no skip
         Returns:
             List[List[int]]: best path result
 
@@ -302,18 +309,21 @@ class Transducer(ASRModel):
                 num_decoding_left_chunks=num_decoding_left_chunks,
                 ctc_weight=search_ctc_weight,
                 transducer_weight=search_transducer_weight,
+                blank_skip_thresh=blank_skip_thresh,
             )
             beam_score = [s.score for s in beam]
             hyps = [s.hyp[1:] for s in beam]
 
         elif beam_search_type == 'ctc':
-            hyps, encoder_out = self._ctc_prefix_beam_search(
+            hyps, encoder_out, _ = self._ctc_prefix_beam_search(
                 speech,
                 speech_lengths,
                 beam_size=beam_size,
                 decoding_chunk_size=decoding_chunk_size,
                 num_decoding_left_chunks=num_decoding_left_chunks,
-                simulate_streaming=simulate_streaming)
+                simulate_streaming=simulate_streaming,
+                blank_skip_thresh=blank_skip_thresh)
+            hyps = hyps[0]
             beam_score = [hyp[1] for hyp in hyps]
             hyps = [hyp[0] for hyp in hyps]
         assert len(hyps) == beam_size
@@ -386,9 +396,8 @@ class Transducer(ASRModel):
         """ greedy search
 
         Args:
-            speech (torch.Tensor): (batch=1, max_len, feat_dim)
+            speech (torch.Tensor): (batch, max_len, feat_dim)
             speech_length (torch.Tensor): (batch, )
-            beam_size (int): beam size for beam search
             decoding_chunk_size (int): decoding chunk for dynamic chunk
                 trained model.
                 <0: for decoding, use full chunk.
@@ -396,11 +405,10 @@ class Transducer(ASRModel):
                 0: used for training, it's prohibited here
             simulate_streaming (bool): whether do encoder forward in a
                 streaming fashion
+            n_steps (int): max non-blank tokens emitted of a frame
         Returns:
             List[List[int]]: best path result
         """
-        # TODO(Mddct): batch decode
-        assert speech.size(0) == 1
         assert speech.shape[0] == speech_lengths.shape[0]
         assert decoding_chunk_size != 0
         # TODO(Mddct): forward chunk by chunk
@@ -412,11 +420,13 @@ class Transducer(ASRModel):
             decoding_chunk_size,
             num_decoding_left_chunks,
         )
-        encoder_out_lens = encoder_mask.squeeze(1).sum()
-        hyps = basic_greedy_search(self,
-                                   encoder_out,
-                                   encoder_out_lens,
-                                   n_steps=n_steps)
+        encoder_out_lens = encoder_mask.squeeze(1).sum(1)
+        self.init_bs()
+        hyps, _ = batch_greedy_search(self,
+                                      encoder_out,
+                                      encoder_out_lens,
+                                      max_symbols_per_frame=n_steps,
+                                      predictor_cache=self.bs.predictor_cache)
 
         return hyps
 
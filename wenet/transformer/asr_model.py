@@ -13,7 +13,6 @@
 # limitations under the License.
 # Modified from ESPnet(https://github.com/espnet/espnet)
 
-from collections import defaultdict
 from typing import Dict, List, Optional, Tuple
 
 import torch
@@ -35,11 +34,12 @@ from wenet.transformer.ctc import CTC
 from wenet.transformer.decoder import TransformerDecoder
 from wenet.transformer.encoder import TransformerEncoder
 from wenet.transformer.label_smoothing_loss import LabelSmoothingLoss
-from wenet.utils.common import (IGNORE_ID, add_sos_eos, log_add,
+from wenet.utils.common import (IGNORE_ID, add_sos_eos,
                                 remove_duplicates_and_blank, th_accuracy,
                                 reverse_pad_list)
+from wenet.utils.ctc_util import ctc_blank_skip, ctc_prefix_beam_search
 from wenet.utils.mask import (make_pad_mask, mask_finished_preds,
-                              mask_finished_scores, subsequent_mask)
+                              mask_finished_scores)
 
 
 class ASRModel(torch.nn.Module):
@@ -229,33 +229,32 @@ class ASRModel(torch.nn.Module):
             num_decoding_left_chunks,
             simulate_streaming)  # (B, maxlen, encoder_dim)
         maxlen = encoder_out.size(1)
-        encoder_dim = encoder_out.size(2)
         running_size = batch_size * beam_size
-        encoder_out = encoder_out.unsqueeze(1).repeat(1, beam_size, 1, 1).view(
-            running_size, maxlen, encoder_dim)  # (B*N, maxlen, encoder_dim)
-        encoder_mask = encoder_mask.unsqueeze(1).repeat(
-            1, beam_size, 1, 1).view(running_size, 1,
-                                     maxlen)  # (B*N, 1, max_len)
-
-        hyps = torch.ones([running_size, 1], dtype=torch.long,
-                          device=device).fill_(self.sos)  # (B*N, 1)
+        # The key & value of encoder_out for src attention are computed
+        # once and shared by the N beams, the self attention cache is
+        # preallocated for maxlen steps and updated in place
+        self_cache, src_cache = self.decoder.init_step_cache(
+            encoder_out, maxlen, beam_size)
+
+        hyps = torch.ones([running_size, maxlen + 1],
+                          dtype=torch.long,
+                          device=device).fill_(self.sos)  # (B*N, maxlen+1)
         scores = torch.tensor([0.0] + [-float('inf')] * (beam_size - 1),
                               dtype=torch.float)
         scores = scores.to(device).repeat([batch_size]).unsqueeze(1).to(
             device)  # (B*N, 1)
         end_flag = torch.zeros_like(scores, dtype=torch.bool, device=device)
-        cache: Optional[List[torch.Tensor]] = None
+        i = 0
         # 2. Decoder forward step by step
         for i in range(1, maxlen + 1):
             # Stop if all batch and all beam produce eos
             if end_flag.sum() == running_size:
+                i -= 1
                 break
-            # 2.1 Forward decoder step
-            hyps_mask = subsequent_mask(i).unsqueeze(0).repeat(
-                running_size, 1, 1).to(device)  # (B*N, i, i)
+            # 2.1 Forward decoder step, only the last token is computed
             # logp: (B*N, vocab)
-            logp, cache = self.decoder.forward_one_step(
-                encoder_out, encoder_mask, hyps, hyps_mask, cache)
+            logp = self.decoder.forward_step(encoder_mask, hyps[:, i - 1:i],
+                                             i - 1, self_cache, src_cache)
             # 2.2 First beam prune: select topk best prob at current time
             top_k_logp, top_k_index = logp.topk(beam_size)  # (B*N, N)
             top_k_logp = mask_finished_scores(top_k_logp, end_flag)
@@ -264,12 +263,6 @@ class ASRModel(torch.nn.Module):
             scores = scores + top_k_logp  # (B*N, N), broadcast add
             scores = scores.view(batch_size, beam_size * beam_size)  # (B, N*N)
             scores, offset_k_index = scores.topk(k=beam_size)  # (B, N)
-            # Update cache to be consistent with new topk scores / hyps
-            cache_index = (offset_k_index // beam_size).view(-1)  # (B*N)
-            base_cache_index = (torch.arange(batch_size, device=device).view(
-                -1, 1).repeat([1, beam_size]) * beam_size).view(-1)  # (B*N)
-            cache_index = base_cache_index + cache_index
-            cache = [torch.index_select(c, dim=0, index=cache_index) for c in cache]
             scores = scores.view(-1, 1)  # (B*N, 1)
             # 2.4. Compute base index in top_k_index,
             # regard top_k_index as (B*N*N),regard offset_k_index as (B*N),
@@ -280,18 +273,24 @@ class ASRModel(torch.nn.Module):
             best_k_index = base_k_index.view(-1) + offset_k_index.view(
                 -1)  # (B*N)
 
-            # 2.5 Update best hyps
+            # 2.5 Update best hyps and cache to be consistent with new topk
+            # scores / hyps, only the first i steps are valid
             best_k_pred = torch.index_select(top_k_index.view(-1),
                                              dim=-1,
                                              index=best_k_index)  # (B*N)
             best_hyps_index = best_k_index // beam_size
-            last_best_k_hyps = torch.index_select(
-                hyps, dim=0, index=best_hyps_index)  # (B*N, i)
-            hyps = torch.cat((last_best_k_hyps, best_k_pred.view(-1, 1)),
-                             dim=1)  # (B*N, i+1)
+            hyps[:, :i] = torch.index_select(hyps[:, :i],
+                                             dim=0,
+                                             index=best_hyps_index)
+            hyps[:, i] = best_k_pred
+            for c in self_cache:
+                c[:, :, :i] = torch.index_select(c[:, :, :i],
+                                                 dim=0,
+                                                 index=best_hyps_index)
 
             # 2.6 Update end flag
-            end_flag = torch.eq(hyps[:, -1], self.eos).view(-1, 1)
+            end_flag = torch.eq(hyps[:, i], self.eos).view(-1, 1)
+        hyps = hyps[:, :i + 1]  # (B*N, i+1)
 
         # 3. Select best of best
         scores = scores.view(batch_size, beam_size)
@@ -310,6 +309,7 @@ class ASRModel(torch.nn.Module):
         decoding_chunk_size: int = -1,
         num_decoding_left_chunks: int = -1,
         simulate_streaming: bool = False,
+        blank_skip_thresh: float = 1.0,
     ) -> List[List[int]]:
         """ Apply CTC greedy search
 
@@ -324,6 +324,8 @@ class ASRModel(torch.nn.Module):
                 0: used for training, it's prohibited here
             simulate_streaming (bool): whether do encoder forward in a
                 streaming fashion
+            blank_skip_thresh (float): frames whose blank posterior is
+                larger than it are skipped in search, 1.0 means no skip
         Returns:
             List[List[int]]: best path result
         """
@@ -339,6 +341,10 @@ class ASRModel(torch.nn.Module):
         encoder_out_lens = encoder_mask.squeeze(1).sum(1)
         ctc_probs = self.ctc.log_softmax(
             encoder_out)  # (B, maxlen, vocab_size)
+        if blank_skip_thresh < 1.0:
+            ctc_probs, encoder_out_lens, _ = ctc_blank_skip(
+                ctc_probs, encoder_out_lens, blank_skip_thresh)
+            maxlen = ctc_probs.size(1)
         topk_prob, topk_index = ctc_probs.topk(1, dim=2)  # (B, maxlen, 1)
         topk_index = topk_index.view(batch_size, maxlen)  # (B, maxlen)
         mask = make_pad_mask(encoder_out_lens, maxlen)  # (B, maxlen)
@@ -356,7 +362,9 @@ class ASRModel(torch.nn.Module):
         decoding_chunk_size: int = -1,
         num_decoding_left_chunks: int = -1,
         simulate_streaming: bool = False,
-    ) -> Tuple[List[List[int]], torch.Tensor]:
+        blank_skip_thresh: float = 1.0,
+    ) -> Tuple[List[List[Tuple[Tuple[int, ...], float, Tuple[int, ...]]]],
+               torch.Tensor, torch.Tensor]:
         """ CTC prefix beam search inner implementation
 
         Args:
@@ -370,68 +378,38 @@ class ASRModel(torch.nn.Module):
                 0: used for training, it's prohibited here
             simulate_streaming (bool): whether do encoder forward in a
                 streaming fashion
+            blank_skip_thresh (float): frames whose blank posterior is
+                larger than it are skipped in search, 1.0 means no skip
 
         Returns:
-            List[List[int]]: nbest results
-            torch.Tensor: encoder output, (1, max_len, encoder_dim),
+            List[List[Tuple[Tuple[int, ...], float, Tuple[int, ...]]]]:
+                nbest (prefix, score, times) of each utterance, times are
+                the encoder output frames where the tokens are emitted
+            torch.Tensor: encoder output, (batch, max_len, encoder_dim),
                 it will be used for rescoring in attention rescoring mode
+            torch.Tensor: encoder mask, (batch, 1, max_len)
         """
         assert speech.shape[0] == speech_lengths.shape[0]
         assert decoding_chunk_size != 0
-        batch_size = speech.shape[0]
-        # For CTC prefix beam search, we only support batch_size=1
-        assert batch_size == 1
         # Let's assume B = batch_size and N = beam_size
         # 1. Encoder forward and get CTC score
         encoder_out, encoder_mask = self._forward_encoder(
             speech, speech_lengths, decoding_chunk_size,
             num_decoding_left_chunks,
             simulate_streaming)  # (B, maxlen, encoder_dim)
-        maxlen = encoder_out.size(1)
+        encoder_out_lens = encoder_mask.squeeze(1).sum(1)
         ctc_probs = self.ctc.log_softmax(
-            encoder_out)  # (1, maxlen, vocab_size)
-        ctc_probs = ctc_probs.squeeze(0)
-        # cur_hyps: (prefix, (blank_ending_score, none_blank_ending_score))
-        cur_hyps = [(tuple(), (0.0, -float('inf')))]
+            encoder_out)  # (B, maxlen, vocab_size)
+        frame_index: Optional[torch.Tensor] = None
+        if blank_skip_thresh < 1.0:
+            ctc_probs, encoder_out_lens, frame_index = ctc_blank_skip(
+                ctc_probs, encoder_out_lens, blank_skip_thresh)
         # 2. CTC beam search step by step
-        for t in range(0, maxlen):
-            logp = ctc_probs[t]  # (vocab_size,)
-            # key: prefix, value (pb, pnb), default value(-inf, -inf)
-            next_hyps = defaultdict(lambda: (-float('inf'), -float('inf')))
-            # 2.1 First beam prune: select topk best
-            top_k_logp, top_k_index = logp.topk(beam_size)  # (beam_size,)
-            for s in top_k_index:
-                s = s.item()
-                ps = logp[s].item()
-                for prefix, (pb, pnb) in cur_hyps:
-                    last = prefix[-1] if len(prefix) > 0 else None
-                    if s == 0:  # blank
-                        n_pb, n_pnb = next_hyps[prefix]
-                        n_pb = log_add([n_pb, pb + ps, pnb + ps])
-                        next_hyps[prefix] = (n_pb, n_pnb)
-                    elif s == last:
-                        #  Update *ss -> *s;
-                        n_pb, n_pnb = next_hyps[prefix]
-                        n_pnb = log_add([n_pnb, pnb + ps])
-                        next_hyps[prefix] = (n_pb, n_pnb)
-                        # Update *s-s -> *ss, - is for blank
-                        n_prefix = prefix + (s, )
-                        n_pb, n_pnb = next_hyps[n_prefix]
-                        n_pnb = log_add([n_pnb, pb + ps])
-                        next_hyps[n_prefix] = (n_pb, n_pnb)
-                    else:
-                        n_prefix = prefix + (s, )
-                        n_pb, n_pnb = next_hyps[n_prefix]
-                        n_pnb = log_add([n_pnb, pb + ps, pnb + ps])
-                        next_hyps[n_prefix] = (n_pb, n_pnb)
-
-            # 2.2 Second beam prune
-            next_hyps = sorted(next_hyps.items(),
-                               key=lambda x: log_add(list(x[1])),
-                               reverse=True)
-            cur_hyps = next_hyps[:beam_size]
-        hyps = [(y[0], log_add([y[1][0], y[1][1]])) for y in cur_hyps]
-        return hyps, encoder_out
+        hyps = ctc_prefix_beam_search(ctc_probs,
+                                      encoder_out_lens,
+                                      beam_size,
+                                      frame_index=frame_index)
+        return hyps, encoder_out, encoder_mask
 
     def ctc_prefix_beam_search(
         self,
@@ -441,7 +419,8 @@ class ASRModel(torch.nn.Module):
         decoding_chunk_size: int = -1,
         num_decoding_left_chunks: int = -1,
         simulate_streaming: bool = False,
-    ) -> List[int]:
+        blank_skip_thresh: float = 1.0,
+    ) -> Tuple[List[List[int]], List[float]]:
         """ Apply CTC prefix beam search
 
         Args:
@@ -455,15 +434,22 @@ class ASRModel(torch.nn.Module):
                 0: used for training, it's prohibited here
             simulate_streaming (bool): whether do encoder forward in a
                 streaming fashion
+            blank_skip_thresh (float): frames whose blank posterior is
+                larger than it are skipped in search, 1.0 means no skip
 
         Returns:
-            List[int]: CTC prefix beam search nbest results
+            List[List[int]]: CTC prefix beam search best path of each
+                utterance
+            List[float]: score of each best path
         """
-        hyps, _ = self._ctc_prefix_beam_search(speech, speech_lengths,
-                                               beam_size, decoding_chunk_size,
-                                               num_decoding_left_chunks,
-                                               simulate_streaming)
-        return hyps[0]
+        hyps, _, _ = self._ctc_prefix_beam_search(speech, speech_lengths,
+                                                  beam_size,
+                                                  decoding_chunk_size,
+                                                  num_decoding_left_chunks,
+                                                  simulate_streaming,
+                                                  blank_skip_thresh)
+        return [list(nbest[0][0]) for nbest in hyps], \
+            [nbest[0][1] for nbest in hyps]
 
     def attention_rescoring(
         self,
@@ -475,7 +461,8 @@ class ASRModel(torch.nn.Module):
         ctc_weight: float = 0.0,
         simulate_streaming: bool = False,
         reverse_weight: float = 0.0,
-    ) -> List[int]:
+        blank_skip_thresh: float = 1.0,
+    ) -> Tuple[List[List[int]], List[float]]:
         """ Apply attention rescoring decoding, CTC prefix beam search
             is applied first to get nbest, then we resoring the nbest on
             attention decoder with corresponding encoder out
@@ -493,9 +480,13 @@ class ASRModel(torch.nn.Module):
                 streaming fashion
             reverse_weight (float): right to left decoder weight
             ctc_weight (float): ctc score weight
+            blank_skip_thresh (float): frames whose blank posterior is
+                larger than it are skipped in ctc prefix beam search,
+                1.0 means no skip
 
         Returns:
-            List[int]: Attention rescoring result
+            List[List[int]]: Attention rescoring result of each utterance
+            List[float]: score of each result
         """
         assert speech.shape[0] == speech_lengths.shape[0]
         assert decoding_chunk_size != 0
@@ -504,64 +495,99 @@ class ASRModel(torch.nn.Module):
             assert hasattr(self.decoder, 'right_decoder')
         device = speech.device
         batch_size = speech.shape[0]
-        # For attention rescoring we only support batch_size=1
-        assert batch_size == 1
-        # encoder_out: (1, maxlen, encoder_dim), len(hyps) = beam_size
-        hyps, encoder_out = self._ctc_prefix_beam_search(
+        # encoder_out: (B, maxlen, encoder_dim), len(hyps[i]) <= beam_size
+        hyps, encoder_out, encoder_mask = self._ctc_prefix_beam_search(
             speech, speech_lengths, beam_size, decoding_chunk_size,
-            num_decoding_left_chunks, simulate_streaming)
-
-        assert len(hyps) == beam_size
+            num_decoding_left_chunks, simulate_streaming, blank_skip_thresh)
+        # Let's assume M = total number of hyps of all utterances, all the
+        # hyps are rescored in one decoder forward
+        flat_hyps = [hyp[0] for nbest in hyps for hyp in nbest]
+        ctc_scores = torch.tensor([hyp[1] for nbest in hyps for hyp in nbest],
+                                  device=device)  # (M,)
+        utt_index = torch.tensor(
+            [i for i, nbest in enumerate(hyps) for _ in nbest],
+            dtype=torch.long, device=device)  # (M,)
+        beam_index = torch.tensor([j for nbest in hyps for j in
+                                   range(len(nbest))],
+                                  dtype=torch.long, device=device)  # (M,)
         hyps_pad = pad_sequence([
-            torch.tensor(hyp[0], device=device, dtype=torch.long)
-            for hyp in hyps
-        ], True, self.ignore_id)  # (beam_size, max_hyps_len)
-        ori_hyps_pad = hyps_pad
-        hyps_lens = torch.tensor([len(hyp[0]) for hyp in hyps],
+            torch.tensor(hyp, device=device, dtype=torch.long)
+            for hyp in flat_hyps
+        ], True, self.ignore_id)  # (M, max_hyps_len)
+        hyps_lens = torch.tensor([len(hyp) for hyp in flat_hyps],
                                  device=device,
-                                 dtype=torch.long)  # (beam_size,)
-        hyps_pad, _ = add_sos_eos(hyps_pad, self.sos, self.eos, self.ignore_id)
-        hyps_lens = hyps_lens + 1  # Add <sos> at begining
-        encoder_out = encoder_out.repeat(beam_size, 1, 1)
-        encoder_mask = torch.ones(beam_size,
-                                  1,
-                                  encoder_out.size(1),
-                                  dtype=torch.bool,
+                                 dtype=torch.long)  # (M,)
+        scores = self._attention_rescoring_score(
+            encoder_out.index_select(0, utt_index),
+            encoder_mask.index_select(0, utt_index), hyps_pad, hyps_lens,
+            reverse_weight)  # (M,)
+        scores = scores + ctc_scores * ctc_weight
+        # Pick the best hyp of each utterance
+        nbest_scores = torch.full((batch_size, beam_size),
+                                  -float('inf'),
                                   device=device)
-        # used for right to left decoder
-        r_hyps_pad = reverse_pad_list(ori_hyps_pad, hyps_lens, self.ignore_id)
-        r_hyps_pad, _ = add_sos_eos(r_hyps_pad, self.sos, self.eos,
-                                    self.ignore_id)
+        nbest_scores[utt_index, beam_index] = scores
+        best_scores, best_index = nbest_scores.max(dim=-1)  # (B,)
+        best_index = best_index.tolist()
+        best_hyps = [list(hyps[i][best_index[i]][0]) for i in
+                     range(batch_size)]
+        return best_hyps, best_scores.tolist()
+
+    def _attention_rescoring_score(
+        self,
+        encoder_out: torch.Tensor,
+        encoder_mask: torch.Tensor,
+        hyps_pad: torch.Tensor,
+        hyps_lens: torch.Tensor,
+        reverse_weight: float = 0.0,
+    ) -> torch.Tensor:
+        """ Score hyps on the attention decoder in one forward
+
+        Args:
+            encoder_out (torch.Tensor): encoder output of each hyp,
+                (num_hyps, max_len, encoder_dim)
+            encoder_mask (torch.Tensor): (num_hyps, 1, max_len)
+            hyps_pad (torch.Tensor): hyps without <sos>/<eos> padded with
+                ignore_id, (num_hyps, max_hyps_len)
+            hyps_lens (torch.Tensor): length of each hyp, (num_hyps,)
+            reverse_weight (float): right to left decoder weight
+
+        Returns:
+            torch.Tensor: decoder score of each hyp, (num_hyps,)
+        """
+        max_len = hyps_pad.size(1)
+        index_range = torch.arange(max_len, device=hyps_pad.device)
+        seq_mask = hyps_lens.unsqueeze(1) > index_range  # (M, max_hyps_len)
+        sos = torch.full_like(hyps_lens, self.sos).unsqueeze(1)
+        eos = torch.full_like(hyps_lens, self.eos).unsqueeze(1)
+        # ys_in: <sos> w1 ... wn <eos> ..., ys_out: w1 ... wn <eos> <eos> ...
+        ys = torch.where(seq_mask, hyps_pad, self.eos)
+        ys_in = torch.cat([sos, ys], dim=1)  # (M, max_hyps_len + 1)
+        ys_out = torch.cat([ys, eos], dim=1)  # (M, max_hyps_len + 1)
+        ys_in_lens = hyps_lens + 1  # Add <sos> at begining
+        # used for right to left decoder, wn ... w1 <eos> ...
+        index = (hyps_lens.unsqueeze(1) - 1 - index_range) * seq_mask
+        r_ys = torch.where(seq_mask, hyps_pad.gather(1, index), self.eos)
+        r_ys_in = torch.cat([sos, r_ys], dim=1)
+        r_ys_out = torch.cat([r_ys, eos], dim=1)
+        # valid output positions, w1 ... wn <eos>
+        out_mask = ys_in_lens.unsqueeze(1) > torch.arange(
+            max_len + 1, device=hyps_pad.device)  # (M, max_hyps_len + 1)
         decoder_out, r_decoder_out, _ = self.decoder(
-            encoder_out, encoder_mask, hyps_pad, hyps_lens, r_hyps_pad,
-            reverse_weight)  # (beam_size, max_hyps_len, vocab_size)
+            encoder_out, encoder_mask, ys_in, ys_in_lens, r_ys_in,
+            reverse_weight)  # (M, max_hyps_len + 1, vocab_size)
         decoder_out = torch.nn.functional.log_softmax(decoder_out, dim=-1)
-        decoder_out = decoder_out.cpu().numpy()
+        scores = decoder_out.gather(2, ys_out.unsqueeze(2)).squeeze(2)
+        scores = scores.masked_fill(~out_mask, 0.0).sum(1)  # (M,)
         # r_decoder_out will be 0.0, if reverse_weight is 0.0 or decoder is a
         # conventional transformer decoder.
-        r_decoder_out = torch.nn.functional.log_softmax(r_decoder_out, dim=-1)
-        r_decoder_out = r_decoder_out.cpu().numpy()
-        # Only use decoder score for rescoring
-        best_score = -float('inf')
-        best_index = 0
-        for i, hyp in enumerate(hyps):
-            score = 0.0
-            for j, w in enumerate(hyp[0]):
-                score += decoder_out[i][j][w]
-            score += decoder_out[i][len(hyp[0])][self.eos]
-            # add right to left decoder score
-            if reverse_weight > 0:
-                r_score = 0.0
-                for j, w in enumerate(hyp[0]):
-                    r_score += r_decoder_out[i][len(hyp[0]) - j - 1][w]
-                r_score += r_decoder_out[i][len(hyp[0])][self.eos]
-                score = score * (1 - reverse_weight) + r_score * reverse_weight
-            # add ctc score
-            score += hyp[1] * ctc_weight
-            if score > best_score:
-                best_score = score
-                best_index = i
-        return hyps[best_index][0], best_score
+        if reverse_weight > 0.0:
+            r_decoder_out = torch.nn.functional.log_softmax(r_decoder_out,
+                                                            dim=-1)
+            r_scores = r_decoder_out.gather(2, r_ys_out.unsqueeze(2)).squeeze(2)
+            r_scores = r_scores.masked_fill(~out_mask, 0.0).sum(1)
+            scores = scores * (1 - reverse_weight) + r_scores * reverse_weight
+        return scores
 
     @torch.jit.ignore(drop=True)
     def load_lfmmi_resource(self):
@@ -185,6 +185,81 @@ class TransformerDecoder(torch.nn.Module):
             y = torch.log_softmax(self.output_layer(y), dim=-1)
         return y, new_cache
 
+    def init_step_cache(
+        self,
+        memory: torch.Tensor,
+        max_steps: int,
+        beam_size: int,
+    ) -> Tuple[List[torch.Tensor], List[torch.Tensor]]:
+        """Allocate the caches used by `forward_step`.
+            This is only used for decoding.
+        Args:
+            memory: encoded memory, float32  (batch, maxlen_in, feat)
+            max_steps: maximum number of decoding steps
+            beam_size: number of hyps of each utterance
+        Returns:
+            self_cache: zero initialized self attention key & value cache
+                per `self.decoders`,
+                (batch * beam_size, head, max_steps, d_k * 2)
+            src_cache: key & value of memory for src attention per
+                `self.decoders`, they are computed only once here,
+                (batch, head, maxlen_in, d_k * 2)
+        """
+        self_cache: List[torch.Tensor] = []
+        src_cache: List[torch.Tensor] = []
+        for decoder in self.decoders:
+            self_attn = decoder.self_attn
+            self_cache.append(
+                torch.zeros(memory.size(0) * beam_size,
+                            self_attn.h,
+                            max_steps,
+                            self_attn.d_k * 2,
+                            dtype=memory.dtype,
+                            device=memory.device))
+            if decoder.src_attn is None:
+                src_cache.append(torch.zeros(0, 0, 0, 0))
+            else:
+                _, k, v = decoder.src_attn.forward_qkv(memory, memory, memory)
+                src_cache.append(torch.cat((k, v), dim=-1))
+        return self_cache, src_cache
+
+    def forward_step(
+        self,
+        memory_mask: torch.Tensor,
+        tgt: torch.Tensor,
+        offset: int,
+        self_cache: List[torch.Tensor],
+        src_cache: List[torch.Tensor],
+    ) -> torch.Tensor:
+        """Forward one step with the caches from `init_step_cache`, only the
+            last token is computed and the caches are updated in place.
+            This is only used for decoding.
+        Args:
+            memory_mask: encoded memory mask, (batch, 1, maxlen_in)
+            tgt: input token ids of current step, int64
+                (batch * beam_size, 1)
+            offset: current step, starting from 0
+            self_cache: self attention cache per `self.decoders`
+            src_cache: src attention cache per `self.decoders`
+        Returns:
+            y: log probability of next token, (batch * beam_size, token)
+        """
+        if isinstance(self.embed, torch.nn.Sequential):
+            x = self.embed[0](tgt)
+            x, _ = self.embed[1](x, offset)
+        else:
+            x, _ = self.embed(tgt, offset)
+        for i, decoder in enumerate(self.decoders):
+            x = decoder.forward_step(x, memory_mask, self_cache[i],
+                                     src_cache[i], offset)
+        if self.normalize_before:
+            y = self.after_norm(x[:, -1])
+        else:
+            y = x[:, -1]
+        if self.use_output_layer:
+            y = torch.log_softmax(self.output_layer(y), dim=-1)
+        return y
+
 
 class BiTransformerDecoder(torch.nn.Module):
     """Base class of Transfomer decoder module.
@@ -294,3 +369,28 @@ class BiTransformerDecoder(torch.nn.Module):
         """
         return self.left_decoder.forward_one_step(memory, memory_mask, tgt,
                                                   tgt_mask, cache)
+
+    def init_step_cache(
+        self,
+        memory: torch.Tensor,
+        max_steps: int,
+        beam_size: int,
+    ) -> Tuple[List[torch.Tensor], List[torch.Tensor]]:
+        """Allocate the caches used by `forward_step`, see
+            `TransformerDecoder.init_step_cache`.
+        """
+        return self.left_decoder.init_step_cache(memory, max_steps,
+                                                 beam_size)
+
+    def forward_step(
+        self,
+        memory_mask: torch.Tensor,
+        tgt: torch.Tensor,
+        offset: int,
+        self_cache: List[torch.Tensor],
+        src_cache: List[torch.Tensor],
+    ) -> torch.Tensor:
+        """Forward one step with cache, see `TransformerDecoder.forward_step`.
+        """
+        return self.left_decoder.forward_step(memory_mask, tgt, offset,
+                                              self_cache, src_cache)
@@ -14,6 +14,7 @@
 # limitations under the License.
 
 """Decoder self-attention layer definition."""
+import math
 from typing import Optional, Tuple
 
 import torch
@@ -130,3 +131,74 @@ class DecoderLayer(nn.Module):
             x = torch.cat([cache, x], dim=1)
 
         return x, tgt_mask, memory, memory_mask
+
+    def forward_step(
+        self,
+        tgt: torch.Tensor,
+        memory_mask: torch.Tensor,
+        self_cache: torch.Tensor,
+        src_cache: torch.Tensor,
+        offset: int,
+    ) -> torch.Tensor:
+        """Compute decoded feature of one step with preallocated caches.
+            This is only used for decoding.
+
+        Args:
+            tgt (torch.Tensor): Input tensor of current step
+                (#batch * beam, 1, size).
+            memory_mask (torch.Tensor): Encoded memory mask
+                (#batch, 1, maxlen_in).
+            self_cache (torch.Tensor): self attention key & value cache
+                (#batch * beam, head, max_steps, d_k * 2), key & value of
+                current step is written to `offset` in place.
+            src_cache (torch.Tensor): key & value of encoded memory for
+                src attention, shared by all the beams of an utterance,
+                (#batch, head, maxlen_in, d_k * 2).
+            offset (int): current step, starting from 0.
+
+        Returns:
+            torch.Tensor: Output tensor (#batch * beam, 1, size).
+
+        """
+        residual = tgt
+        if self.normalize_before:
+            tgt = self.norm1(tgt)
+        q, k, v = self.self_attn.forward_qkv(tgt, tgt, tgt)
+        self_cache[:, :, offset:offset + 1] = torch.cat((k, v), dim=-1)
+        key_cache, value_cache = torch.split(
+            self_cache[:, :, :offset + 1], self_cache.size(-1) // 2, dim=-1)
+        # (#batch * beam, head, 1, offset + 1)
+        scores = torch.matmul(q, key_cache.transpose(-2, -1)) / math.sqrt(
+            self.self_attn.d_k)
+        x = residual + self.dropout(
+            self.self_attn.forward_attention(value_cache, scores))
+        if not self.normalize_before:
+            x = self.norm1(x)
+
+        if self.src_attn is not None:
+            residual = x
+            if self.normalize_before:
+                x = self.norm2(x)
+            # regard the beams of an utterance as the queries of it
+            n_batch = src_cache.size(0)
+            n_head = self.src_attn.h
+            d_k = self.src_attn.d_k
+            q = self.src_attn.linear_q(x).view(n_batch, -1, n_head, d_k)
+            q = q.transpose(1, 2)  # (#batch, head, beam, d_k)
+            key_cache, value_cache = torch.split(src_cache, d_k, dim=-1)
+            # (#batch, head, beam, maxlen_in)
+            scores = torch.matmul(q, key_cache.transpose(-2, -1)) / \
+                math.sqrt(d_k)
+            x_src = self.src_attn.forward_attention(value_cache, scores,
+                                                    memory_mask)
+            x = residual + self.dropout(x_src.reshape(residual.size()))
+            if not self.normalize_before:
+                x = self.norm2(x)
+
+        residual = x
+        if self.normalize_before:
+            x = self.norm3(x)
+        x = residual + self.dropout(self.feed_forward(x))
+        if not self.normalize_before:
+            x = self.norm3(x)
+        return x
@@ -26,7 +26,8 @@ class PositionalEncoding(torch.nn.Module):
 
     :param int d_model: embedding dim
     :param float dropout_rate: dropout rate
-    :param int max_len: maximum input length
+    :param int max_len: length of the precomputed table, encodings beyond
+        it are computed on demand
 
     PE(pos, 2i)   = sin(pos/(10000^(2i/dmodel)))
     PE(pos, 2i+1) = cos(pos/(10000^(2i/dmodel)))
@@ -52,6 +53,7 @@ class PositionalEncoding(torch.nn.Module):
         self.pe[:, 0::2] = torch.sin(position * div_term)
         self.pe[:, 1::2] = torch.cos(position * div_term)
         self.pe = self.pe.unsqueeze(0)
+        self.div_term = div_term.double()
 
     def forward(self,
                 x: torch.Tensor,
@@ -93,24 +95,52 @@ class PositionalEncoding(torch.nn.Module):
         # How to subscript a Union type:
         #   https://github.com/pytorch/pytorch/issues/69434
         if isinstance(offset, int):
-            assert offset + size < self.max_len
-            pos_emb = self.pe[:, offset:offset + size]
+            if offset + size < self.max_len:
+                pos_emb = self.pe[:, offset:offset + size]
+            else:
+                pos_emb = self.compute_pe(
+                    torch.arange(offset, offset + size,
+                                 device=self.pe.device).unsqueeze(0))
         elif isinstance(offset, torch.Tensor) and offset.dim() == 0:  # scalar
-            assert offset + size < self.max_len
-            pos_emb = self.pe[:, offset:offset + size]
+            if offset + size < self.max_len:
+                pos_emb = self.pe[:, offset:offset + size]
+            else:
+                pos_emb = self.compute_pe(
+                    (offset + torch.arange(0, size).to(offset.device))
+                    .unsqueeze(0))
         else:  # for batched streaming decoding on GPU
-            assert torch.max(offset) + size < self.max_len
             index = offset.unsqueeze(1) + \
                 torch.arange(0, size).to(offset.device)  # B X T
             flag = index > 0
             # remove negative offset
             index = index * flag
-            pos_emb = F.embedding(index, self.pe[0])  # B X T X d_model
+            if torch.max(offset) + size < self.max_len:
+                pos_emb = F.embedding(index, self.pe[0])  # B X T X d_model
+            else:
+                pos_emb = self.compute_pe(index)
 
         if apply_dropout:
             pos_emb = self.dropout(pos_emb)
         return pos_emb
 
+    def compute_pe(self, index: torch.Tensor) -> torch.Tensor:
+        """ Compute the encoding of positions beyond the precomputed table,
+            so a stream can run for any length with constant memory.
+
+        Args:
+            index (torch.Tensor): positions, (B, T)
+
+        Returns:
+            torch.Tensor: encoding, (B, T, d_model)
+        """
+        # float64 keeps the phase precise for large positions
+        angle = index.to(torch.float64).unsqueeze(2) * \
+            self.div_term.to(index.device)
+        pe = torch.stack([torch.sin(angle), torch.cos(angle)], dim=3)
+        return pe.view(index.size(0), index.size(1),
+                       self.d_model).to(self.pe.dtype)
+
+
 class RelPositionalEncoding(PositionalEncoding):
     """Relative positional encoding module.
     See : Appendix B in https://arxiv.org/abs/1901.02860
@@ -15,7 +15,7 @@
 # Modified from ESPnet(https://github.com/espnet/espnet)
 
 """Encoder definition."""
-from typing import Tuple
+from typing import List, Tuple
 
 import torch
 
@@ -32,6 +32,7 @@ from wenet.transformer.subsampling import Conv2dSubsampling4
 from wenet.transformer.subsampling import Conv2dSubsampling6
 from wenet.transformer.subsampling import Conv2dSubsampling8
 from wenet.transformer.subsampling import LinearNoSubsampling
+from wenet.transformer.subsampling import StreamingConv2dSubsampling
 from wenet.utils.common import get_activation
 from wenet.utils.mask import make_pad_mask
 from wenet.utils.mask import add_optional_chunk_mask
@@ -221,6 +222,21 @@ class BaseEncoder(torch.nn.Module):
             xs = self.global_cmvn(xs)
         # NOTE(xcsong): Before embed, shape(xs) is (b=1, time, mel-dim)
         xs, pos_emb, _ = self.embed(xs, tmp_masks, offset)
+        return self._forward_chunk_layers(xs, offset, required_cache_size,
+                                          att_cache, cnn_cache, att_mask)
+
+    def _forward_chunk_layers(
+        self,
+        xs: torch.Tensor,
+        offset: int,
+        required_cache_size: int,
+        att_cache: torch.Tensor,
+        cnn_cache: torch.Tensor,
+        att_mask: torch.Tensor,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """ Encoder layers part of `forward_chunk`, xs is the output of
+            subsampling with shape (b=1, chunk_size, hidden-dim)
+        """
         # NOTE(xcsong): After  embed, shape(xs) is (b=1, chunk_size, hidden-dim)
         elayers, cache_t1 = att_cache.size(0), att_cache.size(2)
         chunk_size = xs.size(1)
@@ -260,11 +276,203 @@ class BaseEncoder(torch.nn.Module):
 
         return (xs, r_att_cache, r_cnn_cache)
 
+    def forward_chunk_ring(
+        self,
+        xs: torch.Tensor,
+        offset: int,
+        required_cache_size: int,
+        att_cache: torch.Tensor,
+        cnn_cache: torch.Tensor = torch.zeros(0, 0, 0, 0),
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """ Forward just one chunk with a preallocated ring-buffer
+            attention cache
+
+        Same as `forward_chunk`, but the KEY & VALUE of the chunk are written
+        in place to a fixed-capacity `att_cache` instead of being concatenated
+        with the history, so no new attention cache is allocated per chunk.
+        The frame at encoder output time `t` always lives in slot
+        `t % ring_size`, stale and unfilled slots are masked out.
+
+        Args:
+            xs (torch.Tensor): chunk input, with shape (b=1, time, mel-dim),
+                see `forward_chunk`.
+            offset (int): current offset in encoder output time stamp
+            required_cache_size (int): cache size required for next chunk
+                compuation, must be >= 0.
+            att_cache (torch.Tensor): ring-buffer cache tensor for KEY & VALUE
+                in transformer/conformer attention, with shape
+                (elayers, head, ring_size, d_k * 2), where
+                `ring_size >= required_cache_size + chunk_size`,
+                zero-initialized before the first chunk.
+            cnn_cache (torch.Tensor): cache tensor for cnn_module in conformer,
+                (elayers, b=1, hidden-dim, cache_t2), where
+                `cache_t2 == cnn.lorder - 1`
+
+        Returns:
+            torch.Tensor: output of current input xs,
+                with shape (b=1, chunk_size, hidden-dim).
+            torch.Tensor: the updated `att_cache` itself.
+            torch.Tensor: new conformer cnn cache required for next chunk, with
+                same shape as the original cnn_cache.
+
+        """
+        assert xs.size(0) == 1
+        assert required_cache_size >= 0
+        # tmp_masks is just for interface compatibility
+        tmp_masks = torch.ones(1,
+                               xs.size(1),
+                               device=xs.device,
+                               dtype=torch.bool)
+        tmp_masks = tmp_masks.unsqueeze(1)
+        if self.global_cmvn is not None:
+            xs = self.global_cmvn(xs)
+        xs, pos_emb, _ = self.embed(xs, tmp_masks, offset)
+        return self._forward_chunk_ring_layers(xs, offset, required_cache_size,
+                                               att_cache, cnn_cache)
+
+    def _forward_chunk_ring_layers(
+        self,
+        xs: torch.Tensor,
+        offset: int,
+        required_cache_size: int,
+        att_cache: torch.Tensor,
+        cnn_cache: torch.Tensor,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """ Encoder layers part of `forward_chunk_ring`, xs is the output of
+            subsampling with shape (b=1, chunk_size, hidden-dim)
+        """
+        chunk_size = xs.size(1)
+        ring_size = att_cache.size(2)
+        assert required_cache_size + chunk_size <= ring_size
+        end = offset + chunk_size
+        # slots the KEY & VALUE of current chunk are written to
+        cache_index = torch.arange(offset, end, device=xs.device) % ring_size
+        # encoder output time stamp held by every slot after writing, (R,)
+        slot_time = torch.arange(ring_size, device=xs.device)
+        slot_time = end - 1 - torch.remainder(end - 1 - slot_time, ring_size)
+        # attend to current chunk and at most `required_cache_size` history
+        # frames, just like the concatenated cache in `forward_chunk`
+        att_mask = slot_time >= max(offset - required_cache_size, 0)
+        att_mask = att_mask.view(1, 1, ring_size)  # (1, 1, R)
+        # (R, 1, D) -> (1, R, D), negative time stamps are masked anyway
+        pos_emb = self.embed.position_encoding(
+            offset=slot_time, size=1).transpose(0, 1)
+        r_cnn_cache = []
+        for i, layer in enumerate(self.encoders):
+            xs, _, _, new_cnn_cache = layer(
+                xs, att_mask, pos_emb,
+                att_cache=att_cache[i:i + 1],
+                cnn_cache=cnn_cache[i] if cnn_cache.size(0) > 0 else cnn_cache,
+                att_cache_index=cache_index
+            )
+            r_cnn_cache.append(new_cnn_cache.unsqueeze(0))
+        if self.normalize_before:
+            xs = self.after_norm(xs)
+        r_cnn_cache = torch.cat(r_cnn_cache, dim=0)
+
+        return (xs, att_cache, r_cnn_cache)
+
+    def forward_chunk_batch(
+        self,
+        xs: torch.Tensor,
+        xs_lens: torch.Tensor,
+        offset: torch.Tensor,
+        required_cache_size: int,
+        att_cache: torch.Tensor = torch.zeros(0, 0, 0, 0, 0),
+        cnn_cache: torch.Tensor = torch.zeros(0, 0, 0, 0),
+        cache_mask: torch.Tensor = torch.ones((0, 0, 0), dtype=torch.bool),
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor,
+               torch.Tensor]:
+        """ Forward one chunk of N independent streams at once
+
+        Every stream has its own offset and history, the attention cache is
+        kept at a fixed size and `cache_mask` tells which cache frames are
+        real history of each stream. The caches of stream `b` are
+        `att_cache[:, b]`, `cnn_cache[:, b]` and `cache_mask[b]`, so streams
+        can join or leave the batch between chunks by stacking or indexing
+        their caches. A fresh stream uses all-zero caches and an all-False
+        cache mask.
+
+        Args:
+            xs (torch.Tensor): chunk input, with shape (b, time, mel-dim),
+                see `forward_chunk`. Only the last chunk of a stream may be
+                shorter than `time` and padded.
+            xs_lens (torch.Tensor): valid input length of each chunk, (b,)
+            offset (torch.Tensor): current offset in encoder output time
+                stamp of each stream, (b,)
+            required_cache_size (int): cache size required for next chunk
+                compuation, must be > 0.
+            att_cache (torch.Tensor): cache tensor for KEY & VALUE in
+                transformer/conformer attention, with shape
+                (elayers, b, head, required_cache_size, d_k * 2),
+                (0, 0, 0, 0, 0) means all streams are fresh.
+            cnn_cache (torch.Tensor): cache tensor for cnn_module in conformer,
+                (elayers, b, hidden-dim, cache_t2), where
+                `cache_t2 == cnn.lorder`
+            cache_mask (torch.Tensor): valid frames of att_cache,
+                (b, 1, required_cache_size), (0, 0, 0) means all streams are
+                fresh.
+
+        Returns:
+            torch.Tensor: output of current input xs,
+                with shape (b, chunk_size, hidden-dim).
+            torch.Tensor: output padding mask (b, 1, chunk_size)
+            torch.Tensor: new attention cache required for next chunk, with
+                shape (elayers, b, head, required_cache_size, d_k * 2)
+            torch.Tensor: new conformer cnn cache required for next chunk,
+                (elayers, b, hidden-dim, cache_t2)
+            torch.Tensor: new cache mask (b, 1, required_cache_size)
+
+        """
+        assert required_cache_size > 0
+        T = xs.size(1)
+        chunk_masks = ~make_pad_mask(xs_lens, T).unsqueeze(1)  # (B, 1, T)
+        if self.global_cmvn is not None:
+            xs = self.global_cmvn(xs)
+        xs, _, chunk_masks = self.embed(xs, chunk_masks, offset)
+        if att_cache.size(0) == 0:
+            self_attn = self.encoders[0].self_attn
+            att_cache = torch.zeros(
+                (len(self.encoders), xs.size(0), self_attn.h,
+                 required_cache_size, self_attn.d_k * 2),
+                device=xs.device, dtype=xs.dtype)
+            cache_mask = torch.zeros((xs.size(0), 1, required_cache_size),
+                                     device=xs.device, dtype=torch.bool)
+        assert att_cache.size(3) == required_cache_size
+        # (B, 1, required_cache_size + chunk_size)
+        masks = torch.cat((cache_mask, chunk_masks), dim=2)
+        # NOTE: negative time stamps of fresh streams are masked out anyway
+        pos_emb = self.embed.position_encoding(
+            offset=offset - required_cache_size,
+            size=required_cache_size + xs.size(1))
+        r_att_cache = []
+        r_cnn_cache = []
+        for i, layer in enumerate(self.encoders):
+            xs, _, new_att_cache, new_cnn_cache = layer(
+                xs, masks, pos_emb, mask_pad=chunk_masks,
+                att_cache=att_cache[i],
+                cnn_cache=cnn_cache[i] if cnn_cache.size(0) > 0 else cnn_cache
+            )
+            # shape(new_att_cache) is (B, head, attention_key_size, d_k * 2)
+            r_att_cache.append(
+                new_att_cache[:, :, -required_cache_size:, :].unsqueeze(0))
+            r_cnn_cache.append(new_cnn_cache.unsqueeze(0))
+        if self.normalize_before:
+            xs = self.after_norm(xs)
+
+        r_att_cache = torch.cat(r_att_cache, dim=0)
+        r_cnn_cache = torch.cat(r_cnn_cache, dim=0)
+        r_cache_mask = masks[:, :, -required_cache_size:]
+
+        return (xs, chunk_masks, r_att_cache, r_cnn_cache, r_cache_mask)
+
     def forward_chunk_by_chunk(
         self,
         xs: torch.Tensor,
         decoding_chunk_size: int,
         num_decoding_left_chunks: int = -1,
+        use_ring_cache: bool = False,
+        use_subsampling_cache: bool = False,
     ) -> Tuple[torch.Tensor, torch.Tensor]:
         """ Forward input chunk by chunk with chunk_size like a streaming
             fashion
@@ -276,7 +484,7 @@ class BaseEncoder(torch.nn.Module):
             2. convolution in conformer
             3. convolution in subsampling
 
-        However, we don't implement subsampling cache for:
+        By default, we don't implement subsampling cache for:
             1. We can control subsampling module to output the right result by
                overlapping input instead of cache left context, even though it
                wastes some computation, but subsampling only takes a very
@@ -288,9 +496,18 @@ class BaseEncoder(torch.nn.Module):
             3. Currently, nn.Sequential is used to stack all the convolution
                layers in subsampling, we need to rewrite it to make it work
                with cache, which is not prefered.
+        For small chunk sizes the overlap is a big share of the input, so
+        `use_subsampling_cache` wraps Conv2dSubsampling4/6/8 with
+        `StreamingConv2dSubsampling`, which caches the left context of every
+        convolution layer and only feeds new frames of each chunk.
         Args:
             xs (torch.Tensor): (1, max_len, dim)
             chunk_size (int): decoding chunk size
+            use_ring_cache (bool): use a preallocated ring-buffer attention
+                cache, see `forward_chunk_ring`. It requires
+                num_decoding_left_chunks >= 0.
+            use_subsampling_cache (bool): cache left context of subsampling
+                instead of overlapping the input of adjacent chunks.
         """
         assert decoding_chunk_size > 0
         # The model is trained by static or dynamic chunk
@@ -305,13 +522,47 @@ class BaseEncoder(torch.nn.Module):
         outputs = []
         offset = 0
         required_cache_size = decoding_chunk_size * num_decoding_left_chunks
+        if use_ring_cache:
+            assert required_cache_size >= 0
+            self_attn = self.encoders[0].self_attn
+            att_cache = torch.zeros(
+                (len(self.encoders), self_attn.h,
+                 required_cache_size + decoding_chunk_size,
+                 self_attn.d_k * 2),
+                device=xs.device, dtype=xs.dtype)
+        if use_subsampling_cache:
+            embed = StreamingConv2dSubsampling(self.embed)
+            subsampling_cache: List[torch.Tensor] = []
+        fed_frames = 0
 
         # Feed forward overlap input step by step
         for cur in range(0, num_frames - context + 1, stride):
             end = min(cur + decoding_window, num_frames)
             chunk_xs = xs[:, cur:end, :]
-            (y, att_cache, cnn_cache) = self.forward_chunk(
-                chunk_xs, offset, required_cache_size, att_cache, cnn_cache)
+            if use_subsampling_cache:
+                # Only feed frames not seen by the subsampling module yet
+                chunk_xs = xs[:, fed_frames:end, :]
+                fed_frames = end
+                if self.global_cmvn is not None:
+                    chunk_xs = self.global_cmvn(chunk_xs)
+                chunk_xs, _, subsampling_cache = embed(
+                    chunk_xs, offset, subsampling_cache)
+                if use_ring_cache:
+                    (y, att_cache, cnn_cache) = self._forward_chunk_ring_layers(
+                        chunk_xs, offset, required_cache_size, att_cache,
+                        cnn_cache)
+                else:
+                    (y, att_cache, cnn_cache) = self._forward_chunk_layers(
+                        chunk_xs, offset, required_cache_size, att_cache,
+                        cnn_cache, torch.ones((0, 0, 0), dtype=torch.bool))
+            elif use_ring_cache:
+                (y, att_cache, cnn_cache) = self.forward_chunk_ring(
+                    chunk_xs, offset, required_cache_size, att_cache,
+                    cnn_cache)
+            else:
+                (y, att_cache, cnn_cache) = self.forward_chunk(
+                    chunk_xs, offset, required_cache_size, att_cache,
+                    cnn_cache)
             outputs.append(y)
             offset += y.size(1)
         ys = torch.cat(outputs, 1)
@@ -63,6 +63,7 @@ class TransformerEncoderLayer(nn.Module):
         mask_pad: torch.Tensor = torch.ones((0, 0, 0), dtype=torch.bool),
         att_cache: torch.Tensor = torch.zeros((0, 0, 0, 0)),
         cnn_cache: torch.Tensor = torch.zeros((0, 0, 0, 0)),
+        att_cache_index: torch.Tensor = torch.zeros(0, dtype=torch.long),
     ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
         """Compute encoded features.
 
@@ -79,6 +80,8 @@ class TransformerEncoderLayer(nn.Module):
             cnn_cache (torch.Tensor): Convolution cache in conformer layer
                 (#batch=1, size, cache_t2), not used here, it's for interface
                 compatibility to ConformerEncoderLayer.
+            att_cache_index (torch.Tensor): Slots of a ring-buffer att_cache
+                to write the new KEY & VALUE to, (0,) means no ring-buffer.
         Returns:
             torch.Tensor: Output tensor (#batch, time, size).
             torch.Tensor: Mask tensor (#batch, time, time).
@@ -91,7 +94,7 @@ class TransformerEncoderLayer(nn.Module):
         if self.normalize_before:
             x = self.norm1(x)
         x_att, new_att_cache = self.self_attn(
-            x, x, x, mask, cache=att_cache)
+            x, x, x, mask, cache=att_cache, cache_index=att_cache_index)
         x = residual + self.dropout(x_att)
         if not self.normalize_before:
             x = self.norm1(x)
@@ -167,6 +170,7 @@ class ConformerEncoderLayer(nn.Module):
         mask_pad: torch.Tensor = torch.ones((0, 0, 0), dtype=torch.bool),
         att_cache: torch.Tensor = torch.zeros((0, 0, 0, 0)),
         cnn_cache: torch.Tensor = torch.zeros((0, 0, 0, 0)),
+        att_cache_index: torch.Tensor = torch.zeros(0, dtype=torch.long),
     ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
         """Compute encoded features.
 
@@ -182,6 +186,8 @@ class ConformerEncoderLayer(nn.Module):
                 (#batch=1, head, cache_t1, d_k * 2), head * d_k == size.
             cnn_cache (torch.Tensor): Convolution cache in conformer layer
                 (#batch=1, size, cache_t2)
+            att_cache_index (torch.Tensor): Slots of a ring-buffer att_cache
+                to write the new KEY & VALUE to, (0,) means no ring-buffer.
         Returns:
             torch.Tensor: Output tensor (#batch, time, size).
             torch.Tensor: Mask tensor (#batch, time, time).
@@ -205,7 +211,7 @@ class ConformerEncoderLayer(nn.Module):
         if self.normalize_before:
             x = self.norm_mha(x)
         x_att, new_att_cache = self.self_attn(
-            x, x, x, mask, pos_emb, att_cache)
+            x, x, x, mask, pos_emb, att_cache, att_cache_index)
         x = residual + self.dropout(x_att)
         if not self.normalize_before:
             x = self.norm_mha(x)
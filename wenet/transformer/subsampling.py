@@ -16,7 +16,7 @@
 
 """Subsampling layer definition."""
 
-from typing import Tuple, Union
+from typing import List, Tuple, Union
 
 import torch
 
@@ -238,3 +238,80 @@ class Conv2dSubsampling8(BaseSubsampling):
         x = self.linear(x.transpose(1, 2).contiguous().view(b, t, c * f))
         x, pos_emb = self.pos_enc(x, offset)
         return x, pos_emb, x_mask[:, :, 2::2][:, :, 2::2][:, :, 2::2]
+
+
+class StreamingConv2dSubsampling(torch.nn.Module):
+    """Chunk-wise Conv2dSubsampling4/6/8 with left context cache.
+
+    Instead of re-feeding the overlapped input frames of the previous chunk,
+    every convolution layer keeps the tail of its input which is still
+    needed by its next output frame, so each chunk only feeds new frames.
+    The outputs are the same as running the wrapped subsampling module on
+    the whole input. Parameters are shared with the wrapped module.
+
+    Args:
+        subsampling (BaseSubsampling): Conv2dSubsampling4/6/8 to wrap.
+
+    """
+    def __init__(self, subsampling: BaseSubsampling):
+        super().__init__()
+        if isinstance(subsampling, Conv2dSubsampling4):
+            self.out = subsampling.out
+        elif isinstance(subsampling, (Conv2dSubsampling6,
+                                      Conv2dSubsampling8)):
+            self.out = subsampling.linear
+        else:
+            raise ValueError("unsupported subsampling: {}".format(
+                type(subsampling).__name__))
+        self.conv = subsampling.conv
+        self.pos_enc = subsampling.pos_enc
+        self.subsampling_rate = subsampling.subsampling_rate
+        self.right_context = subsampling.right_context
+
+    def forward(
+        self,
+        x: torch.Tensor,
+        offset: Union[int, torch.Tensor] = 0,
+        cache: List[torch.Tensor] = []
+    ) -> Tuple[torch.Tensor, torch.Tensor, List[torch.Tensor]]:
+        """Subsample new frames of a chunk.
+
+        Args:
+            x (torch.Tensor): New input frames (#batch, time, idim).
+            offset (int, torch.Tensor): position offset of the output
+            cache (List[torch.Tensor]): left context of every convolution
+                layer, returned by previous call, [] for the first chunk.
+
+        Returns:
+            torch.Tensor: Subsampled tensor (#batch, time', odim), time' may
+                be 0 if there are not enough frames yet.
+            torch.Tensor: positional encoding
+            List[torch.Tensor]: new left context cache
+
+        """
+        x = x.unsqueeze(1)  # (b, c=1, t, f)
+        new_cache: List[torch.Tensor] = []
+        i = 0
+        for layer in self.conv:
+            if isinstance(layer, torch.nn.Conv2d):
+                if len(cache) > 0:
+                    x = torch.cat((cache[i], x), dim=2)
+                kernel, stride = layer.kernel_size[0], layer.stride[0]
+                num_out = 0
+                if x.size(2) >= kernel:
+                    num_out = (x.size(2) - kernel) // stride + 1
+                new_cache.append(x[:, :, num_out * stride:, :])
+                if num_out > 0:
+                    x = layer(x)
+                else:
+                    x = torch.zeros(
+                        (x.size(0), layer.out_channels, 0,
+                         (x.size(3) - kernel) // stride + 1),
+                        dtype=x.dtype, device=x.device)
+                i += 1
+            else:
+                x = layer(x)
+        b, c, t, f = x.size()
+        x = self.out(x.transpose(1, 2).contiguous().view(b, t, c * f))
+        x, pos_emb = self.pos_enc(x, offset)
+        return x, pos_emb, new_cache
@@ -61,6 +61,59 @@ def save_checkpoint(model: torch.nn.Module, path: str, infos=None):
         fout.write(data)
 
 
+def load_state_dict_mmap(path: str) -> dict:
+    """ Load a state dict on CPU with its storages memory-mapped, tensors
+        are only read from disk when accessed, so many big checkpoints can
+        be opened at the same time.
+    """
+    try:
+        return torch.load(path, map_location='cpu', mmap=True)
+    except (TypeError, RuntimeError):
+        # old pytorch or legacy (non zipfile) checkpoint format
+        return torch.load(path, map_location='cpu')
+
+
+def save_ema_checkpoint(model: torch.nn.Module, path: str, decay: float,
+                        infos=None):
+    '''
+    Update the exponential moving average of the model weights saved in
+    `path`: ema = decay * ema + (1 - decay) * model, the average starts from
+    the current weights if `path` does not exist. Tensors are accumulated
+    one by one in float64.
+
+    Args:
+        infos (dict or None): any info you want to save.
+    '''
+    if isinstance(model, (torch.nn.DataParallel,
+                          torch.nn.parallel.DistributedDataParallel)):
+        model = model.module
+    state_dict = model.state_dict()
+    if os.path.exists(path):
+        logging.info('Checkpoint: update ema checkpoint %s' % path)
+        ema = load_state_dict_mmap(path)
+        for k, v in state_dict.items():
+            if k not in ema or not v.is_floating_point():
+                ema[k] = v.detach().cpu().clone()
+                continue
+            avg = ema[k].double().mul_(decay)
+            avg.add_(v.detach().cpu().double(), alpha=1.0 - decay)
+            ema[k] = avg.to(v.dtype)
+    else:
+        logging.info('Checkpoint: init ema checkpoint %s' % path)
+        ema = {k: v.detach().cpu().clone() for k, v in state_dict.items()}
+    # write to a temporary file first, `path` may be mapped by `ema`
+    torch.save(ema, path + '.tmp')
+    os.replace(path + '.tmp', path)
+    info_path = re.sub('.pt$', '.yaml', path)
+    if infos is None:
+        infos = {}
+    infos['ema_decay'] = decay
+    infos['save_time'] = datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')
+    with open(info_path, 'w') as fout:
+        data = yaml.dump(infos)
+        fout.write(data)
+
+
 def filter_modules(model_state_dict, modules):
     new_mods = []
     incorrect_mods = []
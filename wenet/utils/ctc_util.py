@@ -12,9 +12,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from typing import List, Optional, Tuple
+
 import numpy as np
 import torch
 
+# Moduli and bases of the two polynomial rolling hashes used to identify
+# prefixes in `ctc_prefix_beam_search`, all products fit in int64
+_PREFIX_HASH_MOD = (1000000007, 998244353)
+_PREFIX_HASH_BASE = (1000003, 999983)
+
+
 def insert_blank(label, blank_id=0):
     """Insert blank token between every two label token."""
     label = np.expand_dims(label, 1)
@@ -36,48 +44,316 @@ def forced_align(ctc_probs: torch.Tensor,
     Returns:
         torch.Tensor: alignment result
     """
-    y_insert_blank = insert_blank(y, blank_id)
-
-    log_alpha = torch.zeros((ctc_probs.size(0), len(y_insert_blank)))
-    log_alpha = log_alpha - float('inf')  # log of zero
-    state_path = (torch.zeros(
-        (ctc_probs.size(0), len(y_insert_blank)), dtype=torch.int16) - 1
-    )  # state path
-
-    # init start state
-    log_alpha[0, 0] = ctc_probs[0][y_insert_blank[0]]
-    log_alpha[0, 1] = ctc_probs[0][y_insert_blank[1]]
-
-    for t in range(1, ctc_probs.size(0)):
-        for s in range(len(y_insert_blank)):
-            if y_insert_blank[s] == blank_id or s < 2 or y_insert_blank[
-                    s] == y_insert_blank[s - 2]:
-                candidates = torch.tensor(
-                    [log_alpha[t - 1, s], log_alpha[t - 1, s - 1]])
-                prev_state = [s, s - 1]
-            else:
-                candidates = torch.tensor([
-                    log_alpha[t - 1, s],
-                    log_alpha[t - 1, s - 1],
-                    log_alpha[t - 1, s - 2],
-                ])
-                prev_state = [s, s - 1, s - 2]
-            log_alpha[t, s] = torch.max(candidates) + ctc_probs[t][y_insert_blank[s]]
-            state_path[t, s] = prev_state[torch.argmax(candidates)]
-
-    state_seq = -1 * torch.ones((ctc_probs.size(0), 1), dtype=torch.int16)
-
-    candidates = torch.tensor([
-        log_alpha[-1, len(y_insert_blank) - 1],
-        log_alpha[-1, len(y_insert_blank) - 2]
-    ])
-    final_state = [len(y_insert_blank) - 1, len(y_insert_blank) - 2]
-    state_seq[-1] = final_state[torch.argmax(candidates)]
-    for t in range(ctc_probs.size(0) - 2, -1, -1):
-        state_seq[t] = state_path[t + 1, state_seq[t + 1, 0]]
-
-    output_alignment = []
-    for t in range(0, ctc_probs.size(0)):
-        output_alignment.append(y_insert_blank[state_seq[t, 0]])
-
-    return output_alignment
+    alignments, _, _ = batch_forced_align(
+        ctc_probs.unsqueeze(0),
+        torch.tensor([ctc_probs.size(0)], device=ctc_probs.device),
+        y.unsqueeze(0),
+        torch.tensor([y.size(0)], device=ctc_probs.device),
+        blank_id)
+    return alignments[0]
+
+
+def batch_forced_align(
+    ctc_probs: torch.Tensor,
+    ctc_lens: torch.Tensor,
+    ys: torch.Tensor,
+    ys_lens: torch.Tensor,
+    blank_id: int = 0,
+) -> Tuple[List[List[int]], List[List[Tuple[int, int]]], List[float]]:
+    """Batched ctc forced alignment by viterbi.
+
+    All the states of all the utterances are updated at once in every
+    frame, only the back pointers are kept and the best path is recovered
+    by backtracking after the last frame.
+
+    Args:
+        ctc_probs (torch.Tensor): ctc log posteriors, (B, T, V)
+        ctc_lens (torch.Tensor): valid frames of each utterance, (B,)
+        ys (torch.Tensor): padded label sequences, (B, L)
+        ys_lens (torch.Tensor): label length of each utterance, (B,)
+        blank_id (int): blank symbol index
+
+    Returns:
+        List[List[int]]: aligned token (blank included) of every frame
+        List[List[Tuple[int, int]]]: [start, end) frames of every token
+        List[float]: viterbi log probability of each utterance
+    """
+    batch_size, maxlen, _ = ctc_probs.size()
+    device = ctc_probs.device
+    neg_inf = -float('inf')
+    num_states = 2 * ys.size(1) + 1
+    # Let's assume S = num_states, blank at even states, tokens at odd ones
+    state_index = torch.arange(num_states, device=device)
+    valid_states = state_index.unsqueeze(0) < \
+        (2 * ys_lens + 1).unsqueeze(1)  # (B, S)
+    ext = torch.full((batch_size, num_states), blank_id, dtype=torch.long,
+                     device=device)
+    ext[:, 1::2] = ys.masked_fill(ys < 0, blank_id)  # (B, S)
+    # s - 2 -> s is allowed for a token different from the previous one
+    skip = torch.zeros_like(valid_states)
+    skip[:, 2:] = (ext[:, 2:] != blank_id) & (ext[:, 2:] != ext[:, :-2])
+
+    # init start states
+    emit = ctc_probs[:, 0].gather(1, ext) if maxlen > 0 else None
+    log_alpha = torch.full((batch_size, num_states), neg_inf,
+                           dtype=ctc_probs.dtype, device=device)
+    log_alpha[:, :2] = emit[:, :2] if maxlen > 0 else neg_inf
+    log_alpha = log_alpha.masked_fill(~valid_states, neg_inf)
+    pad = torch.full((batch_size, 2), neg_inf, dtype=ctc_probs.dtype,
+                     device=device)
+    back = []  # how many states are stepped back at each frame
+    for t in range(1, maxlen):
+        emit = ctc_probs[:, t].gather(1, ext)  # (B, S)
+        prev = torch.cat([pad, log_alpha], dim=1)  # (B, 2 + S)
+        candidates = torch.stack([
+            log_alpha,
+            prev[:, 1:-1],
+            prev[:, :-2].masked_fill(~skip, neg_inf),
+        ], dim=-1)  # (B, S, 3)
+        best, step = candidates.max(-1)
+        active = (ctc_lens > t).unsqueeze(1)  # (B, 1)
+        new_alpha = (best + emit).masked_fill(~valid_states, neg_inf)
+        log_alpha = torch.where(active, new_alpha, log_alpha)
+        back.append(step.to(torch.int8))
+
+    # final state is the last blank or the last token
+    last = 2 * ys_lens  # (B,)
+    last_blank = log_alpha.gather(1, last.unsqueeze(1)).squeeze(1)
+    last_token = log_alpha.gather(1, (last - 1).clamp(min=0).unsqueeze(1))
+    last_token = last_token.squeeze(1).masked_fill(ys_lens == 0, neg_inf)
+    state = torch.where(last_token > last_blank, last - 1, last)
+    scores = torch.maximum(last_blank, last_token)
+    # backtrack
+    path = torch.zeros((batch_size, maxlen), dtype=torch.long, device=device)
+    for t in range(maxlen - 1, -1, -1):
+        active = ctc_lens > t
+        path[:, t] = state
+        if t > 0:
+            step = back[t - 1].gather(1, state.unsqueeze(1)).squeeze(1)
+            state = torch.where(active, state - step.long(), state)
+
+    tokens = ext.gather(1, path)  # (B, T)
+    # [start, end) frames of every token, token k is state 2k + 1
+    frame = torch.arange(maxlen, device=device).unsqueeze(0)
+    valid_frames = frame < ctc_lens.unsqueeze(1)  # (B, T)
+    is_token = (path % 2 == 1) & valid_frames
+    token_index = torch.where(is_token, path // 2, ys.size(1))
+    num_slots = ys.size(1) + 1
+    start = torch.full((batch_size, num_slots), maxlen, dtype=torch.long,
+                       device=device).scatter_reduce(
+                           1, token_index, frame.expand(batch_size, -1),
+                           'amin')
+    end = torch.full((batch_size, num_slots), -1, dtype=torch.long,
+                     device=device).scatter_reduce(
+                         1, token_index, frame.expand(batch_size, -1),
+                         'amax') + 1
+
+    tokens = tokens.tolist()
+    start = start.tolist()
+    end = end.tolist()
+    alignments, segments = [], []
+    for b in range(batch_size):
+        alignments.append(tokens[b][:int(ctc_lens[b])])
+        segments.append(list(zip(start[b][:int(ys_lens[b])],
+                                 end[b][:int(ys_lens[b])])))
+    return alignments, segments, scores.tolist()
+
+
+def ctc_blank_skip(
+    ctc_probs: torch.Tensor,
+    ctc_lens: torch.Tensor,
+    blank_skip_thresh: float,
+    blank_id: int = 0,
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Drop the frames dominated by blank before ctc search.
+
+    A frame is dropped when its blank posterior is larger than
+    `blank_skip_thresh` and so is the blank posterior of its previous
+    frame, i.e. only the first frame of each blank run is kept, so two
+    same tokens separated by blank frames are still separated by a blank
+    after skipping.
+
+    Args:
+        ctc_probs (torch.Tensor): ctc log posteriors, (B, T, V)
+        ctc_lens (torch.Tensor): valid frames of each utterance, (B,)
+        blank_skip_thresh (float): blank posterior threshold,
+            1.0 means no skip
+        blank_id (int): blank symbol index
+
+    Returns:
+        torch.Tensor: kept log posteriors, (B, T', V)
+        torch.Tensor: kept frames of each utterance, (B,)
+        torch.Tensor: original frame index of each kept frame, (B, T')
+    """
+    batch_size, maxlen, vocab_size = ctc_probs.size()
+    blank = ctc_probs[:, :, blank_id].exp() > blank_skip_thresh  # (B, T)
+    prev_blank = torch.cat([blank.new_zeros(batch_size, 1), blank[:, :-1]],
+                           dim=1)
+    valid = torch.arange(maxlen, device=ctc_probs.device).unsqueeze(0) < \
+        ctc_lens.unsqueeze(1)
+    keep = valid & ~(blank & prev_blank)  # (B, T)
+    new_lens = keep.sum(1)
+    new_maxlen = int(new_lens.max()) if batch_size > 0 else 0
+    # kept frames first, in their original order
+    frame_index = torch.sort((~keep).int(), dim=1,
+                             stable=True)[1][:, :new_maxlen]  # (B, T')
+    ctc_probs = ctc_probs.gather(
+        1,
+        frame_index.unsqueeze(2).expand(-1, -1, vocab_size))  # (B, T', V)
+    return ctc_probs, new_lens, frame_index
+
+
+def ctc_prefix_beam_search(
+    ctc_probs: torch.Tensor,
+    ctc_lens: torch.Tensor,
+    beam_size: int,
+    blank_id: int = 0,
+    frame_index: Optional[torch.Tensor] = None,
+) -> List[List[Tuple[Tuple[int, ...], float, Tuple[int, ...]]]]:
+    """Batched ctc prefix beam search.
+
+    All the prefixes of all the utterances are kept in tensors, the
+    prefixes are identified by rolling hashes so that merging the same
+    prefix reached from different paths is a tensor operation as well.
+    Only the back pointers are kept during the search, the prefixes are
+    recovered by backtracking once the last frame is processed.
+
+    Args:
+        ctc_probs (torch.Tensor): ctc log posteriors, (B, T, V)
+        ctc_lens (torch.Tensor): valid frames of each utterance, (B,)
+        beam_size (int): beam size for beam search
+        blank_id (int): blank symbol index
+        frame_index (torch.Tensor): original frame index of each frame in
+            ctc_probs, (B, T), see `ctc_blank_skip`. If it is None, frame
+            t of ctc_probs is the original frame t.
+
+    Returns:
+        List[List[Tuple[Tuple[int, ...], float, Tuple[int, ...]]]]: nbest
+            (prefix, score, times) of each utterance, sorted by score in
+            descending order, times is the frame where each token of the
+            prefix is emitted.
+    """
+    batch_size, maxlen, vocab_size = ctc_probs.size()
+    device = ctc_probs.device
+    neg_inf = -float('inf')
+    # Let's assume B = batch_size, N = beam_size and K = first beam size
+    num_k = min(beam_size, vocab_size)
+    mod1, mod2 = _PREFIX_HASH_MOD
+    base1, base2 = _PREFIX_HASH_BASE
+    # blank ending score and none blank ending score of each prefix
+    pb = torch.full((batch_size, beam_size), neg_inf, dtype=ctc_probs.dtype,
+                    device=device)
+    pb[:, 0] = 0.0
+    pnb = torch.full_like(pb, neg_inf)
+    # last token (-1 for empty prefix), length and hashes of each prefix
+    last = torch.full((batch_size, beam_size), -1, dtype=torch.long,
+                      device=device)
+    lens = torch.zeros((batch_size, beam_size), dtype=torch.long,
+                       device=device)
+    hash1 = torch.zeros((batch_size, beam_size), dtype=torch.long,
+                        device=device)
+    hash2 = torch.zeros((batch_size, beam_size), dtype=torch.long,
+                        device=device)
+    # Candidates are N unchanged prefixes followed by N*K extended ones
+    beam_index = torch.arange(beam_size, device=device)
+    cand_parent = torch.cat([beam_index,
+                             beam_index.repeat_interleave(num_k)])  # (C,)
+    num_cand = cand_parent.size(0)
+    # strictly lower triangular, (C, C)
+    earlier = torch.ones(num_cand, num_cand, dtype=torch.bool,
+                         device=device).tril(-1)
+    parents = []
+    tokens = []
+    for t in range(maxlen):
+        logp = ctc_probs[:, t]  # (B, V)
+        # 1. First beam prune: select topk best
+        top_k_logp, top_k_index = logp.topk(num_k)  # (B, K)
+        p_all = torch.logaddexp(pb, pnb)  # (B, N)
+        # 2.1 Prefix unchanged: *- -> *, or *s -> *s
+        blank_logp = torch.where((top_k_index == blank_id).any(-1),
+                                 logp[:, blank_id],
+                                 torch.full_like(logp[:, blank_id],
+                                                 neg_inf))  # (B,)
+        stay_pb = p_all + blank_logp.unsqueeze(1)  # (B, N)
+        last_in_top_k = (top_k_index.unsqueeze(1) ==
+                         last.unsqueeze(2)).any(-1)  # (B, N)
+        last_logp = logp.gather(1, last.clamp(min=0))  # (B, N)
+        stay_pnb = (pnb + last_logp).masked_fill(~last_in_top_k, neg_inf)
+        # 2.2 Prefix extended: *s-s -> *ss, or *r -> *rs
+        s = top_k_index.unsqueeze(1)  # (B, 1, K)
+        ps = top_k_logp.unsqueeze(1)  # (B, 1, K)
+        ext_pnb = torch.where(s == last.unsqueeze(2),
+                              pb.unsqueeze(2) + ps,
+                              p_all.unsqueeze(2) + ps)  # (B, N, K)
+        ext_pnb = ext_pnb.masked_fill(s == blank_id, neg_inf)
+        ext_token = s.expand(-1, beam_size, -1)  # (B, N, K)
+        ext_hash1 = (hash1.unsqueeze(2) * base1 + ext_token + 1) % mod1
+        ext_hash2 = (hash2.unsqueeze(2) * base2 + ext_token + 1) % mod2
+        # 2.3 Merge candidates which share the same prefix
+        cand_pb = torch.cat([stay_pb, torch.full_like(ext_pnb, neg_inf).view(
+            batch_size, -1)], dim=1)  # (B, C)
+        cand_pnb = torch.cat([stay_pnb, ext_pnb.view(batch_size, -1)], dim=1)
+        cand_hash1 = torch.cat([hash1, ext_hash1.view(batch_size, -1)], dim=1)
+        cand_hash2 = torch.cat([hash2, ext_hash2.view(batch_size, -1)], dim=1)
+        cand_lens = torch.cat(
+            [lens, (lens + 1).repeat_interleave(num_k, dim=1)], dim=1)
+        cand_token = torch.cat([torch.full_like(last, -1),
+                                ext_token.reshape(batch_size, -1)], dim=1)
+        same = ((cand_hash1.unsqueeze(2) == cand_hash1.unsqueeze(1)) &
+                (cand_hash2.unsqueeze(2) == cand_hash2.unsqueeze(1)) &
+                (cand_lens.unsqueeze(2) == cand_lens.unsqueeze(1)))
+        merged_pb = cand_pb.unsqueeze(1).masked_fill(~same, neg_inf)
+        merged_pb = torch.logsumexp(merged_pb, dim=-1)  # (B, C)
+        merged_pnb = cand_pnb.unsqueeze(1).masked_fill(~same, neg_inf)
+        merged_pnb = torch.logsumexp(merged_pnb, dim=-1)  # (B, C)
+        # only the first candidate of each prefix is kept
+        dup = (same & earlier).any(-1)  # (B, C)
+        merged_pb = merged_pb.masked_fill(dup, neg_inf)
+        merged_pnb = merged_pnb.masked_fill(dup, neg_inf)
+        # 3. Second beam prune
+        _, best_index = torch.logaddexp(merged_pb,
+                                        merged_pnb).topk(beam_size)  # (B, N)
+        parent = cand_parent[best_index]  # (B, N)
+        token = cand_token.gather(1, best_index)  # (B, N)
+        # Utterances shorter than t keep their beam unchanged
+        active = (ctc_lens > t).unsqueeze(1)  # (B, 1)
+        parent = torch.where(active, parent, beam_index.unsqueeze(0))
+        token = token.masked_fill(~active, -1)
+        pb = torch.where(active, merged_pb.gather(1, best_index), pb)
+        pnb = torch.where(active, merged_pnb.gather(1, best_index), pnb)
+        hash1 = torch.where(active, cand_hash1.gather(1, best_index), hash1)
+        hash2 = torch.where(active, cand_hash2.gather(1, best_index), hash2)
+        lens = torch.where(active, cand_lens.gather(1, best_index), lens)
+        last = torch.where(token >= 0, token, last.gather(1, parent))
+        parents.append(parent)
+        tokens.append(token)
+
+    # 4. Backtrack the prefixes from the back pointers
+    scores, order = torch.logaddexp(pb, pnb).sort(dim=1, descending=True)
+    scores = scores.tolist()
+    paths = [[[] for _ in range(beam_size)] for _ in range(batch_size)]
+    if maxlen > 0:
+        parents = torch.stack(parents).cpu()  # (T, B, N)
+        tokens = torch.stack(tokens).cpu()  # (T, B, N)
+        index = order.cpu()
+        path = []
+        for t in range(maxlen - 1, -1, -1):
+            path.append(tokens[t].gather(1, index))
+            index = parents[t].gather(1, index)
+        # (B, N, T), in reversed time order
+        paths = torch.stack(path, dim=-1).flip(-1).tolist()
+    if frame_index is None:
+        times = [list(range(maxlen))] * batch_size
+    else:
+        times = frame_index.tolist()
+    hyps = []
+    for b in range(batch_size):
+        nbest = []
+        for n in range(beam_size):
+            if scores[b][n] == neg_inf:
+                continue
+            emit = [t for t, w in enumerate(paths[b][n]) if w >= 0]
+            nbest.append((tuple(paths[b][n][t] for t in emit), scores[b][n],
+                          tuple(times[b][t] for t in emit)))
+        hyps.append(nbest)
+    return hyps
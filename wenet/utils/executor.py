@@ -23,8 +23,17 @@ from torch.nn.utils import clip_grad_norm_
 
 class Executor:
 
-    def __init__(self):
+    def __init__(self, augment=None, feature=None):
+        """
+        Args:
+            augment: callable to augment (feats, feats_lengths) on device
+                in training, such as BatchSpecAugment
+            feature: callable to compute (feats, feats_lengths) from the
+                padded waveforms of the batch on device, such as BatchFbank
+        """
         self.step = 0
+        self.augment = augment
+        self.feature = feature
 
     def train(self, model, optimizer, scheduler, data_loader, device, writer,
               args, scaler):
@@ -60,6 +69,10 @@ class Executor:
                 num_utts = target_lengths.size(0)
                 if num_utts == 0:
                     continue
+                if self.feature is not None:
+                    feats, feats_lengths = self.feature(feats, feats_lengths)
+                if self.augment is not None:
+                    feats = self.augment(feats, feats_lengths)
                 context = None
                 # Disable gradient synchronizations across DDP processes.
                 # Within this context, gradients will be accumulated on module
@@ -138,6 +151,8 @@ class Executor:
                 num_utts = target_lengths.size(0)
                 if num_utts == 0:
                     continue
+                if self.feature is not None:
+                    feats, feats_lengths = self.feature(feats, feats_lengths)
                 loss_dict = model(feats, feats_lengths, target, target_lengths)
                 loss = loss_dict['loss']
                 if torch.isfinite(loss):
@@ -0,0 +1,310 @@
+# Copyright (c) 2021 Mobvoi Inc. (authors: Binbin Zhang)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+""" Decode long recordings with memory independent of their length:
+    audio is read block by block, cut into segments by an energy VAD or
+    by CTC blank endpoints, and every segment is decoded chunk by chunk
+    with bounded encoder caches.
+"""
+
+import math
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import torch
+import torchaudio
+import torchaudio.compliance.kaldi as kaldi
+
+
+def read_wav_blocks(wav_file: str,
+                    block_seconds: float = 10.0,
+                    resample_rate: Optional[int] = None
+                    ) -> Tuple[int, Iterator[torch.Tensor]]:
+    """ Read a wav file lazily
+
+        Returns:
+            int: sample rate of the blocks
+            Iterator[torch.Tensor]: mono blocks of samples, (num_samples,)
+    """
+    sample_rate = torchaudio.info(wav_file).sample_rate
+    block_size = int(block_seconds * sample_rate)
+
+    def blocks():
+        offset = 0
+        while True:
+            waveform, _ = torchaudio.load(wav_file,
+                                          frame_offset=offset,
+                                          num_frames=block_size)
+            if waveform.size(1) == 0:
+                break
+            offset += waveform.size(1)
+            yield waveform.mean(dim=0)
+            if waveform.size(1) < block_size:
+                break
+
+    if resample_rate is not None and resample_rate != sample_rate:
+        return resample_rate, resample_blocks(blocks(), sample_rate,
+                                              resample_rate)
+    return sample_rate, blocks()
+
+
+def resample_blocks(blocks: Iterator[torch.Tensor], orig_freq: int,
+                    new_freq: int) -> Iterator[torch.Tensor]:
+    """ Resample a stream of blocks of samples, the output is the same as
+        torchaudio.functional.resample over the whole stream
+
+        The inputs around the block boundaries are kept for the resampling
+        filter, so only the outputs whose filter support is complete are
+        yielded, the rest are computed again with the next block.
+
+        Returns:
+            Iterator[torch.Tensor]: blocks of resampled samples
+    """
+    gcd = math.gcd(orig_freq, new_freq)
+    # every `orig_unit` inputs give `new_unit` outputs
+    orig_unit, new_unit = orig_freq // gcd, new_freq // gcd
+    # see torchaudio.functional.resample, lowpass_filter_width 6 and
+    # rolloff 0.99, an output depends on `width` inputs before its unit
+    # and `width` after
+    width = math.ceil(6 * orig_unit / (0.99 * min(orig_unit, new_unit)))
+    context = math.ceil((width + orig_unit) / orig_unit) * orig_unit
+    buf = torch.zeros(0)
+    buf_start = 0  # input index of buf[0], a multiple of orig_unit
+    done = 0  # input index up to which outputs are yielded
+    for block in blocks:
+        buf = torch.cat([buf, block])
+        end = (buf_start + buf.size(0) - context) // orig_unit * orig_unit
+        if end <= done:
+            continue
+        out = torchaudio.functional.resample(
+            buf[:end + context - buf_start], orig_freq, new_freq)
+        yield out[(done - buf_start) // orig_unit *
+                  new_unit:(end - buf_start) // orig_unit * new_unit]
+        done = end
+        keep = max(done - context, 0)
+        buf = buf[keep - buf_start:]
+        buf_start = keep
+    if buf.size(0) > 0:
+        out = torchaudio.functional.resample(buf, orig_freq, new_freq)
+        yield out[(done - buf_start) // orig_unit * new_unit:]
+
+
+def energy_vad(blocks: Iterator[torch.Tensor],
+               sample_rate: int,
+               threshold_db: float = -40.0,
+               frame_ms: float = 30.0,
+               min_silence: float = 0.5,
+               pad: float = 0.2,
+               max_segment: float = 30.0
+               ) -> Iterator[Tuple[int, torch.Tensor]]:
+    """ Cut speech segments out of blocks of samples by frame energy
+
+        A segment ends after `min_silence` seconds of frames quieter than
+        `threshold_db` (dB relative to full scale), or when it is longer
+        than `max_segment` seconds. Only the samples of the current segment
+        are buffered.
+
+        Returns:
+            Iterator[Tuple[int, torch.Tensor]]: first sample index and
+                samples of every segment
+    """
+    frame = int(sample_rate * frame_ms / 1000)
+    pad = int(pad * sample_rate)
+    min_silence = int(min_silence * sample_rate)
+    max_segment = int(max_segment * sample_rate)
+    buf = torch.zeros(0)
+    buf_start = 0  # sample index of buf[0]
+    pos = 0  # sample index of the next frame
+    seg_start, last_speech, last_end = None, 0, 0
+    for block in blocks:
+        buf = torch.cat([buf, block])
+        num_frames = (buf_start + buf.size(0) - pos) // frame
+        if num_frames == 0:
+            continue
+        frames = buf[pos - buf_start:pos - buf_start + num_frames * frame]
+        energy = frames.view(num_frames, frame).pow(2).mean(dim=1)
+        speech = (10 * torch.log10(energy + 1e-10) > threshold_db).tolist()
+        for is_speech in speech:
+            if is_speech:
+                if seg_start is None:
+                    seg_start = max(pos - pad, last_end, buf_start)
+                last_speech = pos + frame
+            pos += frame
+            if seg_start is not None and (pos - last_speech >= min_silence
+                                          or pos - seg_start >= max_segment):
+                last_end = min(last_speech + pad, pos)
+                yield seg_start, buf[seg_start - buf_start:last_end -
+                                     buf_start]
+                seg_start = None
+        keep = seg_start if seg_start is not None else max(
+            pos - pad, last_end, buf_start)
+        buf = buf[keep - buf_start:]
+        buf_start = keep
+    if seg_start is not None:
+        end = min(last_speech + pad, buf_start + buf.size(0))
+        yield seg_start, buf[seg_start - buf_start:end - buf_start]
+
+
+class FbankStream():
+    """ Kaldi fbank of a stream of samples, frames are the same as
+        processor.compute_fbank over the whole stream
+    """
+    def __init__(self, sample_rate: int, num_mel_bins: int = 23,
+                 frame_length: int = 25, frame_shift: int = 10):
+        self.sample_rate = sample_rate
+        self.num_mel_bins = num_mel_bins
+        self.frame_length = frame_length
+        self.frame_shift = frame_shift
+        self.window_size = int(sample_rate * frame_length / 1000)
+        self.window_shift = int(sample_rate * frame_shift / 1000)
+        self.remained = torch.zeros(0)
+
+    def accept(self, samples: torch.Tensor) -> torch.Tensor:
+        """ Returns:
+                torch.Tensor: fbank of the new complete frames (T, D)
+        """
+        samples = torch.cat([self.remained, samples])
+        if samples.size(0) < self.window_size:
+            self.remained = samples
+            return torch.zeros(0, self.num_mel_bins)
+        num_frames = (samples.size(0) -
+                      self.window_size) // self.window_shift + 1
+        self.remained = samples[num_frames * self.window_shift:]
+        return kaldi.fbank(samples.unsqueeze(0) * (1 << 15),
+                           num_mel_bins=self.num_mel_bins,
+                           frame_length=self.frame_length,
+                           frame_shift=self.frame_shift,
+                           dither=0.0,
+                           energy_floor=0.0,
+                           sample_frequency=self.sample_rate)
+
+    def reset(self):
+        self.remained = torch.zeros(0)
+
+
+class StreamingCTCDecoder():
+    """ CTC greedy search over encoder chunks, see
+        BaseEncoder.forward_chunk_by_chunk.
+
+        The attention cache keeps `num_left_chunks` chunks at most, and the
+        caches are reset when a segment ends, so the memory only depends on
+        the chunk settings and `max_segment`. With `endpoint_silence` > 0, a
+        segment also ends after that many seconds of CTC blanks following
+        any token.
+    """
+    def __init__(self,
+                 model: torch.nn.Module,
+                 chunk_size: int,
+                 num_left_chunks: int = -1,
+                 frame_shift: int = 10,
+                 max_segment: float = 30.0,
+                 endpoint_silence: float = 0.0,
+                 blank: int = 0):
+        assert chunk_size > 0
+        self.model = model
+        self.chunk_size = chunk_size
+        self.required_cache_size = chunk_size * num_left_chunks
+        self.subsampling = model.encoder.embed.subsampling_rate
+        self.context = model.encoder.embed.right_context + 1
+        self.stride = self.subsampling * chunk_size
+        self.decoding_window = (chunk_size - 1) * self.subsampling + \
+            self.context
+        # seconds of an encoder output frame
+        self.frame_time = self.subsampling * frame_shift / 1000
+        self.max_frames = int(max_segment / self.frame_time)
+        self.endpoint_frames = int(endpoint_silence / self.frame_time)
+        self.blank = blank
+        self.device = next(model.parameters()).device
+        self.reset(0.0)
+
+    def reset(self, start_time: float):
+        """ Start a new segment at `start_time` seconds of the recording,
+            buffered features are dropped
+        """
+        self.feats = torch.zeros(0, 0)
+        self._new_segment(start_time)
+
+    def _new_segment(self, start_time: float):
+        self.start_time = start_time
+        self.offset = 0
+        self.att_cache = torch.zeros((0, 0, 0, 0), device=self.device)
+        self.cnn_cache = torch.zeros((0, 0, 0, 0), device=self.device)
+        self.tokens: List[int] = []
+        self.times: List[float] = []
+        self.prev = self.blank
+        self.num_blanks = 0
+
+    def accept(self, feats: torch.Tensor) -> List[Dict]:
+        """ Decode all the complete chunks of feats (T, D)
+
+            Returns:
+                List[Dict]: segments ended by endpoints or `max_segment`
+        """
+        self.feats = feats if self.feats.size(0) == 0 else torch.cat(
+            [self.feats, feats])
+        segments = []
+        while self.feats.size(0) >= self.decoding_window:
+            segment = self._decode_chunk(self.feats[:self.decoding_window])
+            self.feats = self.feats[self.stride:]
+            if segment is not None:
+                segments.append(segment)
+        return segments
+
+    def finalize(self) -> List[Dict]:
+        """ Decode the remaining features and end the current segment
+
+            Returns:
+                List[Dict]: the remaining segments
+        """
+        segments = []
+        while self.feats.size(0) >= self.context:
+            segment = self._decode_chunk(self.feats[:self.decoding_window])
+            self.feats = self.feats[self.stride:]
+            if segment is not None:
+                segments.append(segment)
+        self.feats = torch.zeros(0, 0)
+        segment = self._end_segment()
+        if segment is not None:
+            segments.append(segment)
+        return segments
+
+    def _decode_chunk(self, chunk: torch.Tensor) -> Optional[Dict]:
+        ys, self.att_cache, self.cnn_cache = self.model.forward_encoder_chunk(
+            chunk.unsqueeze(0).to(self.device), self.offset,
+            self.required_cache_size, self.att_cache, self.cnn_cache)
+        best = self.model.ctc_activation(ys).argmax(dim=-1)[0].tolist()
+        for i, token in enumerate(best):
+            if token == self.blank:
+                self.num_blanks += 1
+            else:
+                self.num_blanks = 0
+                if token != self.prev:
+                    self.tokens.append(token)
+                    self.times.append(self.start_time +
+                                      (self.offset + i) * self.frame_time)
+            self.prev = token
+        self.offset += ys.size(1)
+        if self.offset >= self.max_frames or (
+                self.endpoint_frames > 0 and len(self.tokens) > 0
+                and self.num_blanks >= self.endpoint_frames):
+            return self._end_segment()
+        return None
+
+    def _end_segment(self) -> Optional[Dict]:
+        segment = None
+        if len(self.tokens) > 0:
+            segment = dict(start=self.times[0],
+                           end=self.times[-1] + self.frame_time,
+                           tokens=self.tokens,
+                           times=self.times)
+        self._new_segment(self.start_time + self.offset * self.frame_time)
+        return segment